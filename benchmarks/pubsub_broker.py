@@ -0,0 +1,99 @@
+"""
+Compares publish to subscribe latency and throughput of the embedded broker against redis.
+
+Publications go from one publisher to every subscriber connection of this process, through a broker started in a
+child process and through the redis server at --redis when one is given.
+
+    $ python -m benchmarks.pubsub_broker --messages 20000 --subscribers 4 --redis 127.0.0.1:6379
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import signal
+import time
+
+from benchmarks.registry_sim import percentiles
+from vyked.broker import Broker, BrokerPubSub
+
+CHANNEL = 'benchmark/1.0.0/created'
+BATCH = 500
+
+
+def serve_broker(ready):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = loop.run_until_complete(Broker().serve('127.0.0.1', 0, loop))
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    ready.put(server.sockets[0].getsockname()[1])
+    loop.run_forever()
+
+
+@asyncio.coroutine
+def run(make_handler, messages, subscribers, size, timeout):
+    latencies = []
+    done = asyncio.Future()
+    expected = messages * subscribers
+
+    def on_message(channel, payload):
+        latencies.append(time.perf_counter() - json.loads(payload)['sent'])
+        if len(latencies) == expected and not done.done():
+            done.set_result(None)
+
+    for _ in range(subscribers):
+        asyncio.async(make_handler().subscribe([CHANNEL], on_message))
+    publisher = make_handler()
+    yield from publisher.connect()
+    yield from asyncio.sleep(0.5)  # lets the subscriptions settle
+    padding = 'x' * size
+    start = time.perf_counter()
+    for sent in range(0, messages, BATCH):
+        yield from asyncio.gather(*[publisher.publish(CHANNEL, json.dumps({'sent': time.perf_counter(),
+                                                                           'padding': padding}))
+                                    for _ in range(min(BATCH, messages - sent))])
+    try:
+        yield from asyncio.wait_for(done, timeout)
+    except asyncio.TimeoutError:
+        pass
+    return len(latencies), time.perf_counter() - start, latencies
+
+
+def report(name, received, expected, elapsed, latencies):
+    print('{:<8} {} of {} in {:.3f}s, {:.0f}/s, latency ms {}'.format(
+        name, received, expected, elapsed, received / elapsed,
+        ' '.join('{}={}'.format(k, v) for k, v in percentiles(latencies).items() if k != 'count')))
+
+
+def main(args):
+    logging.getLogger('vyked').setLevel(logging.WARNING)
+    loop = asyncio.get_event_loop()
+    ready = multiprocessing.Queue()
+    broker = multiprocessing.Process(target=serve_broker, args=(ready,))
+    broker.start()
+    expected = args.messages * args.subscribers
+    try:
+        port = ready.get()
+        result = loop.run_until_complete(run(lambda: BrokerPubSub('127.0.0.1', port), args.messages,
+                                             args.subscribers, args.size, args.timeout))
+        report('broker', result[0], expected, *result[1:])
+    finally:
+        broker.terminate()
+        broker.join()
+    if args.redis:
+        from vyked.pubsub import PubSub
+
+        host, port = args.redis.rsplit(':', 1)
+        result = loop.run_until_complete(run(lambda: PubSub(host, int(port)), args.messages, args.subscribers,
+                                             args.size, args.timeout))
+        report('redis', result[0], expected, *result[1:])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--subscribers', type=int, default=4, help='subscriber connections')
+    parser.add_argument('--size', type=int, default=100, help='bytes of padding in every payload')
+    parser.add_argument('--timeout', type=float, default=30, help='seconds to wait for every publication')
+    parser.add_argument('--redis', default=None, metavar='HOST:PORT', help='redis server to compare with')
+    main(parser.parse_args())
@@ -0,0 +1,105 @@
+"""
+Measures the registry's CPU time for keeping nodes alive, pinged by the registry against keepalive leases.
+
+Every mode runs for the same wall clock time with one heartbeat per node per interval. Pings and pongs are looped
+back in process, keepalives are sent one per node or batched the way a process hosting many nodes sends them.
+
+    $ python -m benchmarks.registry_leases --nodes 1000 5000 10000 --interval 0.5 --duration 5
+"""
+import argparse
+import asyncio
+import logging
+import time
+
+from vyked import pinger
+from vyked.lease import KEEPALIVES_PER_LEASE
+from vyked.packet import ControlPacket
+from vyked.registry import Registry, Repository
+
+BATCH = 100
+
+
+class NullProtocol:
+    def send(self, packet):
+        pass
+
+    def is_connected(self):
+        return True
+
+
+class LoopbackProtocol(NullProtocol):
+    """
+    Answers the registry's pings the way a node does
+    """
+
+    def __init__(self, registry):
+        self._registry = registry
+
+    def send(self, packet):
+        if packet['type'] == 'ping':
+            asyncio.get_event_loop().call_soon(self._registry.receive, ControlPacket.pong(packet['node_id']), self,
+                                               None)
+
+
+def make_params(node, lease):
+    return {'service': 'service', 'version': '1.0.0', 'vendors': [], 'host': '10.0.0.1', 'port': 5000 + node,
+            'node_id': 'node{}'.format(node), 'type': 'tcp', 'lease': lease}
+
+
+def connect_loopback(registry, host, port, node_id, service_type):
+    future = asyncio.Future()
+    future.set_result((None, LoopbackProtocol(registry)))
+    registry._handle_service_connection(node_id, future)
+
+
+def send_keepalives(registry, node_ids, batch, interval, running):
+    if not running:
+        return
+    for start in range(0, len(node_ids), batch):
+        registry.receive(ControlPacket.keepalive(node_ids[start:start + batch]), NullProtocol(), None)
+    asyncio.get_event_loop().call_later(interval, send_keepalives, registry, node_ids, batch, interval, running)
+
+
+def run(mode, nodes, interval, duration):
+    loop = asyncio.get_event_loop()
+    running = [True]
+    registry = Registry(None, 0, Repository())
+    registry._connect_to_service = lambda *args: connect_loopback(registry, *args)
+    lease = None if mode == 'ping' else interval * KEEPALIVES_PER_LEASE
+    node_ids = []
+    for node in range(nodes):
+        params = make_params(node, lease)
+        registry.register_service({'params': params}, NullProtocol(), '10.0.0.1', 0)
+        node_ids.append(params['node_id'])
+    if mode != 'ping':
+        registry._expire_leases()
+        loop.call_later(interval, send_keepalives, registry, node_ids, BATCH if mode == 'lease batched' else 1,
+                        interval, running)
+    start = time.process_time()
+    loop.run_until_complete(asyncio.sleep(duration))
+    cpu = time.process_time() - start
+    alive = len(registry._repository.get_nodes())
+    running.clear()
+    for node_pinger in registry._pingers.values():
+        node_pinger.stop()
+    loop.run_until_complete(asyncio.sleep(interval * 2))  # lets the stopped pingers wind down
+    return cpu, alive
+
+
+def main(node_counts, interval, duration):
+    logging.getLogger('vyked').setLevel(logging.WARNING)
+    pinger.PING_INTERVAL = pinger.PING_TIMEOUT = interval
+    print('{:>8} {:<14} {:>12} {:>10} {:>8}'.format('nodes', 'mode', 'cpu (s)', 'cpu share', 'alive'))
+    for nodes in node_counts:
+        for mode in ('ping', 'lease', 'lease batched'):
+            cpu, alive = run(mode, nodes, interval, duration)
+            print('{:>8} {:<14} {:>12.3f} {:>9.1f}% {:>8}'.format(nodes, mode, cpu, cpu / duration * 100, alive))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--nodes', type=int, nargs='+', default=[1000, 5000, 10000])
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds between heartbeats of a node')
+    parser.add_argument('--duration', type=float, default=5, help='seconds each mode runs for')
+    args = parser.parse_args()
+    main(args.nodes, args.interval, args.duration)
@@ -0,0 +1,65 @@
+"""
+Times Repository lookups and a deregistration storm through the Registry.
+
+    $ python -m benchmarks.registry_repository --nodes 10000 --services 1000
+"""
+import argparse
+import logging
+import time
+
+from vyked.registry import Registry, Repository
+
+
+class NullProtocol:
+    def send(self, packet):
+        pass
+
+
+def make_params(service, node, services):
+    vendors = [{'service': 'service{}'.format((service + i) % services), 'version': '1.0.0'} for i in (1, 2)]
+    return {'service': 'service{}'.format(service), 'version': '1.0.0', 'vendors': vendors, 'host': '10.0.0.1',
+            'port': 5000 + node, 'node_id': 'node{}'.format(node), 'type': 'tcp'}
+
+
+def timed(name, count, fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print('{:<24} {:>10.2f} ms {:>12.1f} us/op'.format(name, elapsed * 1e3, elapsed / count * 1e6))
+
+
+def main(nodes, services):
+    logging.getLogger('vyked').setLevel(logging.WARNING)
+    registry = Registry(None, 0, Repository())
+    registry._connect_to_service = lambda *args: None
+    repository = registry._repository
+    params = [make_params(node % services, node, services) for node in range(nodes)]
+
+    def register():
+        for each in params:
+            registry.register_service({'params': each}, NullProtocol(), '10.0.0.1', 0)
+
+    def get_node():
+        for each in params:
+            repository.get_node(each['node_id'])
+
+    def get_consumers():
+        for each in params:
+            repository.get_consumers(each['service'], each['version'])
+
+    def deregister():
+        for each in params:
+            registry.deregister_service(each['node_id'])
+
+    timed('register', nodes, register)
+    timed('get_node', nodes, get_node)
+    timed('get_consumers', nodes, get_consumers)
+    timed('deregistration storm', nodes, deregister)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=10000)
+    parser.add_argument('--services', type=int, default=1000)
+    args = parser.parse_args()
+    main(args.nodes, args.services)
@@ -0,0 +1,232 @@
+"""
+Simulates thousands of virtual nodes against a local registry and reports how it copes.
+
+The registry runs in its own process. Virtual nodes are multiplexed over a few connections, they register with a
+lease, send batched keepalives, xsubscribe and churn: a churned node stops its keepalives and is replaced by a new
+one. Half the services depend on a service of the other half, their nodes register first and stay pending until a
+vendor node shows up, which gives the activation latency. Results are printed and can be written as JSON to compare
+releases.
+
+    $ python -m benchmarks.registry_sim --nodes 5000 --services 500 --churn-rate 50 --output sim.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import random
+import resource
+import signal
+import time
+from functools import partial
+
+from vyked.packet import ControlPacket
+from vyked.protocol_factory import get_vyked_protocol
+from vyked.registry import Registry, Repository
+
+KEEPALIVE_BATCH = 1000
+
+
+def serve(ready, stats):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    logging.getLogger('vyked').setLevel(logging.WARNING)
+    registry = Registry('127.0.0.1', 0, Repository())
+    server = loop.run_until_complete(loop.create_server(partial(get_vyked_protocol, registry), '127.0.0.1', 0))
+    registry._expire_leases()
+    loop.add_signal_handler(signal.SIGTERM, loop.stop)
+    ready.put(server.sockets[0].getsockname()[1])
+    loop.run_forever()
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    stats.put({'cpu_seconds': usage.ru_utime + usage.ru_stime, 'max_rss_kb': usage.ru_maxrss,
+               'nodes': len(registry._repository.get_nodes())})
+
+
+def percentiles(samples):
+    if not samples:
+        return {}
+    samples = sorted(samples)
+
+    def at(fraction):
+        return round(samples[min(len(samples) - 1, int(len(samples) * fraction))] * 1e3, 3)
+
+    return {'count': len(samples), 'p50': at(0.5), 'p90': at(0.9), 'p99': at(0.99),
+            'max': round(samples[-1] * 1e3, 3)}
+
+
+class Connection:
+    """
+    One registry connection carrying many virtual nodes
+    """
+
+    def __init__(self, simulation):
+        self._simulation = simulation
+        self.protocol = None
+        self.nodes = set()
+
+    def receive(self, packet, protocol, transport):
+        if packet['type'] == 'registered':
+            self._simulation.activated(packet['params']['node_id'])
+
+
+class Simulation:
+    def __init__(self, args):
+        self._args = args
+        self._connections = []
+        self._services = ['service{}'.format(i) for i in range(args.services)]
+        self._tier = args.services // 2
+        self._sent = {}
+        self._vendor_registered = {}
+        self._node_service = {}
+        self._alive = []
+        self._next_node = 0
+        self.registration_latency = []
+        self.activation_latency = []
+        self.activated_count = 0
+
+    def activated(self, node_id):
+        now = time.perf_counter()
+        sent = self._sent.pop(node_id, None)
+        if sent is None:
+            return
+        self.activated_count += 1
+        vendor = self._vendor_of(self._node_service[node_id])
+        if vendor is None:
+            self.registration_latency.append(now - sent)
+        else:
+            self.activation_latency.append(now - max(sent, self._vendor_registered.get(vendor, sent)))
+
+    def _vendor_of(self, service):
+        index = self._services.index(service)
+        return self._services[index - self._tier] if index >= self._tier else None
+
+    @asyncio.coroutine
+    def connect(self, port):
+        loop = asyncio.get_event_loop()
+        for _ in range(self._args.connections):
+            connection = Connection(self)
+            _, connection.protocol = yield from loop.create_connection(partial(get_vyked_protocol, connection),
+                                                                       '127.0.0.1', port)
+            self._connections.append(connection)
+
+    def register(self, service):
+        node_id = 'node{}'.format(self._next_node)
+        self._next_node += 1
+        connection = self._connections[self._next_node % len(self._connections)]
+        vendor = self._vendor_of(service)
+        vendors = [] if vendor is None else [{'service': vendor, 'version': '1.0.0'}]
+        params = {'service': service, 'version': '1.0.0', 'vendors': vendors, 'host': '127.0.0.1',
+                  'port': 10000 + self._next_node % 50000, 'node_id': node_id, 'type': 'tcp',
+                  'lease': self._args.lease}
+        self._node_service[node_id] = service
+        self._sent[node_id] = time.perf_counter()
+        if vendor is None:
+            self._vendor_registered.setdefault(service, self._sent[node_id])
+        connection.protocol.send({'pid': node_id, 'type': 'register', 'params': params})
+        connection.nodes.add(node_id)
+        self._alive.append((connection, node_id))
+        if random.random() < self._args.subscribe_ratio:
+            endpoint = (random.choice(self._services[:self._tier]), '1.0.0', 'event', 'RANDOM')
+            connection.protocol.send(ControlPacket.xsubscribe(service, '1.0.0', '127.0.0.1', params['port'], node_id,
+                                                              [endpoint]))
+
+    @asyncio.coroutine
+    def register_all(self, services, count):
+        """
+        Registers count nodes of services at the configured rate, in batches sent every 10ms
+        """
+        batch = max(1, int(self._args.register_rate / 100)) if self._args.register_rate else count
+        for start in range(0, count, batch):
+            for i in range(start, min(count, start + batch)):
+                self.register(services[i % len(services)])
+            yield from asyncio.sleep(0.01 if self._args.register_rate else 0)
+
+    def churn(self):
+        """
+        Drops a random node, its lease runs out in the registry, and registers a replacement
+        """
+        connection, node_id = self._alive.pop(random.randrange(len(self._alive)))
+        connection.nodes.discard(node_id)
+        self.register(self._node_service[node_id])
+
+    @asyncio.coroutine
+    def keepalives(self, until):
+        while time.perf_counter() < until:
+            for connection in self._connections:
+                nodes = list(connection.nodes)
+                for start in range(0, len(nodes), KEEPALIVE_BATCH):
+                    connection.protocol.send(ControlPacket.keepalive(nodes[start:start + KEEPALIVE_BATCH]))
+            yield from asyncio.sleep(self._args.lease / 3)
+
+    @asyncio.coroutine
+    def churn_for(self, until):
+        while self._args.churn_rate and time.perf_counter() < until:
+            self.churn()
+            yield from asyncio.sleep(1 / self._args.churn_rate)
+
+    @asyncio.coroutine
+    def run(self):
+        nodes = self._args.nodes
+        dependants, vendors = self._services[self._tier:], self._services[:self._tier]
+        start = time.perf_counter()
+        keepalives = asyncio.async(self.keepalives(start + 3600))
+        yield from self.register_all(dependants, nodes // 2)
+        yield from self.register_all(vendors, nodes - nodes // 2)
+        while self._sent and time.perf_counter() - start < self._args.timeout:
+            yield from asyncio.sleep(0.05)
+        registration_time = time.perf_counter() - start
+        until = time.perf_counter() + self._args.duration
+        yield from self.churn_for(until)
+        yield from asyncio.sleep(max(0, until - time.perf_counter()))
+        keepalives.cancel()
+        return registration_time
+
+
+def main(args):
+    logging.getLogger('vyked').setLevel(logging.WARNING)
+    ready, stats = multiprocessing.Queue(), multiprocessing.Queue()
+    registry = multiprocessing.Process(target=serve, args=(ready, stats))
+    registry.start()
+    loop = asyncio.get_event_loop()
+    simulation = Simulation(args)
+    try:
+        loop.run_until_complete(simulation.connect(ready.get()))
+        started = time.perf_counter()
+        registration_time = loop.run_until_complete(simulation.run())
+        elapsed = time.perf_counter() - started
+    finally:
+        registry.terminate()
+    registry_stats = stats.get(timeout=10)
+    registry.join()
+    results = {
+        'config': vars(args),
+        'registration_seconds': round(registration_time, 3),
+        'nodes_activated': simulation.activated_count,
+        'registration_latency_ms': percentiles(simulation.registration_latency),
+        'activation_latency_ms': percentiles(simulation.activation_latency),
+        'registry': dict(registry_stats, cpu_share=round(registry_stats['cpu_seconds'] / elapsed, 3)),
+    }
+    for name in ('registration_latency_ms', 'activation_latency_ms'):
+        print('{:<26} {}'.format(name, ' '.join('{}={}'.format(k, v) for k, v in results[name].items())))
+    print('{:<26} {} of {} in {}s'.format('activated', results['nodes_activated'], simulation._next_node,
+                                          results['registration_seconds']))
+    print('{:<26} cpu={cpu_seconds:.2f}s ({cpu_share:.0%}) max_rss={max_rss_kb}kB nodes={nodes}'.format(
+        'registry', **results['registry']))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--nodes', type=int, default=5000)
+    parser.add_argument('--services', type=int, default=500, help='half of them depend on a service of the other half')
+    parser.add_argument('--connections', type=int, default=8, help='connections the virtual nodes share')
+    parser.add_argument('--register-rate', type=float, default=0, help='registrations per second, 0 for no limit')
+    parser.add_argument('--churn-rate', type=float, default=0, help='nodes replaced per second after registration')
+    parser.add_argument('--subscribe-ratio', type=float, default=0.5, help='share of nodes that xsubscribe')
+    parser.add_argument('--lease', type=float, default=10, help='lease of every virtual node in seconds')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of keepalives and churn after registration')
+    parser.add_argument('--timeout', type=float, default=60, help='seconds to wait for every node to be activated')
+    parser.add_argument('--output', default=None, help='write the results to this file as JSON')
+    main(parser.parse_args())
@@ -0,0 +1,113 @@
+"""
+Compares loopback tcp, a unix socket and the shared memory transport between two processes.
+
+Reports the round trip latency of a single frame and the throughput of frames pipelined in bursts,
+the latter being what a chatty pair of co-located services sees.
+
+    $ python -m benchmarks.shm_transport --count 20000 --burst 64 --size 512
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+
+from vyked.shm import create_shm_server, create_shm_connection
+
+FRAME = b'{"pid": "c5f6f1a2", "type": "request", "payload": {"request_id": "8c1d", "data": "%s"}},'
+
+
+class EchoProtocol(asyncio.Protocol):
+    def connection_made(self, transport):
+        self._transport = transport
+
+    def data_received(self, data):
+        self._transport.write(data)
+
+
+class PingProtocol(asyncio.Protocol):
+    def __init__(self):
+        self.transport = None
+        self._received = None
+        self._pending = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self._pending -= len(data)
+        if self._pending <= 0:
+            self._received.set_result(None)
+
+    def send(self, frame, times=1):
+        self._received = asyncio.Future()
+        self._pending = len(frame) * times
+        for _ in range(times):
+            self.transport.write(frame)
+        return self._received
+
+
+def serve(kind, address, ready):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    if kind == 'tcp':
+        server = loop.run_until_complete(loop.create_server(EchoProtocol, '127.0.0.1', 0))
+        address = server.sockets[0].getsockname()[1]
+    elif kind == 'unix':
+        loop.run_until_complete(loop.create_unix_server(EchoProtocol, address))
+    else:
+        loop.run_until_complete(create_shm_server(EchoProtocol, address, loop=loop))
+    ready.put(address)
+    loop.run_forever()
+
+
+@asyncio.coroutine
+def connect(kind, address):
+    loop = asyncio.get_event_loop()
+    if kind == 'tcp':
+        return (yield from loop.create_connection(PingProtocol, '127.0.0.1', address))
+    elif kind == 'unix':
+        return (yield from loop.create_unix_connection(PingProtocol, address))
+    return (yield from create_shm_connection(PingProtocol, address))
+
+
+@asyncio.coroutine
+def measure(kind, address, frame, count, burst):
+    transport, protocol = yield from connect(kind, address)
+    start = time.perf_counter()
+    for _ in range(count):
+        yield from protocol.send(frame)
+    latency = (time.perf_counter() - start) / count * 1e6
+    start = time.perf_counter()
+    for _ in range(count // burst):
+        yield from protocol.send(frame, burst)
+    throughput = (count // burst) * burst / (time.perf_counter() - start)
+    transport.close()
+    return latency, throughput
+
+
+def main(count, burst, size):
+    frame = FRAME % (b'x' * size)
+    directory = tempfile.mkdtemp()
+    loop = asyncio.get_event_loop()
+    print('{:<8} {:>16} {:>18}'.format('', 'round trip (us)', 'pipelined (msg/s)'))
+    for kind in ('tcp', 'unix', 'shm'):
+        ready = multiprocessing.Queue()
+        server = multiprocessing.Process(target=serve, args=(kind, os.path.join(directory, kind + '.sock'), ready))
+        server.start()
+        try:
+            address = ready.get()
+            latency, throughput = loop.run_until_complete(measure(kind, address, frame, count, burst))
+            print('{:<8} {:>16.1f} {:>18.0f}'.format(kind, latency, throughput))
+        finally:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--count', type=int, default=10000, help='frames sent per transport and mode')
+    parser.add_argument('--burst', type=int, default=64, help='frames written per tick in the pipelined mode')
+    parser.add_argument('--size', type=int, default=0, help='padding added to each frame in bytes')
+    args = parser.parse_args()
+    main(args.count, args.burst, args.size)
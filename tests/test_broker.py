@@ -0,0 +1,102 @@
+import asyncio
+from unittest import mock
+
+from vyked.broker import Broker, BrokerPubSub, BrokerProtocol
+from vyked.packet import ControlPacket
+
+
+def _subscriber(broker, *channels, patterns=()):
+    protocol = mock.Mock(**{'is_connected.return_value': True})
+    broker.receive(ControlPacket.channel_subscribe(list(channels), patterns), protocol, mock.Mock())
+    return protocol
+
+
+def test_publication_is_encoded_once_and_fanned_out_per_connection():
+    broker = Broker()
+    first, second = _subscriber(broker, 'service1/1.0.0/created'), _subscriber(broker, 'service1/1.0.0/created')
+    other = _subscriber(broker, 'service1/1.0.0/deleted')
+    gone = _subscriber(broker, 'service1/1.0.0/created')
+    gone.is_connected.return_value = False
+
+    broker.receive(ControlPacket.channel_publish('service1/1.0.0/created', '{"id": 1}'), mock.Mock(), mock.Mock())
+
+    frame = first.send_frame.call_args[0][0]
+    assert frame is second.send_frame.call_args[0][0]
+    assert b'"channel_message"' in frame and b'service1/1.0.0/created' in frame
+    assert not other.send_frame.called and not gone.send_frame.called
+    assert broker.publish('service1/1.0.0/created', '{}') == 2
+
+
+def test_pattern_subscribers_get_a_publication_once():
+    broker = Broker()
+    both = _subscriber(broker, 'service1/1.0.0/created', patterns=['service1/*/created'])
+    wildcard = _subscriber(broker, patterns=['service1/*/created'])
+
+    assert broker.publish('service1/1.0.0/created', '{}') == 2
+    assert broker.publish('service1/2.0.0/created', '{}') == 2
+    assert broker.publish('service1/2.0.0/deleted', '{}') == 0
+    assert both.send_frame.call_count == 2
+
+    broker.connection_lost(wildcard)
+    assert broker.publish('service1/2.0.0/created', '{}') == 1
+    assert broker._patterns == {'service1/*/created'} and wildcard not in broker._channels
+
+
+def test_pattern_matches_are_cached_for_the_last_channels_only():
+    broker = Broker(max_matches=2)
+    _subscriber(broker, patterns=['service1/*/created'])
+
+    for version in ('1.0.0', '2.0.0', '3.0.0'):
+        broker.publish('service1/{}/created'.format(version), '{}')
+
+    assert list(broker._matches) == ['service1/2.0.0/created', 'service1/3.0.0/created']
+
+
+def test_client_hands_messages_to_the_subscription_handler():
+    client = BrokerPubSub('127.0.0.1', 4600)
+    client._protocol = mock.Mock()
+    handler = mock.Mock()
+    asyncio.get_event_loop().run_until_complete(client.subscribe(['service1/1.0.0/created'], handler))
+
+    client.receive(ControlPacket.channel_message('service1/1.0.0/created', '{"id": 1}'), client._protocol, None)
+
+    assert client._protocol.send.call_args[0][0]['channels'] == ['service1/1.0.0/created']
+    handler.assert_called_once_with('service1/1.0.0/created', '{"id": 1}')
+
+
+def test_lost_broker_connection_is_reported_to_the_handler():
+    handler = mock.Mock()
+    protocol = BrokerProtocol(handler)
+    protocol.connection_made(mock.Mock())
+
+    protocol.connection_lost(None)
+
+    handler.connection_lost.assert_called_once_with(protocol)
+
+
+def test_client_reconnects_and_subscribes_again_when_the_broker_connection_drops(monkeypatch):
+    monkeypatch.setattr('vyked.broker.RECONNECT_DELAY', 0)
+    loop = asyncio.get_event_loop()
+    client = BrokerPubSub('127.0.0.1', 4600)
+    attempts = [OSError('refused'), OSError('refused'), mock.Mock()]
+
+    @asyncio.coroutine
+    def connect():
+        attempt = attempts.pop(0)
+        if isinstance(attempt, Exception):
+            raise attempt
+        client._protocol = attempt
+        return attempt
+
+    client._protocol = dropped = mock.Mock()
+    loop.run_until_complete(client.subscribe(['service1/1.0.0/created'], mock.Mock(), patterns=['service2/*/created']))
+    client.connect = connect
+    client.connection_lost(dropped)
+    loop.run_until_complete(client.subscribe(['service1/1.0.0/deleted'], mock.Mock()))
+    for _ in range(10):
+        loop.run_until_complete(asyncio.sleep(0))
+
+    assert not attempts and dropped.send.call_count == 1
+    packet = client._protocol.send.call_args[0][0]
+    assert packet['channels'] == ['service1/1.0.0/created', 'service1/1.0.0/deleted']
+    assert packet['patterns'] == ['service2/*/created']
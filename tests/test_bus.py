@@ -0,0 +1,218 @@
+import asyncio
+from unittest import mock
+
+from vyked.bus import PublishConnections, PubSubBus, TCPBus
+from vyked.decorators.tcp import subscribe, xsubscribe
+from vyked.packet import MessagePacket
+from vyked.services import TCPServiceClient
+
+
+class FakeProtocol:
+    def __init__(self):
+        self.sent = []
+        self.connected = True
+
+    def send(self, packet):
+        self.sent.append(packet)
+
+    def is_connected(self):
+        return self.connected
+
+    def close(self):
+        self.connected = False
+
+
+class Listener(TCPServiceClient):
+    def __init__(self, version):
+        super(Listener, self).__init__('service1', version)
+        self.received = []
+
+    @subscribe
+    def created(self, id):
+        self.received.append(('created', id))
+
+    @xsubscribe
+    def deleted(self, payload):
+        self.received.append(('deleted', payload['id']))
+
+    @xsubscribe(ack_after_handler=True)
+    def updated(self, payload):
+        self.received.append(('updated', payload['id']))
+        if payload.get('fail'):
+            raise ValueError(payload['id'])
+
+
+def test_publications_are_routed_to_exact_and_wildcard_subscriptions():
+    loop = asyncio.get_event_loop()
+    subscriptions = {}
+
+    @asyncio.coroutine
+    def subscribe_channels(channels, handler, patterns=()):
+        subscriptions.update(channels=channels, patterns=patterns)
+
+    exact, wildcard = Listener('1.0.0'), Listener('*')
+    bus = PubSubBus(mock.Mock())
+    bus._pubsub_handler = mock.Mock(subscribe=subscribe_channels)
+    loop.run_until_complete(bus.register_for_subscription([exact, wildcard]))
+
+    bus.subscription_handler('service1/1.0.0/created', '{"id": 1}')
+    bus.subscription_handler('service1/2.0.0/created', '{"id": 2}')
+    bus.subscription_handler('service2/1.0.0/created', '{"id": 3}')
+    loop.run_until_complete(asyncio.sleep(0))
+
+    assert subscriptions == {'channels': ['service1/1.0.0/created'], 'patterns': ['service1/*/created']}
+    assert exact.received == [('created', 1)]
+    assert wildcard.received == [('created', 1), ('created', 2)]
+    assert [event[:3] for event in bus._registry_client.x_subscribe.call_args[0][0]] == [
+        ('service1', '1.0.0', 'deleted'), ('service1', '1.0.0', 'updated'),
+        ('service1', '*', 'deleted'), ('service1', '*', 'updated')]
+
+
+def test_xpublished_event_goes_to_the_handler_of_its_endpoint():
+    listener = Listener('1.0.0')
+    bus = TCPBus(mock.Mock())
+    bus.register('192.168.1.2', 4002, 'service2', '1.0.0', [listener], 'tcp')
+    protocol = FakeProtocol()
+
+    bus._handle_publish(MessagePacket.publish('p1', 'service1', '1.0.0', 'deleted', {'id': 1}), protocol)
+    bus._handle_publish(MessagePacket.publish('p2', 'service1', '2.0.0', 'deleted', {'id': 2}), protocol)
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0))
+
+    assert listener.received == [('deleted', 1)]
+    assert [packet['request_id'] for packet in protocol.sent] == ['p1', 'p2']
+
+
+def test_retried_xpublish_is_handled_once():
+    listener = Listener('1.0.0')
+    bus = TCPBus(mock.Mock())
+    bus.register('192.168.1.2', 4002, 'service2', '1.0.0', [listener], 'tcp')
+    protocol = FakeProtocol()
+
+    for _ in range(2):
+        bus._handle_publish(MessagePacket.publish('p1', 'service1', '1.0.0', 'deleted', {'id': 1}), protocol)
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0))
+
+    assert listener.received == [('deleted', 1)]
+    assert [packet['request_id'] for packet in protocol.sent] == ['p1', 'p1']
+
+
+def test_ack_after_handler_waits_for_the_handler_and_skips_failures():
+    loop = asyncio.get_event_loop()
+    listener = Listener('1.0.0')
+    bus = TCPBus(mock.Mock())
+    bus.register('192.168.1.2', 4002, 'service2', '1.0.0', [listener], 'tcp')
+    protocol = FakeProtocol()
+
+    bus._handle_publish(MessagePacket.publish('p1', 'service1', '1.0.0', 'updated', {'id': 1}), protocol)
+    bus._handle_publish(MessagePacket.publish('p1', 'service1', '1.0.0', 'updated', {'id': 1}), protocol)
+    assert protocol.sent == []
+    bus._handle_publish(MessagePacket.publish('p2', 'service1', '1.0.0', 'updated', {'id': 2, 'fail': True}),
+                        protocol)
+    for _ in range(3):
+        loop.run_until_complete(asyncio.sleep(0))
+    assert [packet['request_id'] for packet in protocol.sent] == ['p1']
+
+    bus._handle_publish(MessagePacket.publish('p2', 'service1', '1.0.0', 'updated', {'id': 2}), protocol)
+    for _ in range(3):
+        loop.run_until_complete(asyncio.sleep(0))
+    assert listener.received == [('updated', 1), ('updated', 2), ('updated', 2)]
+    assert [packet['request_id'] for packet in protocol.sent] == ['p1', 'p2']
+
+
+def test_xpublish_reuses_persistent_connections(monkeypatch):
+    loop = asyncio.get_event_loop()
+    protocols = []
+
+    @asyncio.coroutine
+    def create_connection(factory, host, port):
+        protocols.append(FakeProtocol())
+        return mock.Mock(), protocols[-1]
+
+    monkeypatch.setattr(loop, 'create_connection', create_connection)
+    bus = PubSubBus(mock.Mock())
+    strategies = {('service2', '1.0.0'): [('192.168.1.3', 4003, 'n2', 'RANDOM')]}
+    for publish_id in ('p1', 'p2', 'p3'):
+        bus._outbox._events[publish_id] = {'id': publish_id}
+        loop.run_until_complete(bus._connect_and_publish(publish_id, 'service1', '1.0.0', 'created', strategies, {}))
+    loop.run_until_complete(asyncio.sleep(0))
+
+    assert len(protocols) == 2
+    assert [packet['publish_id'] for protocol in protocols for packet in protocol.sent] == ['p1', 'p2', 'p3']
+
+    bus.receive(MessagePacket.ack('p2'), mock.Mock(), protocols[0])
+    bus.receive(MessagePacket.ack('p2'), mock.Mock(), protocols[0])
+    assert 'p2' not in bus._outbox and 'p1' in bus._outbox
+    assert all(protocol.connected for protocol in protocols)
+
+    protocols[0].connected = False
+    loop.run_until_complete(bus._connect_and_publish('p4', 'service1', '1.0.0', 'created', strategies, {}))
+    loop.run_until_complete(asyncio.sleep(0))
+    assert len(protocols) == 3
+    assert len(bus._publish_connections) == 2
+    bus._publish_connections.close()
+
+
+def test_unreachable_local_socket_falls_back_to_tcp(monkeypatch):
+    loop = asyncio.get_event_loop()
+    protocol = FakeProtocol()
+
+    @asyncio.coroutine
+    def create_unix_connection(factory, path):
+        raise FileNotFoundError(path)
+
+    @asyncio.coroutine
+    def create_connection(factory, host, port):
+        assert (host, port) == ('192.168.1.3', 4003)
+        return mock.Mock(), protocol
+
+    monkeypatch.setattr(loop, 'create_unix_connection', create_unix_connection)
+    monkeypatch.setattr(loop, 'create_connection', create_connection)
+    registry_client = mock.Mock()
+    registry_client.get_shm_socket.return_value = None
+    registry_client.get_unix_socket.return_value = '/run/vyked/service2.sock'
+    bus = TCPBus(registry_client)
+
+    _, connected = loop.run_until_complete(bus._open_connection('192.168.1.3', 'n2', 4003, mock.Mock()))
+    assert connected is protocol
+
+
+def test_concurrent_publishes_to_a_cold_node_share_the_connection_cap(monkeypatch):
+    loop = asyncio.get_event_loop()
+    protocols = []
+
+    @asyncio.coroutine
+    def create_connection(factory, host, port):
+        yield from asyncio.sleep(0)
+        protocols.append(FakeProtocol())
+        return mock.Mock(), protocols[-1]
+
+    monkeypatch.setattr(loop, 'create_connection', create_connection)
+    connections = PublishConnections(mock.Mock(), connections_per_node=2)
+
+    loop.run_until_complete(asyncio.gather(*[connections.send('192.168.1.3', 4003, {'publish_id': str(i)})
+                                             for i in range(10)]))
+
+    assert len(protocols) == 2
+    assert sum(len(protocol.sent) for protocol in protocols) == 10
+    connections.close()
+
+
+def test_leader_publish_goes_to_the_next_subscriber_when_the_leader_is_unreachable(monkeypatch):
+    loop = asyncio.get_event_loop()
+    protocol = FakeProtocol()
+
+    @asyncio.coroutine
+    def create_connection(factory, host, port):
+        if port == 4004:
+            raise ConnectionRefusedError()
+        return mock.Mock(), protocol
+
+    monkeypatch.setattr(loop, 'create_connection', create_connection)
+    bus = PubSubBus(mock.Mock())
+    strategies = {('service2', '1.0.0'): [('192.168.1.3', 4003, 'n2', 'LEADER', False),
+                                          ('192.168.1.4', 4004, 'n3', 'LEADER', True)]}
+
+    loop.run_until_complete(bus._connect_and_publish('p1', 'service1', '1.0.0', 'created', strategies, {}))
+
+    assert [packet['publish_id'] for packet in protocol.sent] == ['p1']
+    bus._publish_connections.close()
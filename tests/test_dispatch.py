@@ -0,0 +1,75 @@
+import asyncio
+
+from vyked.dispatch import DedupWindow, HandlerQueue
+
+
+class Handler:
+    def __init__(self):
+        self.started = []
+        self.releases = {}
+
+    @asyncio.coroutine
+    def __call__(self, id, user=None):
+        self.started.append(id)
+        self.releases[id] = asyncio.Future()
+        yield from self.releases[id]
+
+    def release(self, id):
+        self.releases[id].set_result(None)
+
+
+def _tick():
+    loop = asyncio.get_event_loop()
+    for _ in range(3):
+        loop.run_until_complete(asyncio.sleep(0))
+
+
+def test_publications_past_the_concurrency_limit_are_buffered_then_dropped():
+    handler = Handler()
+    queue = HandlerQueue(handler, concurrency=2, max_backlog=2)
+
+    accepted = [queue.submit({'id': id}) for id in range(5)]
+    _tick()
+
+    assert accepted == [True, True, True, True, False]
+    assert handler.started == [0, 1]
+    assert (len(queue), queue.running, queue.dropped) == (2, 2, 1)
+
+    handler.release(0)
+    _tick()
+    assert handler.started == [0, 1, 2]
+    assert len(queue) == 1
+
+
+def test_publications_sharing_a_key_are_handled_in_order():
+    handler = Handler()
+    queue = HandlerQueue(handler, concurrency=4, key='user')
+
+    for id, user in enumerate(['a', 'a', 'b', 'a']):
+        queue.submit({'id': id, 'user': user})
+    _tick()
+    assert handler.started == [0, 2]
+
+    handler.release(0)
+    _tick()
+    assert handler.started == [0, 2, 1]
+
+    handler.release(1)
+    handler.release(2)
+    _tick()
+    assert handler.started == [0, 2, 1, 3]
+    assert len(queue) == 0
+
+
+def test_dedup_window_forgets_ids_once_they_expire_or_overflow():
+    now = [0]
+    window = DedupWindow(window=10, max_size=2, clock=lambda: now[0])
+
+    assert window.add('p1') and window.add('p2')
+    assert not window.add('p1')
+    assert window.add('p3')
+    assert 'p1' not in window and len(window) == 2
+
+    now[0] = 10
+    assert window.add('p2')
+    assert 'p3' not in window and len(window) == 1
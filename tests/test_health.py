@@ -0,0 +1,44 @@
+import asyncio
+from unittest import mock
+
+from vyked.health import HTTPHealthChecker
+
+
+class FakeResponse:
+    def __init__(self, status):
+        self.status = status
+        self.released = False
+
+    @asyncio.coroutine
+    def release(self):
+        self.released = True
+
+
+class FakeSession:
+    def __init__(self, statuses):
+        self._statuses = list(statuses)
+        self.responses = []
+
+    @asyncio.coroutine
+    def get(self, url):
+        response = FakeResponse(self._statuses.pop(0))
+        self.responses.append(response)
+        return response
+
+
+def test_node_is_evicted_after_consecutive_failures():
+    session = FakeSession([500, 200, 500, 503, 500])
+    checker = HTTPHealthChecker(failure_threshold=3, session=session)
+    on_unhealthy = mock.Mock()
+    checker.add('n1', '192.168.1.2', 4002, on_unhealthy)
+    checker._schedule = mock.Mock()
+    loop = asyncio.get_event_loop()
+
+    for _ in range(4):
+        loop.run_until_complete(checker._check('n1'))
+    assert not on_unhealthy.called
+
+    loop.run_until_complete(checker._check('n1'))
+    on_unhealthy.assert_called_once_with('n1')
+    assert all(response.released for response in session.responses)
+    checker.close()
@@ -0,0 +1,47 @@
+from unittest import mock
+
+from vyked.lease import LeaseTable
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+def test_renewed_lease_outlives_its_first_expiry():
+    clock = Clock()
+    leases = LeaseTable(clock)
+    leases.grant('n1', 10)
+    leases.grant('n2', 10)
+
+    clock.now = 8
+    leases.renew('n1')
+    clock.now = 12
+
+    assert leases.expired() == ['n2']
+    assert 'n1' in leases
+    clock.now = 18
+    assert leases.expired() == ['n1']
+    assert len(leases) == 0
+
+
+def test_registry_deregisters_node_without_keepalives(service1, registry):
+    clock = Clock()
+    registry._leases = LeaseTable(clock)
+    registry._connect_to_service = mock.Mock()
+    registry.register_service(packet={'params': dict(service1, lease=10)}, registry_protocol=mock.Mock(),
+                              host='192.168.1.1', port=2001)
+    assert not registry._connect_to_service.called
+
+    clock.now = 8
+    registry.receive({'type': 'keepalive', 'node_ids': [service1['node_id']]}, mock.Mock(), mock.Mock())
+    clock.now = 12
+    registry._expire_leases()
+    assert registry._repository.get_node(service1['node_id']) is not None
+
+    clock.now = 19
+    registry._expire_leases()
+    assert registry._repository.get_node(service1['node_id']) is None
@@ -0,0 +1,92 @@
+import asyncio
+import json
+
+from vyked.outbox import COMPACT_AFTER, Outbox
+
+
+class Deliveries:
+    def __init__(self, result=True):
+        self.result = result
+        self.events = []
+
+    @asyncio.coroutine
+    def __call__(self, event):
+        self.events.append(event['id'])
+        return self.result
+
+
+def test_unacked_events_are_delivered_again_after_a_restart(tmpdir):
+    path = str(tmpdir.join('service.outbox'))
+    deliveries = Deliveries()
+    outbox = Outbox(deliveries, path=path)
+    for event_id in ('e1', 'e2', 'e3'):
+        outbox.add({'id': event_id, 'service': 'service1', 'version': '1.0.0', 'endpoint': 'created',
+                    'payload': {'n': event_id}})
+    outbox.ack('e2')
+    outbox.close()
+
+    restarted = Outbox(deliveries, path=path)
+    assert restarted.load() == 2
+    assert sorted(restarted._events) == ['e1', 'e3']
+    assert restarted._events['e3']['payload'] == {'n': 'e3'}
+    with open(path) as f:
+        assert len(f.readlines()) == 2  # compacted on load
+    restarted.close()
+
+
+def test_event_goes_to_the_dead_letter_file_after_max_attempts(tmpdir):
+    path = str(tmpdir.join('service.outbox'))
+    deliveries = Deliveries()
+    outbox = Outbox(deliveries, path=path, max_attempts=3, base_delay=0, max_delay=0)
+    outbox.add({'id': 'e1', 'payload': {}})
+    outbox.add({'id': 'e2', 'payload': {}})
+    outbox.ack('e2')
+
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.1))
+
+    assert deliveries.events == ['e1', 'e1', 'e1']
+    assert len(outbox) == 0
+    with open(path + '.dead') as f:
+        dead = [json.loads(line) for line in f]
+    assert [(letter['id'], letter['attempts']) for letter in dead] == [('e1', 3)]
+    outbox.close()
+
+
+def test_event_nobody_subscribes_to_is_dropped():
+    deliveries = Deliveries(result=False)
+    outbox = Outbox(deliveries)
+    outbox.add({'id': 'e1', 'payload': {}})
+
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.01))
+
+    assert deliveries.events == ['e1']
+    assert 'e1' not in outbox
+    outbox.close()
+
+
+def test_attempt_that_never_returns_is_retried():
+    attempts = []
+
+    @asyncio.coroutine
+    def deliver(event):
+        attempts.append(event['id'])
+        yield from asyncio.Future()  # a subscriber request lost with the registry connection
+
+    outbox = Outbox(deliver, max_attempts=2, base_delay=0, max_delay=0, attempt_timeout=0.01)
+    outbox.add({'id': 'e1', 'payload': {}})
+
+    asyncio.get_event_loop().run_until_complete(asyncio.sleep(0.1))
+
+    assert attempts == ['e1', 'e1']
+    assert 'e1' not in outbox
+    outbox.close()
+
+
+def test_outbox_without_a_file_keeps_acking_past_compaction():
+    outbox = Outbox(Deliveries())
+    for index in range(COMPACT_AFTER + 10):
+        outbox.add({'id': str(index), 'payload': {}})
+        outbox.ack(str(index))
+
+    assert len(outbox) == 0
+    outbox.close()
@@ -0,0 +1,143 @@
+import asyncio
+from unittest import mock
+
+from vyked.pubsub import PubSub, channel_shard
+
+
+class FakeTransaction:
+    def __init__(self, connection):
+        self._connection = connection
+        self._published = []
+
+    @asyncio.coroutine
+    def publish(self, channel, message):
+        self._published.append((channel, message))
+        self._connection.in_flight += 1
+        self._connection.max_in_flight = max(self._connection.max_in_flight, self._connection.in_flight)
+        yield from asyncio.sleep(0)  # the round trip of the QUEUED reply
+        self._connection.in_flight -= 1
+        result = asyncio.Future()
+        result.set_result(1)
+        return result
+
+    @asyncio.coroutine
+    def exec(self):
+        self._connection.batches.append(self._published)
+
+
+class FakeConnection:
+    def __init__(self):
+        self.batches = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    @asyncio.coroutine
+    def multi(self):
+        return FakeTransaction(self)
+
+
+def _publish_in_order(pubsub, publishes):
+    """
+    Starts the publishes in the order given, gather doesn't keep the order of its arguments on every python
+    """
+    futures = [asyncio.async(pubsub.publish(channel, payload)) for channel, payload in publishes]
+    return asyncio.get_event_loop().run_until_complete(asyncio.gather(*futures))
+
+
+def test_publishes_of_a_tick_go_out_as_one_pipelined_batch():
+    pubsub = PubSub('127.0.0.1', 6379, connections=1)
+    pubsub._conns = [FakeConnection()]
+    publishes = [('service1/1.0.0/created', str(i)) for i in range(3)]
+
+    results = _publish_in_order(pubsub, publishes)
+
+    assert results == [True, True, True]
+    assert pubsub._conns[0].batches == [publishes]
+    assert pubsub._conns[0].max_in_flight == 3
+
+
+def test_publish_waits_for_room_in_a_full_buffer():
+    loop = asyncio.get_event_loop()
+    pubsub = PubSub('127.0.0.1', 6379, max_pending=2, connections=1)
+    pubsub._conns = [FakeConnection()]
+
+    results = loop.run_until_complete(asyncio.gather(*[pubsub.publish('service1/1.0.0/created', str(i))
+                                                       for i in range(5)]))
+    assert results == [True] * 5
+    assert [len(batch) for batch in pubsub._conns[0].batches] == [2, 2, 1]
+
+
+def test_unexpected_error_fails_the_batch_and_later_publishes_still_go_out():
+    loop = asyncio.get_event_loop()
+    pubsub = PubSub('127.0.0.1', 6379, connections=1)
+    pubsub._conns = [FakeConnection()]
+    multi = pubsub._conns[0].multi
+    pubsub._conns[0].multi = mock.Mock(side_effect=RuntimeError('broken'))
+
+    assert loop.run_until_complete(pubsub.publish('service1/1.0.0/created', '0')) is False
+
+    pubsub._conns[0].multi = multi
+    assert loop.run_until_complete(pubsub.publish('service1/1.0.0/created', '1')) is True
+
+
+def test_publish_without_a_connection_fails():
+    pubsub = PubSub('127.0.0.1', 6379)
+    assert asyncio.get_event_loop().run_until_complete(pubsub.publish('service1/1.0.0/created', '0')) is False
+
+
+def test_channels_are_spread_over_the_publish_connections():
+    pubsub = PubSub('127.0.0.1', 6379, connections=2)
+    pubsub._conns = [FakeConnection(), FakeConnection()]
+    channels = ['service1/1.0.0/created', 'service1/1.0.0/deleted', 'service1/1.0.0/updated', 'service2/1.0.0/created']
+
+    _publish_in_order(pubsub, [(channel, '{}') for channel in channels])
+
+    for index, conn in enumerate(pubsub._conns):
+        assert [channel for batch in conn.batches for channel, _ in batch] == [
+            channel for channel in channels if channel_shard(channel, 2) == index]
+
+
+class FakeSubscriber:
+    def __init__(self):
+        self.channels = []
+        self.published = asyncio.Queue()
+
+    @asyncio.coroutine
+    def subscribe(self, channels):
+        self.channels.extend(channels)
+
+    @asyncio.coroutine
+    def psubscribe(self, patterns):
+        self.channels.extend(patterns)
+
+    @asyncio.coroutine
+    def next_published(self):
+        return (yield from self.published.get())
+
+
+def test_subscriptions_are_sharded_over_connections_with_a_queue_each(monkeypatch):
+    loop = asyncio.get_event_loop()
+    subscribers = []
+
+    @asyncio.coroutine
+    def get_conn():
+        subscribers.append(FakeSubscriber())
+        return mock.Mock(start_subscribe=asyncio.coroutine(lambda subscriber=subscribers[-1]: subscriber))
+
+    pubsub = PubSub('127.0.0.1', 6379, shards=2)
+    monkeypatch.setattr(pubsub, '_get_conn', get_conn)
+    received = []
+    channels = ['service1/1.0.0/created', 'service1/1.0.0/deleted', 'service1/1.0.0/updated']
+    subscription = asyncio.async(pubsub.subscribe(channels, lambda channel, value: received.append(channel),
+                                                  patterns=['service2/*/created']))
+    loop.run_until_complete(asyncio.sleep(0.01))
+    for subscriber in subscribers:
+        for channel in subscriber.channels:
+            subscriber.published.put_nowait(mock.Mock(channel=channel.replace('*', '1.0.0'), value='{}'))
+    loop.run_until_complete(asyncio.sleep(0.01))
+    subscription.cancel()
+
+    assert len(subscribers) == 2
+    assert sorted(channel for subscriber in subscribers for channel in subscriber.channels) == sorted(
+        channels + ['service2/*/created'])
+    assert sorted(received) == sorted(channels + ['service2/1.0.0/created'])
@@ -1,5 +1,9 @@
 from unittest import mock
 
+from vyked.lease import LeaseTable, LEADER_LEASE
+from vyked.packet import ControlPacket
+from vyked.registry import Registry, Repository
+
 
 def test_register_independent_service(service1, registry):
 
@@ -33,3 +37,241 @@ def test_deregister_dependent_service(service1, service2, registry):
 
     registry.deregister_service(service1['node_id'])
     assert registry._repository.get_pending_services() != []
+
+
+def test_activation_advertises_unix_socket(service1, service2, registry):
+    service1.update({'unix_socket': '/tmp/vyked_service1_4002.sock', 'host_id': 'host1'})
+    registry.register_service(packet={'params': service1}, registry_protocol=mock.Mock(),
+                              host='192.168.1.1', port=2001)
+    registry.register_service(packet={'params': service2}, registry_protocol=mock.Mock(),
+                              host='192.168.1.1', port=2001)
+
+    address = registry._make_activated_packet(service2['service'], service2['version'])['params']['vendors'][0][
+        'addresses'][0]
+    assert address['unix_socket'] == service1['unix_socket']
+    assert address['host_id'] == 'host1'
+
+
+def test_remove_node_keeps_other_instances(service1, registry):
+    repository = registry._repository
+    registry.register_service(packet={'params': service1}, registry_protocol=mock.Mock(),
+                              host='192.168.1.1', port=2001)
+    service1_copy = dict(service1, node_id='n3', port=4004)
+    registry.register_service(packet={'params': service1_copy}, registry_protocol=mock.Mock(),
+                              host='192.168.1.1', port=2001)
+
+    repository.remove_node(service1['node_id'])
+
+    assert repository.get_node(service1['node_id']) is None
+    assert repository.get_node('n3').port == 4004
+    assert [instance[2] for instance in repository.get_instances('service1', '1.0.0')] == ['n3']
+
+
+def test_get_consumers(service1, service2, registry):
+    registry.register_service(packet={'params': service2}, registry_protocol=mock.Mock(),
+                              host='192.168.1.1', port=2001)
+
+    assert registry._repository.get_consumers('service1', '1.0.0') == {('service2', '1.0.0')}
+    assert registry._repository.get_consumers('service2', '1.0.0') == set()
+
+
+def test_activation_is_sent_once_per_tick(service1, service2, registry):
+    protocol = mock.Mock()
+    registry.register_service(packet={'params': service2}, registry_protocol=protocol,
+                              host='192.168.1.1', port=2001)
+    registry.register_service(packet={'params': service1}, registry_protocol=mock.Mock(),
+                              host='192.168.1.1', port=2001)
+    assert not protocol.send.called
+
+    registry._send_activated_packets()
+
+    assert protocol.send.call_count == 1
+    assert protocol.send.call_args[0][0]['type'] == 'registered'
+
+
+def test_vendor_only_activates_its_dependants(service1, service2, registry):
+    service3 = dict(service2, service='service3', node_id='n3',
+                    vendors=[{'service': 'service2', 'version': '1.0.0'}])
+    registry.register_service(packet={'params': service3}, registry_protocol=mock.Mock(),
+                              host='192.168.1.1', port=2001)
+    registry.register_service(packet={'params': service2}, registry_protocol=mock.Mock(),
+                              host='192.168.1.1', port=2001)
+    assert registry._repository.get_unsatisfied_vendors('service3', '1.0.0') == set()
+    assert registry._repository.get_pending_services() == [('service2', '1.0.0')]
+
+    registry.register_service(packet={'params': service1}, registry_protocol=mock.Mock(),
+                              host='192.168.1.1', port=2001)
+    assert registry._repository.get_pending_services() == []
+
+
+def test_new_vendor_instance_is_pushed_to_active_consumers(service1, service2, registry):
+    protocol = mock.Mock()
+    registry.register_service(packet={'params': service1}, registry_protocol=mock.Mock(),
+                              host='192.168.1.1', port=2001)
+    registry.register_service(packet={'params': service2}, registry_protocol=protocol,
+                              host='192.168.1.1', port=2001)
+    registry._send_updates()
+    service1_copy = dict(service1, node_id='n3', port=4004)
+    registry.register_service(packet={'params': service1_copy}, registry_protocol=mock.Mock(),
+                              host='192.168.1.1', port=2001)
+    registry.deregister_service(service1['node_id'])
+
+    registry._send_updates()
+
+    packet = protocol.send.call_args[0][0]
+    assert packet['type'] == 'topology'
+    assert packet['params']['topology_version'] == 1
+    assert [(change['op'], change['node']['node_id']) for change in packet['params']['changes']] == [
+        ('added', 'n3'), ('removed', 'n1')]
+
+
+def test_keepalive_load_is_pushed_when_it_moves(service1, service2, registry):
+    protocol = mock.Mock()
+    registry.register_service(packet={'params': dict(service1, lease=10)}, registry_protocol=mock.Mock(),
+                              host='192.168.1.1', port=2001)
+    registry.register_service(packet={'params': service2}, registry_protocol=protocol,
+                              host='192.168.1.1', port=2001)
+    registry._send_updates()
+
+    def keepalive(in_flight):
+        registry.receive({'type': 'keepalive', 'node_ids': [service1['node_id']],
+                          'loads': {service1['node_id']: {'in_flight': in_flight, 'queue': 0, 'lag': 0}}},
+                         mock.Mock(), mock.Mock())
+        registry._send_updates()
+
+    keepalive(10)
+    keepalive(11)
+    keepalive(20)
+
+    loads = [call[0][0]['params']['changes'][0]['node']['load']['in_flight'] for call in
+             protocol.send.call_args_list if call[0][0]['type'] == 'topology']
+    assert loads == [10, 20]
+
+
+def test_subscriber_changes_are_pushed_to_watchers(service1, service2, registry):
+    watcher = mock.Mock()
+    registry.receive({'type': 'get_subscribers', 'request_id': 'r1', 'params': {
+        'service': 'service1', 'version': '1.0.0', 'endpoint': 'created', 'watch': True}}, watcher, mock.Mock())
+    registry.register_service(packet={'params': service2}, registry_protocol=mock.Mock(),
+                              host='192.168.1.1', port=2001)
+    registry.receive({'type': 'xsubscribe', 'params': {
+        'service': 'service2', 'version': '1.0.0', 'host': '192.168.1.3', 'port': 4003, 'node_id': 'n2',
+        'events': [{'service': 'service1', 'version': '1.0.0', 'endpoint': 'created', 'strategy': 'RANDOM'}]}},
+        mock.Mock(), mock.Mock())
+    registry._send_updates()
+    registry.deregister_service('n2')
+    registry._send_updates()
+
+    pushes = [call[0][0]['params']['subscribers'] for call in watcher.send.call_args_list
+              if call[0][0]['type'] == 'subscribers_changed']
+    assert [[subscriber['node_id'] for subscriber in subscribers] for subscribers in pushes] == [['n2'], []]
+
+
+def test_consumer_registered_first_resolves_to_a_compatible_vendor(service1, service2, registry):
+    service2['vendors'] = [{'service': 'service1', 'version': '~1.0'}]
+    registry.register_service(packet={'params': service2}, registry_protocol=mock.Mock(),
+                              host='192.168.1.1', port=2001)
+    assert registry._repository.get_pending_services() == [('service2', '1.0.0')]
+
+    registry.register_service(packet={'params': dict(service1, version='1.0.4')}, registry_protocol=mock.Mock(),
+                              host='192.168.1.1', port=2001)
+
+    assert registry._repository.get_pending_services() == []
+    assert registry._repository.resolve_version('service1', '~1.0') == '1.0.4'
+
+
+def test_node_reattached_to_a_restored_registry_is_realigned(service1, service2, registry):
+    registry.register_service(packet={'params': service1}, registry_protocol=mock.Mock(),
+                              host='192.168.1.1', port=2001)
+    registry.register_service(packet={'params': service2}, registry_protocol=mock.Mock(),
+                              host='192.168.1.1', port=2001)
+    restored = Registry(ip='192.168.1.1', port=4001, repository=Repository())
+    restored._load(registry._repository.dump())
+
+    protocol = mock.Mock()
+    restored.register_service(packet={'params': service2}, registry_protocol=protocol, host='192.168.1.1', port=2001)
+
+    packet = protocol.send.call_args[0][0]
+    assert packet['type'] == 'topology_snapshot'
+    assert packet['params']['topology_version'] == 0
+    assert [address['node_id'] for address in packet['params']['vendors'][0]['addresses']] == ['n1']
+
+
+def _xsubscribe(registry, node_id, port, service='service2', strategy='LEADER'):
+    registry.receive({'type': 'xsubscribe', 'params': {
+        'service': service, 'version': '1.0.0', 'host': '192.168.1.3', 'port': port, 'node_id': node_id,
+        'events': [{'service': 'service1', 'version': '1.0.0', 'endpoint': 'created', 'strategy': strategy}]}},
+        mock.Mock(), mock.Mock())
+
+
+def _leaders(protocol):
+    subscribers = protocol.send.call_args[0][0]['params']['subscribers']
+    return [subscriber['node_id'] for subscriber in subscribers if subscriber['leader']]
+
+
+def _watch_subscribers(registry):
+    watcher = mock.Mock()
+    registry.receive({'type': 'get_subscribers', 'request_id': 'r1', 'params': {
+        'service': 'service1', 'version': '1.0.0', 'endpoint': 'created', 'watch': True}}, watcher, mock.Mock())
+    return watcher
+
+
+def test_each_leader_strategy_service_gets_one_leader_pushed_on_change(registry):
+    for node_id, port in (('n2', 4003), ('n3', 4004), ('n4', 4005)):
+        _xsubscribe(registry, node_id, port)
+    _xsubscribe(registry, 'n5', 4006, service='service3')
+    _xsubscribe(registry, 'n6', 4007, service='service4', strategy='RANDOM')
+    watcher = _watch_subscribers(registry)
+
+    leaders = _leaders(watcher)
+    assert len(leaders) == 2 and 'n5' in leaders and 'n6' not in leaders
+    leader = [node_id for node_id in leaders if node_id != 'n5'][0]
+
+    registry.deregister_service(leader)
+    registry._send_updates()
+
+    assert watcher.send.call_args[0][0]['type'] == 'subscribers_changed'
+    new_leaders = _leaders(watcher)
+    assert len(new_leaders) == 2 and leader not in new_leaders
+
+
+def test_leadership_moves_once_the_leader_lease_lapses(registry):
+    now = [0]
+    registry._leader_leases = LeaseTable(clock=lambda: now[0])
+    for node_id, port in (('n2', 4003), ('n3', 4004), ('n4', 4005)):
+        _xsubscribe(registry, node_id, port)
+    watcher = _watch_subscribers(registry)
+    leader = _leaders(watcher)[0]
+    followers = [node_id for node_id in ('n2', 'n3', 'n4') if node_id != leader]
+
+    now[0] = LEADER_LEASE / 2
+    registry.receive(ControlPacket.leader_keepalive(followers), mock.Mock(), mock.Mock())
+    registry.receive(ControlPacket.leader_keepalive([leader]), mock.Mock(), mock.Mock())
+    now[0] = LEADER_LEASE
+    registry._expire_leader_leases()
+    assert registry._leaders('service1', '1.0.0', 'created') == {leader}
+
+    now[0] = LEADER_LEASE * 1.4
+    registry.receive(ControlPacket.leader_keepalive(followers), mock.Mock(), mock.Mock())
+    now[0] = LEADER_LEASE * 1.6
+    registry._expire_leader_leases()
+    registry._send_updates()
+
+    assert watcher.send.call_args[0][0]['type'] == 'subscribers_changed'
+    new_leader = _leaders(watcher)[0]
+    assert new_leader in followers
+    assert registry._repository.get_leaders('service1', '1.0.0', 'created') == {('service2', '1.0.0'): new_leader}
+
+
+def test_leaders_rotate_every_term(registry):
+    registry._leader_term = 10
+    for index in range(8):
+        _xsubscribe(registry, 'n{}'.format(index), 4003 + index)
+
+    leaders = set()
+    for term in range(8):
+        registry._rotate_leaders()
+        assert len(registry._leaders('service1', '1.0.0', 'created')) == 1
+        leaders.update(registry._leaders('service1', '1.0.0', 'created'))
+
+    assert len(leaders) > 1
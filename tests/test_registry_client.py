@@ -0,0 +1,178 @@
+import asyncio
+from unittest import mock
+
+from vyked.registry_client import RegistryClient
+
+
+def _client():
+    client = RegistryClient(mock.Mock(), '192.168.1.1', 4001)
+    client._protocol = mock.Mock()
+    client._node_id = 'n2'
+    client.bus = mock.Mock()
+    client.cache_vendors([{'name': 'service1', 'version': '1.0.0', 'addresses': [
+        {'host': '192.168.1.2', 'port': 4002, 'node_id': 'n1', 'type': 'tcp'}]}])
+    return client
+
+
+def _topology(topology_version, *changes):
+    return {'type': 'topology', 'params': {'topology_version': topology_version, 'changes': list(changes)}}
+
+
+def _change(op, node_id, **node):
+    node.update({'host': '192.168.1.4', 'port': 4004, 'node_id': node_id, 'type': 'tcp'})
+    return {'op': op, 'service': 'service1', 'version': '1.0.0', 'node': node}
+
+
+def test_client_applies_topology_deltas_in_order():
+    client = _client()
+
+    client.receive(_topology(1, _change('added', 'n3')), client._protocol, None)
+    client.receive(_topology(2, _change('removed', 'n1'), _change('weight', 'n3', weight=5)), client._protocol, None)
+    client.receive(_topology(2, _change('added', 'n1')), client._protocol, None)
+
+    assert [node[2] for node in client._available_services['service1/1.0.0']] == ['n3']
+    assert client._weights['n3'] == 5
+    client.bus.vendor_node_added.assert_called_once_with('service1', '1.0.0', '192.168.1.4', 4004, 'n3', 'tcp')
+    client.bus.vendor_node_removed.assert_called_once_with('n1')
+
+
+def test_client_resyncs_on_a_version_gap():
+    client = _client()
+
+    client.receive(_topology(2, _change('added', 'n3')), client._protocol, None)
+    client.receive(_topology(3, _change('removed', 'n1')), client._protocol, None)
+
+    assert client._protocol.send.call_count == 1
+    assert client._protocol.send.call_args[0][0]['type'] == 'resync'
+    client.receive({'type': 'topology_snapshot', 'params': {'topology_version': 3, 'vendors': [
+        {'name': 'service1', 'version': '1.0.0', 'addresses': [
+            {'host': '192.168.1.4', 'port': 4004, 'node_id': 'n3', 'type': 'tcp'}]}]}}, client._protocol, None)
+    assert [node[2] for node in client._available_services['service1/1.0.0']] == ['n3']
+    assert client._topology_version == 3
+
+
+def test_client_starts_from_persisted_topology(tmpdir):
+    topology_file = str(tmpdir.join('topology.json'))
+    client = _client()
+    client._topology_file = topology_file
+    client._weights['n1'] = 3
+    client._save_topology()
+
+    restarted = RegistryClient(mock.Mock(), '192.168.1.1', 4001, topology_file=topology_file)
+    restarted.bus = mock.Mock()
+    assert restarted.load_topology()
+    restarted.register('192.168.1.3', 4003, 'service2', '1.0.0', [], 'tcp')
+
+    assert restarted.get_all_addresses(('service1', '1.0.0')) == [('192.168.1.2', 4002, 'n1', 'tcp')]
+    assert restarted._weights['n1'] == 3
+    assert restarted.bus.registration_complete.called
+    restarted.get_instances('service1', '1.0.0')
+    assert len(restarted._queued_packets) == 1
+
+
+def test_busy_nodes_are_picked_less_often():
+    client = _client()
+    client.receive(_topology(1, _change('added', 'n3'), _change('load', 'n1', load={'in_flight': 99})),
+                   client._protocol, None)
+
+    picks = [client.get_random_service('service1/1.0.0', 'tcp')[2] for _ in range(1000)]
+
+    assert picks.count('n3') > 900
+
+
+def test_subscribers_are_served_from_the_cache():
+    client = _client()
+    future = client.get_subscribers('service1', '1.0.0', 'created')
+    request_id = client._protocol.send.call_args[0][0]['request_id']
+    subscriber = {'service': 'service2', 'version': '1.0.0', 'host': '192.168.1.3', 'port': 4003, 'node_id': 'n2',
+                  'strategy': 'RANDOM'}
+    client.receive({'type': 'subscribers', 'request_id': request_id, 'params': {
+        'service': 'service1', 'version': '1.0.0', 'endpoint': 'created', 'subscribers': [subscriber]}},
+        client._protocol, None)
+    assert future.result() == [subscriber]
+
+    client.receive({'type': 'subscribers_changed', 'params': {
+        'service': 'service1', 'version': '1.0.0', 'endpoint': 'created', 'subscribers': []}}, client._protocol, None)
+
+    assert client.get_subscribers('service1', '1.0.0', 'created').result() == []
+    assert client._protocol.send.call_count == 1
+
+
+def test_bounced_request_goes_to_the_owning_shard():
+    client = _client()
+    shard_protocol = mock.Mock()
+    client._shard_protocols[('10.0.0.2', 4001)] = shard_protocol
+    bounced = {'type': 'get_subscribers', 'request_id': 'r1',
+               'params': {'service': 'service1', 'version': '1.0.0', 'endpoint': 'created', 'watch': True}}
+
+    client.receive({'type': 'wrong_shard', 'shards': [['192.168.1.1', 4001], ['10.0.0.2', 4001]], 'packet': bounced},
+                   client._protocol, None)
+
+    shard_protocol.send.assert_called_once_with(bounced)
+
+
+def test_client_fails_over_to_the_promoted_replica():
+    client = _client()
+    client._replicas = [('10.0.0.2', 4001), ('10.0.0.3', 4001)]
+    client._registration = {'type': 'register', 'params': {'node_id': 'n2'}}
+    client._pinger = mock.Mock()
+    client._transport = mock.Mock()
+    protocols = {('10.0.0.2', 4001): mock.Mock(), ('10.0.0.3', 4001): mock.Mock()}
+
+    @asyncio.coroutine
+    def create_connection(factory, host, port):
+        if (host, port) not in protocols:
+            raise ConnectionRefusedError()
+        return mock.Mock(), protocols[(host, port)]
+
+    client._loop = mock.Mock(create_connection=create_connection)
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(client._failover())
+    assert client._protocol is protocols[('10.0.0.2', 4001)]
+    protocols[('10.0.0.2', 4001)].send.assert_any_call(client._registration)
+
+    client.receive({'type': 'not_primary', 'host': '10.0.0.3', 'port': 4001}, client._protocol, None)
+    loop.run_until_complete(asyncio.sleep(0.01))
+
+    assert client._protocol is protocols[('10.0.0.3', 4001)]
+    protocols[('10.0.0.3', 4001)].send.assert_any_call(client._registration)
+    client._pinger.stop()
+
+
+def test_client_moves_on_to_the_next_replica_when_redirected_to_the_failed_primary(monkeypatch):
+    monkeypatch.setattr('vyked.registry_client.FAILOVER_RETRY_DELAY', 0)
+    client = _client()
+    client._replicas = [('10.0.0.2', 4001), ('10.0.0.3', 4001)]
+    client._pinger = mock.Mock()
+    client._transport = mock.Mock()
+    protocols = {('10.0.0.2', 4001): mock.Mock(), ('10.0.0.3', 4001): mock.Mock()}
+
+    @asyncio.coroutine
+    def create_connection(factory, host, port):
+        if (host, port) not in protocols:
+            raise ConnectionRefusedError()
+        return mock.Mock(), protocols[(host, port)]
+
+    client._loop = mock.Mock(create_connection=create_connection)
+    loop = asyncio.get_event_loop()
+    client.on_timeout('registry')
+    loop.run_until_complete(asyncio.sleep(0.01))
+    assert client._protocol is protocols[('10.0.0.2', 4001)]
+
+    client.receive({'type': 'not_primary', 'host': '192.168.1.1', 'port': 4001}, client._protocol, None)
+    loop.run_until_complete(asyncio.sleep(0.01))
+
+    assert client._protocol is protocols[('10.0.0.3', 4001)]
+    client._pinger.stop()
+
+
+def test_snapshot_from_a_restarted_registry_resets_the_topology_version():
+    client = _client()
+    client._topology_version = 5
+
+    client.receive({'type': 'topology_snapshot', 'params': {'topology_version': 0, 'vendors': [
+        {'name': 'service1', 'version': '1.0.0', 'addresses': [
+            {'host': '192.168.1.2', 'port': 4002, 'node_id': 'n1', 'type': 'tcp'}]}]}}, client._protocol, None)
+    client.receive(_topology(1, _change('added', 'n9')), client._protocol, None)
+
+    assert [address[2] for address in client.get_all_addresses(('service1', '1.0.0'))] == ['n1', 'n9']
@@ -0,0 +1,49 @@
+from unittest import mock
+
+from vyked.registry import Registry, Repository
+from vyked.registry_store import RepositoryStore
+
+
+def _register(registry, params):
+    registry.register_service(packet={'params': params}, registry_protocol=mock.Mock(), host='192.168.1.1',
+                              port=2001)
+
+
+def test_restore_from_snapshot_and_journal(tmpdir, service1, service2):
+    store = RepositoryStore(str(tmpdir))
+    registry = Registry(ip='192.168.1.1', port=4001, repository=Repository(), store=store)
+    _register(registry, service1)
+    store.snapshot(registry._repository.dump())
+    _register(registry, service2)
+    registry._xsubscribe({'params': {'service': 'service2', 'version': '1.0.0', 'host': '192.168.1.3', 'port': 4003,
+                                     'node_id': 'n2', 'events': [{'service': 'service1', 'version': '1.0.0',
+                                                                  'endpoint': 'created', 'strategy': 'RANDOM'}]}})
+    _register(registry, dict(service1, node_id='n3'))
+    registry.deregister_service('n3')
+    store.close()
+
+    repository = Repository()
+    for op, params in RepositoryStore(str(tmpdir)).load():
+        repository.apply(op, params)
+
+    assert sorted(node.node_id for node in repository.get_nodes()) == ['n1', 'n2']
+    assert repository.get_vendors('service2', '1.0.0') == service2['vendors']
+    assert repository.get_subscribers('service1', '1.0.0', 'created') == [
+        ('service2', '1.0.0', '192.168.1.3', 4003, 'n2', 'RANDOM')]
+
+
+def test_restored_leased_node_gets_a_grace_lease(tmpdir, service1):
+    store = RepositoryStore(str(tmpdir))
+    registry = Registry(ip='192.168.1.1', port=4001, repository=Repository(), store=store)
+    _register(registry, dict(service1, lease=10))
+    store.snapshot(registry._repository.dump())
+    store.close()
+
+    restored = Registry(ip='192.168.1.1', port=4001, repository=Repository(), store=RepositoryStore(str(tmpdir)))
+    restored._connect_to_service = mock.Mock()
+    restored._load(restored._store.load())
+    restored._validate_nodes()
+
+    assert restored._repository.get_node(service1['node_id']).lease == 10
+    assert service1['node_id'] in restored._leases
+    assert not restored._connect_to_service.called
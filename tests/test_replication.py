@@ -0,0 +1,232 @@
+import asyncio
+import importlib.util
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+from functools import partial
+from unittest import mock
+
+import pytest
+
+from vyked.packet import ControlPacket
+from vyked.protocol_factory import get_vyked_protocol
+from vyked.registry import Registry, Repository
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _register(registry, params):
+    registry.receive({'type': 'register', 'params': params}, mock.Mock(), mock.Mock(**{
+        'get_extra_info.return_value': ('192.168.1.1', 2001)}))
+
+
+def _replica(primary_protocol):
+    replica = Registry(ip='192.168.1.5', port=4001, repository=Repository(), primary=('192.168.1.1', 4001))
+    replica._primary_protocol = primary_protocol
+    return replica
+
+
+def test_primary_streams_changes_to_replica(service1, service2, registry):
+    primary_protocol = mock.Mock()
+    replica = _replica(primary_protocol)
+    replica_protocol = mock.Mock()
+    replica_protocol.send.side_effect = lambda packet: replica.receive(packet, primary_protocol, mock.Mock())
+
+    _register(registry, service1)
+    registry.receive({'type': 'replicate', 'params': {'host': '192.168.1.5', 'port': 4001}}, replica_protocol,
+                     mock.Mock())
+    _register(registry, service2)
+    registry.deregister_service(service1['node_id'])
+
+    assert [node.node_id for node in replica._repository.get_nodes()] == [service2['node_id']]
+    assert replica._repository.get_pending_services() == [('service2', '1.0.0')]
+
+
+def test_replica_rejects_writes(service1):
+    replica = _replica(mock.Mock())
+    client_protocol = mock.Mock()
+
+    replica.receive({'type': 'register', 'params': service1}, client_protocol, mock.Mock())
+
+    assert replica._repository.get_nodes() == []
+    packet = client_protocol.send.call_args[0][0]
+    assert (packet['type'], packet['host'], packet['port']) == ('not_primary', '192.168.1.1', 4001)
+
+
+def test_first_replica_promotes_itself_when_the_lease_expires():
+    replica = _replica(mock.Mock())
+    replica.receive({'type': 'lease', 'params': {'duration': 3, 'replicas': [['192.168.1.5', 4001],
+                                                                             ['192.168.1.6', 4001]]}},
+                    replica._primary_protocol, mock.Mock())
+    assert not replica.is_primary
+
+    replica._loop.run_until_complete(replica._follow(replica._replicas))
+
+    assert replica.is_primary
+
+
+def _primary_with_replica(registry):
+    replica_protocol = mock.Mock(**{'is_connected.return_value': True})
+    registry.receive({'type': 'replicate', 'params': {'host': '192.168.1.5', 'port': 4001}}, replica_protocol,
+                     mock.Mock())
+    registry._send_leases()
+    return replica_protocol
+
+
+def test_primary_keeps_its_lease_while_the_first_replica_acks(registry):
+    replica_protocol = _primary_with_replica(registry)
+    registry._successor_ack -= registry._lease
+
+    registry.receive({'type': 'lease_ack'}, replica_protocol, mock.Mock())
+    registry._send_leases()
+
+    assert registry.is_primary
+    packet = replica_protocol.send.call_args[0][0]
+    assert packet['type'] == 'lease' and packet['params']['replicas'] == [('192.168.1.5', 4001)]
+
+
+def test_primary_steps_down_when_the_first_replica_stops_acking(registry):
+    replica_protocol = _primary_with_replica(registry)
+    followed = []
+
+    @asyncio.coroutine
+    def follow(candidates):
+        followed.append(candidates)
+
+    registry._follow = follow
+    registry._successor_ack -= registry._lease
+    registry._send_leases()
+    registry._loop.run_until_complete(asyncio.sleep(0))
+
+    assert not registry.is_primary and not registry._primary_timers
+    replica_protocol.close.assert_called_once_with()
+    assert followed == [[('192.168.1.5', 4001)]]
+    client_protocol = mock.Mock()
+    registry.receive({'type': 'register', 'params': {}}, client_protocol, mock.Mock())
+    packet = client_protocol.send.call_args[0][0]
+    assert (packet['type'], packet['host'], packet['port']) == ('not_primary', '192.168.1.5', 4001)
+
+
+class _Elements(list):
+    def on_element(self, element):
+        self.append(element)
+
+
+def _registries_can_run():
+    """
+    Tells if the registry's own dependencies are installed, jsonstreamer with the yajl library it wraps included
+    """
+    if importlib.util.find_spec('setproctitle') is None:
+        return False
+    elements = _Elements()
+    try:
+        from jsonstreamer import ObjectStreamer
+        streamer = ObjectStreamer()
+        streamer.auto_listen(elements, prefix='on_')
+        streamer.consume('[{"type": "ping"},')
+    except Exception:
+        return False
+    return elements == [{'type': 'ping'}]
+
+
+needs_registries = pytest.mark.skipif(not _registries_can_run(), reason='registry dependencies are not installed')
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _start_registry(directory, port, *args):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.environ.get('PYTHONPATH')])))
+    process = subprocess.Popen([sys.executable, '-m', 'vyked.registry', '--host', '127.0.0.1', '--port', str(port),
+                                '--lease', '1'] + list(args), cwd=str(directory), env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError('Registry on port {} did not start'.format(port))
+
+
+class _Replies:
+    def __init__(self):
+        self.packets = asyncio.Queue()
+
+    def receive(self, packet, protocol, transport):
+        self.packets.put_nowait(packet)
+
+
+@asyncio.coroutine
+def _request(port, packet, reply_types):
+    replies = _Replies()
+    loop = asyncio.get_event_loop()
+    _, protocol = yield from loop.create_connection(partial(get_vyked_protocol, replies), '127.0.0.1', port)
+    try:
+        protocol.send(packet)
+        while True:
+            reply = yield from asyncio.wait_for(replies.packets.get(), 5)
+            if reply['type'] in reply_types:
+                return reply
+    finally:
+        protocol.close()
+
+
+def _register_node(port, node_id):
+    packet = ControlPacket.registration('127.0.0.1', 4002, node_id, 'service1', '1.0.0', [], 'tcp', lease=10)
+    return asyncio.get_event_loop().run_until_complete(
+        _request(port, packet, ('registered', 'topology_snapshot', 'not_primary')))
+
+
+@pytest.fixture
+def registries(tmpdir):
+    """
+    A primary registry process and a replica of it, both on localhost with a lease of one second
+    """
+    primary_port, replica_port = _free_port(), _free_port()
+    primary = _start_registry(tmpdir.mkdir('primary'), primary_port)
+    replica = _start_registry(tmpdir.mkdir('replica'), replica_port, '--replica-of',
+                              '127.0.0.1:{}'.format(primary_port))
+    time.sleep(0.5)  # the replica connects and takes its first lease
+    try:
+        yield (primary, primary_port), (replica, replica_port)
+    finally:
+        for process in (primary, replica):
+            process.send_signal(signal.SIGCONT)
+            process.kill()
+            process.wait()
+
+
+@needs_registries
+def test_replica_process_takes_over_the_nodes_of_a_killed_primary(registries):
+    (primary, primary_port), (_, replica_port) = registries
+    assert _register_node(primary_port, 'n1')['type'] == 'registered'
+    reply = _register_node(replica_port, 'n2')
+    assert (reply['type'], reply['port']) == ('not_primary', primary_port)
+
+    primary.kill()
+    deadline = time.monotonic() + 5
+    while _register_node(replica_port, 'n2')['type'] == 'not_primary':
+        assert time.monotonic() < deadline
+        time.sleep(0.2)
+
+    assert _register_node(replica_port, 'n1')['type'] == 'topology_snapshot'  # known from replication
+
+
+@needs_registries
+def test_primary_process_steps_down_when_its_replica_freezes(registries):
+    (_, primary_port), (replica, replica_port) = registries
+
+    replica.send_signal(signal.SIGSTOP)
+    time.sleep(1.5)
+
+    reply = _register_node(primary_port, 'n1')
+    assert (reply['type'], reply['port']) == ('not_primary', replica_port)
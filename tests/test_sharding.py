@@ -0,0 +1,64 @@
+from unittest import mock
+
+from vyked.registry import Registry, Repository
+
+SHARDS = [('10.0.0.1', 4001), ('10.0.0.2', 4001)]
+
+
+def _shard(index):
+    return Registry(ip=SHARDS[index][0], port=4001, repository=Repository(), shards=SHARDS, shard_index=index)
+
+
+def _link(first, second):
+    """
+    Connects two shards with protocols that deliver packets straight to the other side
+    """
+    to_first, to_second = mock.Mock(), mock.Mock()
+    to_first.send.side_effect = lambda packet: first.receive(packet, to_second, mock.Mock())
+    to_second.send.side_effect = lambda packet: second.receive(packet, to_first, mock.Mock())
+    first._shard_protocols[second._shard_index] = to_second
+    second._shard_protocols[first._shard_index] = to_first
+
+
+def _register(registry, params):
+    registry.receive({'type': 'register', 'params': params}, mock.Mock(), mock.Mock(**{
+        'get_extra_info.return_value': ('192.168.1.1', 2001)}))
+
+
+def test_dependency_on_a_service_of_another_shard(service1, service2):
+    service4 = dict(service2, service='service4', node_id='n4')  # shard 0, depends on service1 in shard 1
+    shard0, shard1 = _shard(0), _shard(1)
+    _link(shard0, shard1)
+
+    _register(shard0, service4)
+    assert shard0._repository.get_pending_services() == [('service4', '1.0.0')]
+
+    _register(shard1, service1)
+    assert shard0._repository.get_pending_services() == []
+    assert shard0._repository.get_instances('service1', '1.0.0') == [('192.168.1.2', 4002, 'n1', 'tcp')]
+
+    shard1.deregister_service('n1')
+    assert shard0._repository.get_pending_services() == [('service4', '1.0.0')]
+
+
+def test_request_for_another_shard_is_bounced(service1):
+    client_protocol = mock.Mock()
+    shard0 = _shard(0)
+
+    shard0.receive({'type': 'register', 'params': service1}, client_protocol, mock.Mock())
+
+    assert shard0._repository.get_nodes() == []
+    packet = client_protocol.send.call_args[0][0]
+    assert (packet['type'], packet['shards'], packet['packet']['params']) == ('wrong_shard', SHARDS, service1)
+
+
+def test_mirrored_nodes_are_left_out_of_snapshots(service1, service2):
+    service4 = dict(service2, service='service4', node_id='n4')
+    shard0, shard1 = _shard(0), _shard(1)
+    _link(shard0, shard1)
+    _register(shard0, service4)
+    _register(shard1, service1)
+
+    dumped = [params['node_id'] for op, params in shard0._repository.dump(exclude=shard0._mirrored)
+              if op == 'register']
+    assert dumped == ['n4']
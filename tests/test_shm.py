@@ -0,0 +1,45 @@
+import mmap
+import os
+import stat
+from unittest import mock
+
+import pytest
+
+from vyked.shm import RingBuffer, _ShmChannel, _create_mapping
+
+
+def test_ring_buffer_wraps_around():
+    mm = mmap.mmap(-1, RingBuffer.size(8))
+    ring = RingBuffer(mm, 0, 8)
+
+    assert ring.write(b'abcdef') == 6
+    assert ring.read() == b'abcdef'
+    assert ring.write(b'ghijklmnop') == 8
+    assert ring.write(b'q') == 0
+    assert ring.read() == b'ghijklmn'
+    assert ring.read() == b''
+
+
+def test_server_refuses_files_outside_the_shm_directory(tmpdir):
+    target = tmpdir.join('vyked_{}.shm'.format('0' * 32))
+    target.write('keep')
+    transport = mock.Mock()
+    channel = _ShmChannel(mock.Mock(), mock.Mock())
+    channel.connection_made(transport)
+
+    channel.data_received(str(target).encode() + b'\n')
+    channel.connection_lost(None)
+
+    transport.close.assert_called_once_with()
+    assert target.read() == 'keep'
+
+
+def test_ring_file_is_private_and_never_reuses_an_existing_path(tmpdir):
+    path = str(tmpdir.join('vyked_{}.shm'.format('1' * 32)))
+    mm = _create_mapping(path, 8)
+
+    assert len(mm) == 2 * RingBuffer.size(8)
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    with pytest.raises(FileExistsError):
+        _create_mapping(path, 8)
+    mm.close()
@@ -0,0 +1,81 @@
+import asyncio
+import json
+import socket
+from unittest import mock
+
+import pytest
+
+from vyked.streams import RedisError, Streams, encode_command, read_reply
+
+REDIS = ('127.0.0.1', 6379)
+
+
+def _reader(data):
+    reader = asyncio.StreamReader()
+    reader.feed_data(data)
+    return reader
+
+
+def test_commands_and_replies_use_the_redis_protocol():
+    loop = asyncio.get_event_loop()
+    assert encode_command('XACK', 's', b'1-0', 5) == b'*4\r\n$4\r\nXACK\r\n$1\r\ns\r\n$3\r\n1-0\r\n$1\r\n5\r\n'
+
+    reply = loop.run_until_complete(read_reply(_reader(
+        b'*3\r\n*2\r\n$3\r\n1-0\r\n*2\r\n$7\r\npayload\r\n$2\r\n{}\r\n$-1\r\n-ERR no\r\n')))
+
+    assert reply[0] == [b'1-0', [b'payload', b'{}']]
+    assert reply[1] is None
+    assert isinstance(reply[2], RedisError)
+
+
+def test_a_batch_is_acked_at_once_leaving_failed_entries_pending():
+    loop = asyncio.get_event_loop()
+    conn = mock.Mock(**{'execute.return_value': asyncio.Future()})
+    conn.execute.return_value.set_result(2)
+    handled = []
+
+    @asyncio.coroutine
+    def handler(payload):
+        if payload['fail']:
+            raise ValueError(payload)
+        handled.append(payload['id'])
+
+    entries = [(b'1-0', [b'payload', b'{"id": 1, "fail": false}']),
+               (b'2-0', [b'payload', b'{"id": 2, "fail": true}']),
+               (b'3-0', [b'payload', b'{"id": 3, "fail": false}'])]
+    loop.run_until_complete(Streams('127.0.0.1', 6379, 'service2/1.0.0')._handle(conn, 's', entries, handler))
+
+    assert handled == [1, 3]
+    conn.execute.assert_called_once_with('XACK', 's', 'service2/1.0.0', b'1-0', b'3-0')
+
+
+def _redis_running():
+    try:
+        socket.create_connection(REDIS, timeout=0.2).close()
+        return True
+    except OSError:
+        return False
+
+
+@pytest.mark.skipif(not _redis_running(), reason='needs a redis server >= 6.2 on {}:{}'.format(*REDIS))
+def test_each_group_gets_every_event_once_against_redis():
+    loop = asyncio.get_event_loop()
+    endpoint = 'service1/1.0.0/created_{}'.format(id(loop))
+    received = {'service2': [], 'service3': []}
+    groups = {name: [Streams(*REDIS, group=name), Streams(*REDIS, group=name)] for name in received}
+    consumers = []
+    for name, members in groups.items():
+        for streams in members:
+            handler = asyncio.coroutine(lambda payload, name=name: received[name].append(payload['id']))
+            consumers.append(asyncio.async(streams.consume(endpoint, handler)))
+    loop.run_until_complete(asyncio.sleep(0.2))
+
+    publisher = Streams(*REDIS, group='service1')
+    for i in range(10):
+        loop.run_until_complete(publisher.add(endpoint, json.dumps({'id': i})))
+    loop.run_until_complete(asyncio.sleep(0.5))
+    for consumer in consumers:
+        consumer.cancel()
+
+    assert sorted(received['service2']) == list(range(10))
+    assert sorted(received['service3']) == list(range(10))
@@ -0,0 +1,33 @@
+from vyked.versions import VersionIndex
+
+
+def _index(*versions):
+    index = VersionIndex()
+    for version in versions:
+        index.add(version)
+    return index
+
+
+def test_plain_version_resolves_exactly_then_to_the_highest_of_its_major():
+    index = _index('1.2.0', '1.10.0', '2.0.0', '1.9.3')
+
+    assert list(index) == ['1.2.0', '1.9.3', '1.10.0', '2.0.0']
+    assert index.resolve('1.2.0') == '1.2.0'
+    assert index.resolve('1.0.0') == '1.10.0'
+    assert index.resolve('3.0.0') is None
+
+    index.remove('1.10.0')
+    assert index.resolve('1.0.0') == '1.9.3'
+
+
+def test_ranges():
+    index = _index('1.2.0', '1.2.7', '1.3.1', '1.10.0', '2.0.0')
+
+    assert index.resolve('~1.2') == '1.2.7'
+    assert index.resolve('~1.4') is None
+    assert index.resolve('^1.3') == '1.10.0'
+    assert index.resolve('>=1.2,<1.10') == '1.3.1'
+    assert index.resolve('>1.3.1,<=2.0.0') == '2.0.0'
+    assert index.resolve('>1.10.0,<2') is None
+    assert index.resolve('==1.2.0') == '1.2.0'
+    assert index.resolve('*') == '2.0.0'
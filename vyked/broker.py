@@ -0,0 +1,200 @@
+import asyncio
+import logging
+from collections import defaultdict, OrderedDict
+from fnmatch import fnmatchcase
+from functools import partial
+
+from .jsonprotocol import JSONProtocol, VykedProtocol
+from .packet import ControlPacket
+
+MAX_MATCHES = 10000
+RECONNECT_DELAY = 0.5
+MAX_RECONNECT_DELAY = 30
+
+_logger = logging.getLogger(__name__)
+
+
+class BrokerProtocol(VykedProtocol):
+    """
+    Tells its handler when the connection drops
+    """
+
+    def connection_lost(self, exc):
+        super().connection_lost(exc)
+        self._handler.connection_lost(self)
+
+
+class Broker:
+    """
+    Pub sub broker speaking vyked's own protocol, can stand in for redis for @publish and @subscribe.
+    A publication is encoded once and written once to every connection subscribed to its channel, or to a glob
+    style pattern matching it. The patterns matching a channel are looked up once per set of subscribed patterns and
+    cached for the last max_matches channels. A connection's subscriptions are dropped as soon as it is lost.
+    """
+
+    def __init__(self, max_matches=MAX_MATCHES):
+        self._subscribers = defaultdict(set)
+        self._channels = defaultdict(set)
+        self._patterns = set()
+        self._matches = OrderedDict()
+        self._max_matches = max_matches
+
+    @asyncio.coroutine
+    def serve(self, host, port, loop=None):
+        """
+        :return: the asyncio server accepting publishers and subscribers
+        """
+        loop = loop or asyncio.get_event_loop()
+        return (yield from loop.create_server(partial(BrokerProtocol, self), host, port))
+
+    def receive(self, packet, protocol, transport):
+        if packet['type'] == 'channel_publish':
+            self.publish(packet['channel'], packet['payload'])
+        elif packet['type'] == 'channel_subscribe':
+            for channel in packet['channels']:
+                self._subscribers[channel].add(protocol)
+                self._channels[protocol].add(channel)
+            for pattern in packet.get('patterns', ()):
+                self._subscribers[pattern].add(protocol)
+                self._channels[protocol].add(pattern)
+                if pattern not in self._patterns:
+                    self._patterns.add(pattern)
+                    self._matches.clear()
+        elif packet['type'] == 'ping':
+            protocol.send(ControlPacket.pong(packet['node_id']))
+
+    def connection_lost(self, protocol):
+        self._drop(protocol)
+
+    def publish(self, channel, payload):
+        """
+        :return: the number of connections the publication went to
+        """
+        protocols = self._subscribers.get(channel, set())
+        patterns = self._matching(channel)
+        if patterns:
+            protocols = protocols.union(*(self._subscribers[pattern] for pattern in patterns))
+        if not protocols:
+            return 0
+        frame = JSONProtocol.make_frame(ControlPacket.channel_message(channel, payload))
+        sent = 0
+        for protocol in protocols:
+            if protocol.is_connected():
+                protocol.send_frame(frame)
+                sent += 1
+        return sent
+
+    def _matching(self, channel):
+        patterns = self._matches.get(channel)
+        if patterns is None:
+            patterns = self._matches[channel] = [pattern for pattern in self._patterns if fnmatchcase(channel, pattern)]
+            if len(self._matches) > self._max_matches:
+                self._matches.popitem(last=False)
+        return patterns
+
+    def _drop(self, protocol):
+        for channel in self._channels.pop(protocol, ()):
+            self._subscribers[channel].discard(protocol)
+            if not self._subscribers[channel]:
+                del self._subscribers[channel]
+                if channel in self._patterns:
+                    self._patterns.discard(channel)
+                    self._matches.clear()
+
+
+class BrokerPubSub:
+    """
+    Pub sub handler going through a Broker, with the interface of pubsub.PubSub.
+    A lost broker connection is reconnected with exponential backoff and its subscriptions are sent again.
+    """
+
+    def __init__(self, broker_host, broker_port):
+        self._broker_host = broker_host
+        self._broker_port = broker_port
+        self._protocol = None
+        self._handler = None
+        self._channels = []
+        self._patterns = []
+        self._reconnecting = False
+
+    @asyncio.coroutine
+    def connect(self):
+        _, self._protocol = yield from asyncio.get_event_loop().create_connection(
+            partial(BrokerProtocol, self), self._broker_host, self._broker_port)
+        return self._protocol
+
+    def connection_lost(self, protocol):
+        if protocol is self._protocol:
+            _logger.error('Lost the connection to the broker at %s:%s', self._broker_host, self._broker_port)
+            self._protocol = None
+            self._reconnecting = True
+            asyncio.async(self._reconnect())
+
+    @asyncio.coroutine
+    def _reconnect(self):
+        """
+        Connects again and resends every subscription, subscriptions made meanwhile included
+        """
+        delay = RECONNECT_DELAY
+        while True:
+            yield from asyncio.sleep(delay)
+            try:
+                yield from self.connect()
+            except OSError as e:
+                _logger.error('Reconnecting to the broker failed: %s', e)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+                continue
+            self._reconnecting = False
+            if self._channels or self._patterns:
+                self._protocol.send(ControlPacket.channel_subscribe(self._channels, self._patterns))
+            return
+
+    @asyncio.coroutine
+    def publish(self, endpoint: str, payload: str):
+        """
+        :return: False if the broker connection is down
+        """
+        if self._protocol is None or not self._protocol.is_connected():
+            _logger.error('Publish to %s failed, the broker is not connected', endpoint)
+            return False
+        self._protocol.send(ControlPacket.channel_publish(endpoint, payload))
+        return True
+
+    @asyncio.coroutine
+    def subscribe(self, endpoints: list, handler, patterns=()):
+        """
+        :param handler: called with the channel and the payload of every publication received
+        :param patterns: glob style channel patterns like 'service/*/endpoint'
+        """
+        self._handler = handler
+        self._channels.extend(endpoints)
+        self._patterns.extend(patterns)
+        if self._reconnecting:
+            return
+        if self._protocol is None:
+            yield from self.connect()
+        self._protocol.send(ControlPacket.channel_subscribe(endpoints, patterns))
+
+    def receive(self, packet, protocol, transport):
+        if packet['type'] == 'channel_message':
+            self._handler(packet['channel'], packet['payload'])
+
+
+if __name__ == '__main__':
+    import argparse
+
+    from .utils.log import config_logs
+
+    parser = argparse.ArgumentParser(description='Starts a standalone vyked pub sub broker')
+    parser.add_argument('--host', default=None)
+    parser.add_argument('--port', type=int, default=4600)
+    args = parser.parse_args()
+    config_logs(enable_ping_logs=False, log_level=logging.INFO)
+    loop = asyncio.get_event_loop()
+    server = loop.run_until_complete(Broker().serve(args.host, args.port))
+    try:
+        loop.run_forever()
+    finally:
+        server.close()
+        loop.run_until_complete(server.wait_closed())
+        loop.close()
@@ -1,9 +1,11 @@
 import asyncio
 from collections import defaultdict
+from fnmatch import fnmatchcase
 from functools import partial
 import json
 import logging
 import random
+import time
 import uuid
 
 from again.utils import unique_hex
@@ -13,12 +15,20 @@ import aiohttp
 
 from .services import TCPServiceClient, HTTPServiceClient
 from .pubsub import PubSub
+from .broker import BrokerPubSub
+from .dispatch import DedupWindow, HandlerQueue
+from .outbox import Outbox
 from .packet import ControlPacket, MessagePacket
 from .protocol_factory import get_vyked_protocol
+from .shm import create_shm_connection
+from .streams import Streams
 from .utils.jsonencoder import VykedEncoder
 
 HTTP = 'http'
 TCP = 'tcp'
+PUBLISH_CONNECTIONS_PER_NODE = 2
+PUBLISH_IDLE_TIMEOUT = 60
+DROPPED_LOG_EVERY = 1000
 
 _logger = logging.getLogger(__name__)
 
@@ -33,6 +43,21 @@ def _retry_for_pub(result):
     return not result
 
 
+def _subscription_handlers(clients, marker):
+    """
+    :param marker: attribute set by the subscribe decorator, 'is_subscribe' or 'is_xsubscribe'
+    :return: bound handlers of the service clients keyed by (service, version, endpoint)
+    """
+    handlers = defaultdict(list)
+    for client in clients:
+        if isinstance(client, TCPServiceClient):
+            for each in dir(client):
+                fn = getattr(client, each)
+                if callable(fn) and getattr(fn, marker, False):
+                    handlers[(client.name, client.version, fn.__name__)].append(fn)
+    return handlers
+
+
 def _retry_for_exception(_):
     return True
 
@@ -71,12 +96,17 @@ class TCPBus:
         self._pingers = {}
         self._node_clients = {}
         self._service_clients = []
+        self._publish_handlers = {}
+        self._delivered = DedupWindow()
+        self._unacked = set()
         self._pending_requests = []
         self.tcp_host = None
         self.http_host = None
         self._host_id = unique_hex()
         self._ronin = False
         self._registered = False
+        self._in_flight = 0
+        self.pubsub_bus = None
 
     def _create_service_clients(self):
         futures = []
@@ -88,12 +118,15 @@ class TCPBus:
                     futures.append(future)
         return asyncio.gather(*futures, return_exceptions=False)
 
-    def register(self, host, port, service, version, clients, service_type):
+    def register(self, host, port, service, version, clients, service_type, unix_socket=None, shm_socket=None,
+                 lease=None):
         for client in clients:
             if isinstance(client, (TCPServiceClient, HTTPServiceClient)):
                 client.bus = self
         self._service_clients = clients
-        self._registry_client.register(host, port, service, version, clients, service_type)
+        self._publish_handlers = _subscription_handlers(clients, 'is_xsubscribe')
+        self._registry_client.register(host, port, service, version, clients, service_type, unix_socket=unix_socket,
+                                       shm_socket=shm_socket, lease=lease)
 
     def registration_complete(self):
         if not self._registered:
@@ -106,6 +139,31 @@ class TCPBus:
 
             f.add_done_callback(fun)
 
+    def vendor_node_added(self, service, version, host, port, node_id, service_type):
+        """
+        Connects to a vendor instance that joined after registration completed
+        """
+        if not self._registered or service_type != TCP:
+            return
+        for sc in self._service_clients:
+            if isinstance(sc, TCPServiceClient) and sc.properties == (service, version):
+                self._node_clients[node_id] = sc
+                self._connect_to_client(host, node_id, port, service_type, sc)
+
+    def vendor_node_removed(self, node_id):
+        self._node_clients.pop(node_id, None)
+        protocol = self._client_protocols.pop(node_id, None)
+        if protocol is not None and protocol.is_connected():
+            protocol.close()
+
+    def load_report(self):
+        """
+        :return: the requests this node is serving, the requests it has queued for its vendors and the publications
+                 buffered for its subscription handlers
+        """
+        backlog = self.pubsub_bus.backlog() if self.pubsub_bus is not None else 0
+        return {'in_flight': self._in_flight, 'queue': len(self._pending_requests), 'backlog': backlog}
+
     def send(self, packet: dict):
         packet['from'] = self._host_id
         func = getattr(self, '_' + packet['type'] + '_sender')
@@ -122,12 +180,29 @@ class TCPBus:
     @retry(should_retry_for_result=_retry_for_client_conn, should_retry_for_exception=_retry_for_exception, timeout=10,
            strategy=[0, 2, 2, 4])
     def _connect_to_client(self, host, node_id, port, service_type, service_client):
-        future = asyncio.async(
-            asyncio.get_event_loop().create_connection(partial(get_vyked_protocol, service_client), host, port))
+        future = asyncio.async(self._open_connection(host, node_id, port, service_client))
         future.add_done_callback(
             partial(self._service_client_connection_callback, self._node_clients[node_id], node_id, service_type))
         return future
 
+    @asyncio.coroutine
+    def _open_connection(self, host, node_id, port, service_client):
+        """
+        Connects over the node's shared memory or unix socket when it is on this host, over tcp otherwise or if the
+        local socket can't be reached, a host sharing this host's name or a different mount namespace for example
+        """
+        factory = partial(get_vyked_protocol, service_client)
+        shm_socket = self._registry_client.get_shm_socket(node_id)
+        unix_socket = self._registry_client.get_unix_socket(node_id)
+        try:
+            if shm_socket is not None:
+                return (yield from create_shm_connection(factory, shm_socket))
+            if unix_socket is not None:
+                return (yield from asyncio.get_event_loop().create_unix_connection(factory, unix_socket))
+        except OSError as e:
+            _logger.info('Could not connect to %s locally, falling back to tcp: %s', node_id, e)
+        return (yield from asyncio.get_event_loop().create_connection(factory, host, port))
+
     def _service_client_connection_callback(self, sc, node_id, service_type, future):
         _, protocol = future.result()
         # TODO : handle pinging
@@ -156,8 +231,8 @@ class TCPBus:
     def _send_packet(self, packet):
         node_id = self._get_node_id_for_packet(packet)
         if node_id is not None:
-            client_protocol = self._client_protocols[node_id]
-            if client_protocol.is_connected():
+            client_protocol = self._client_protocols.get(node_id)
+            if client_protocol is not None and client_protocol.is_connected():
                 packet['to'] = node_id
                 client_protocol.send(packet)
                 return True
@@ -199,8 +274,10 @@ class TCPBus:
             from_node_id = packet['from']
             entity = packet['entity']
             future = asyncio.async(api_fn(from_id=from_node_id, entity=entity, **packet['payload']))
+            self._in_flight += 1
 
             def send_result(f):
+                self._in_flight -= 1
                 result_packet = f.result()
                 protocol.send(result_packet)
 
@@ -209,90 +286,261 @@ class TCPBus:
             print('no api found for packet: ', packet)
 
     def _handle_publish(self, packet, protocol):
-        service, version, endpoint, payload, publish_id = packet['service'], packet['version'], packet['endpoint'], \
-                                                          packet['payload'], packet['publish_id']
-        for client in self._service_clients:
-            if client.name == service and client.version == version:
-                fun = getattr(client, endpoint)
-                asyncio.async(fun(payload))
-        protocol.send(MessagePacket.ack(publish_id))
+        """
+        Hands an xpublished event to its handlers once, a retry of an event already received is only acked again
+        unless its handlers are still running
+        """
+        service, version, endpoint, payload, publish_id = (packet['service'], packet['version'], packet['endpoint'],
+                                                           packet['payload'], packet['publish_id'])
+        if not self._delivered.add(publish_id):
+            if publish_id not in self._unacked:
+                protocol.send(MessagePacket.ack(publish_id))
+            return
+        handlers = self._publish_handlers.get((service, version, endpoint), ())
+        futures = [asyncio.async(fun(payload)) for fun in handlers]
+        if any(getattr(fun, 'ack_after_handler', False) for fun in handlers):
+            self._unacked.add(publish_id)
+            asyncio.gather(*futures, return_exceptions=True).add_done_callback(
+                partial(self._handled, publish_id, protocol))
+        else:
+            protocol.send(MessagePacket.ack(publish_id))
+
+    def _handled(self, publish_id, protocol, future):
+        self._unacked.discard(publish_id)
+        errors = [result for result in future.result() if isinstance(result, BaseException)]
+        if errors:
+            self._delivered.discard(publish_id)
+            _logger.error('Handling publish %s failed, it is left for the publisher to retry', publish_id,
+                          exc_info=errors[0])
+        elif protocol.is_connected():
+            protocol.send(MessagePacket.ack(publish_id))
+
+
+class PublishConnections:
+    """
+    Persistent connections to subscriber nodes shared by every xpublish.
+    A node gets up to connections_per_node connections used in turn. Subscribers ack a publish on the connection it
+    came in with its publish_id, so many publishes can be in flight on one connection. Dropped connections are
+    replaced on the next publish and connections to a node unused for idle_timeout seconds are closed.
+    """
+
+    def __init__(self, handler, connections_per_node=PUBLISH_CONNECTIONS_PER_NODE, idle_timeout=PUBLISH_IDLE_TIMEOUT):
+        self._handler = handler
+        self._connections_per_node = connections_per_node
+        self._idle_timeout = idle_timeout
+        self._pools = {}
+        self._connecting = defaultdict(list)
+        self._last_used = {}
+        self._sweep_timer = None
+
+    def __len__(self):
+        return sum(len(pool) for pool in self._pools.values())
+
+    @asyncio.coroutine
+    def send(self, host, port, packet):
+        protocol = yield from self._get(host, port)
+        protocol.send(packet)
+
+    @asyncio.coroutine
+    def _get(self, host, port):
+        address = (host, port)
+        self._last_used[address] = time.monotonic()
+        if self._sweep_timer is None:
+            self._sweep_timer = asyncio.get_event_loop().call_later(self._idle_timeout, self._sweep)
+        pool = self._pools.setdefault(address, [])
+        pool[:] = [protocol for protocol in pool if protocol.is_connected()]
+        if len(pool) + len(self._connecting[address]) < self._connections_per_node:
+            self._connect(address)
+        if not pool:  # every publish to a cold node waits for the first connect in progress
+            _, protocol = yield from asyncio.shield(self._connecting[address][0])
+            return protocol
+        pool.append(pool.pop(0))
+        return pool[-1]
+
+    def _connect(self, address):
+        coroutine = asyncio.get_event_loop().create_connection(partial(get_vyked_protocol, self._handler), *address)
+        future = asyncio.async(coroutine)
+        self._connecting[address].append(future)
+        future.add_done_callback(partial(self._connected, address))
+
+    def _connected(self, address, future):
+        self._connecting[address].remove(future)
+        if not self._connecting[address]:
+            del self._connecting[address]
+        if future.exception() is not None:
+            _logger.info('Could not connect to subscriber %s:%s: %s', address[0], address[1], future.exception())
+        elif address in self._pools:
+            self._pools[address].append(future.result()[1])
+        else:  # swept while connecting
+            future.result()[1].close()
+
+    def _sweep(self):
+        now = time.monotonic()
+        for address, last_used in list(self._last_used.items()):
+            if now - last_used >= self._idle_timeout and not self._connecting.get(address):
+                del self._last_used[address]
+                for protocol in self._pools.pop(address, ()):
+                    if protocol.is_connected():
+                        protocol.close()
+        self._sweep_timer = asyncio.get_event_loop().call_later(self._idle_timeout, self._sweep) \
+            if self._last_used else None
+
+    def close(self):
+        if self._sweep_timer is not None:
+            self._sweep_timer.cancel()
+            self._sweep_timer = None
+        for pool in self._pools.values():
+            for protocol in pool:
+                if protocol.is_connected():
+                    protocol.close()
+        self._pools.clear()
+        self._last_used.clear()
 
 
 class PubSubBus:
     PUBSUB_DELAY = 5
 
-    def __init__(self, registry_client):
+    def __init__(self, registry_client, outbox_file=None):
+        """
+        :param outbox_file: where xpublishes are logged until acked so they survive a restart, memory only if None
+        """
         self._pubsub_handler = None
         self._registry_client = registry_client
         self._clients = None
-        self._pending_publishes = {}
-
-    def create_pubsub_handler(self, host, port):
-        self._pubsub_handler = PubSub(host, port)
+        self._subscriptions = {}
+        self._routes = {}
+        self._streams = None
+        self._publish_connections = PublishConnections(self)
+        self._outbox = Outbox(self.xpublish, path=outbox_file, base_delay=self.PUBSUB_DELAY)
+        replayed = self._outbox.load()
+        if replayed:
+            _logger.info('Delivering %s xpublishes left in %s', replayed, outbox_file)
+
+    def create_pubsub_handler(self, host, port, broker=False):
+        """
+        :param broker: host and port are those of a vyked Broker rather than redis
+        """
+        self._pubsub_handler = BrokerPubSub(host, port) if broker else PubSub(host, port)
         yield from self._pubsub_handler.connect()
 
+    def create_streams_handler(self, host, port, group):
+        """
+        Carries xpublishes over redis streams instead of pushing them to subscribers through the registry
+        :param group: consumer group this service reads the streams of its @xsubscribe endpoints with
+        """
+        self._streams = Streams(host, port, group)
+        yield from self._streams.connect()
+
     def register_for_subscription(self, clients):
+        """
+        Subscribes to the @subscribe endpoints of clients, a client of version '*' subscribes to the endpoint
+        of every version of its service through a channel pattern
+        """
         self._clients = clients
-        subscription_list = []
-        xsubscription_list = []
-        for client in clients:
-            if isinstance(client, TCPServiceClient):
-                for each in dir(client):
-                    fn = getattr(client, each)
-                    if callable(fn) and getattr(fn, 'is_subscribe', False):
-                        subscription_list.append(self._get_pubsub_key(client.name, client.version, fn.__name__))
-                    elif callable(fn) and getattr(fn, 'is_xsubscribe', False):
-                        xsubscription_list.append((client.name, client.version, fn.__name__, getattr(fn, 'strategy')))
-        self._registry_client.x_subscribe(xsubscription_list)
-        yield from self._pubsub_handler.subscribe(subscription_list, handler=self.subscription_handler)
+        self._subscriptions = {
+            self._get_pubsub_key(*key): [HandlerQueue(fn, fn.concurrency, fn.max_backlog, fn.key) for fn in handlers]
+            for key, handlers in _subscription_handlers(clients, 'is_subscribe').items()}
+        channels = [key for key in self._subscriptions if not self._is_pattern(key)]
+        patterns = [key for key in self._subscriptions if self._is_pattern(key)]
+        self._routes = {channel: self._route(channel) for channel in channels}
+        xsubscriptions = _subscription_handlers(clients, 'is_xsubscribe')
+        if self._streams is not None:
+            for key, handlers in xsubscriptions.items():
+                for fn in handlers:
+                    asyncio.async(self._streams.consume(self._get_pubsub_key(*key), fn, fn.strategy))
+        else:
+            self._registry_client.x_subscribe([key + (handlers[0].strategy,) for key, handlers in
+                                               xsubscriptions.items()])
+        yield from self._pubsub_handler.subscribe(channels, handler=self.subscription_handler, patterns=patterns)
 
     def publish(self, service, version, endpoint, payload):
+        """
+        :return: future of the redis publish, True once redis took it
+        """
         endpoint_key = self._get_pubsub_key(service, version, endpoint)
-        asyncio.async(self._retry_publish(endpoint_key, json.dumps(payload, cls=VykedEncoder)))
-        publish_id = str(uuid.uuid4())
-        future = asyncio.async(self.xpublish(publish_id, service, version, endpoint, payload))
-        self._pending_publishes[publish_id] = future
+        encoded = json.dumps(payload, cls=VykedEncoder)
+        future = asyncio.async(self._retry_publish(endpoint_key, encoded))
+        future.add_done_callback(partial(self._published, endpoint_key))
+        if self._streams is not None:
+            asyncio.async(self._streams.add(endpoint_key, encoded))
+        else:
+            self._outbox.add({'id': str(uuid.uuid4()), 'service': service, 'version': version, 'endpoint': endpoint,
+                              'payload': payload})
+        return future
+
+    @staticmethod
+    def _published(endpoint_key, future):
+        if not future.cancelled() and future.exception() is None and not future.result():
+            _logger.warning('Publish to %s did not reach redis', endpoint_key)
 
-    def xpublish(self, publish_id, service, version, endpoint, payload):
+    def xpublish(self, event):
+        """
+        Makes one attempt at delivering an outbox event to a node of every subscribed service
+        :return: False if nothing subscribes to the event
+        """
+        service, version, endpoint = event['service'], event['version'], event['endpoint']
         subscribers = yield from self._registry_client.get_subscribers(service, version, endpoint)
+        if not len(subscribers):
+            return False
         strategies = defaultdict(list)
         for subscriber in subscribers:
             strategies[(subscriber['service'], subscriber['version'])].append(
-                (subscriber['host'], subscriber['port'], subscriber['node_id'], subscriber['strategy']))
-        if not len(subscribers):
-            future = self._pending_publishes[publish_id]
-            future.cancel()
-            return
-        yield from self._connect_and_publish(publish_id, service, version, endpoint, strategies, payload)
-        yield from asyncio.sleep(self.PUBSUB_DELAY)
-        yield from self.xpublish(publish_id, service, version, endpoint, payload)
+                (subscriber['host'], subscriber['port'], subscriber['node_id'], subscriber['strategy'],
+                 subscriber.get('leader', False)))
+        yield from self._connect_and_publish(event['id'], service, version, endpoint, strategies, event['payload'])
+        return True
 
     def receive(self, packet, transport, protocol):
-        if packet['type'] == 'ack':
-            future = self._pending_publishes.pop(packet['request_id'])
-            future.cancel()
-            transport.close()
+        if packet['type'] == 'ack':  # acks of retried publishes can come more than once
+            self._outbox.ack(packet['request_id'])
 
     def _retry_publish(self, endpoint, payload):
         return (yield from self._pubsub_handler.publish(endpoint, payload))
 
-    def subscription_handler(self, endpoint, payload):
-        service, version, endpoint = endpoint.split('/')
-        client = [sc for sc in self._clients if (sc.name == service and sc.version == version)][0]
-        func = getattr(client, endpoint)
-        asyncio.async(func(**json.loads(payload)))
+    def subscription_handler(self, channel, payload):
+        handlers = self._routes.get(channel)
+        if handlers is None:  # first publication on a channel only a pattern subscribes to
+            handlers = self._routes[channel] = self._route(channel)
+        if handlers:
+            kwargs = json.loads(payload)
+            for queue in handlers:
+                if not queue.submit(kwargs) and queue.dropped % DROPPED_LOG_EVERY == 1:
+                    _logger.warning('Dropped a publication on %s, %s dropped so far', channel, queue.dropped)
+
+    def backlog(self):
+        """
+        :return: publications buffered for the subscription handlers
+        """
+        return sum(len(queue) for queues in self._subscriptions.values() for queue in queues)
+
+    def _route(self, channel):
+        """
+        :return: handler queues of the subscriptions to channel and of the patterns matching it
+        """
+        handlers = list(self._subscriptions.get(channel, ()))
+        for key, subscribed in self._subscriptions.items():
+            if self._is_pattern(key) and fnmatchcase(channel, key):
+                handlers.extend(subscribed)
+        return handlers
 
     @staticmethod
     def _get_pubsub_key(service, version, endpoint):
         return '/'.join((service, str(version), endpoint))
 
+    @staticmethod
+    def _is_pattern(key):
+        return '*' in key
+
     def _connect_and_publish(self, publish_id, service, version, endpoint, strategies, payload):
         for key, value in strategies.items():
-            if value[0][3] == 'LEADER':
-                host, port = value[0][0], value[0][1]
+            if value[0][3] == 'LEADER':  # the elected leader, then the others in case it can't be reached
+                candidates = sorted(value, key=lambda subscriber: not subscriber[4])
             else:
-                random_metadata = random.choice(value)
-                host, port = random_metadata[0], random_metadata[1]
-            transport, protocol = yield from asyncio.get_event_loop().create_connection(partial(get_vyked_protocol, self), host, port)
+                candidates = [random.choice(value)]
             packet = MessagePacket.publish(publish_id, service, version, endpoint, payload)
-            protocol.send(packet)
+            for host, port, *_ in candidates:
+                try:
+                    yield from self._publish_connections.send(host, port, packet)
+                    break
+                except OSError:  # retried with the next round of the publish if no candidate is reachable
+                    _logger.info('Could not publish %s to %s:%s', publish_id, host, port)
@@ -8,35 +8,46 @@ _logger = logging.getLogger()
 
 from again.utils import unique_hex
 
+from ..dispatch import MAX_BACKLOG, MAX_CONCURRENCY
+
 
 def publish(func):
     """
-    publish the return value of this function as a message from this endpoint
+    publish the return value of this function as a message from this endpoint,
+    the call returns a future that resolves to False if the message could not be published
     """
 
     @wraps(func)
     def wrapper(self, *args, **kwargs):  # outgoing
         payload = func(self, *args, **kwargs)
         payload.pop('self', None)
-        self._publish(func.__name__, payload)
-        return None
+        return self._publish(func.__name__, payload)
 
     wrapper.is_publish = True
 
     return wrapper
 
 
-def subscribe(func):
+def subscribe(func=None, concurrency=MAX_CONCURRENCY, max_backlog=MAX_BACKLOG, key=None):
     """
     use to listen for publications from a specific endpoint of a service,
     this method receives a publication from a remote service
+    :param concurrency: publications handled at the same time, the others wait in a buffer
+    :param max_backlog: publications the buffer holds, publications arriving when it is full are dropped
+    :param key: payload field of the publications that must be handled in order, publications of different
+                values of the field are still handled concurrently
     """
+    if func is None:
+        return partial(subscribe, concurrency=concurrency, max_backlog=max_backlog, key=key)
     wrapper = _get_subscribe_decorator(func)
     wrapper.is_subscribe = True
+    wrapper.concurrency = concurrency
+    wrapper.max_backlog = max_backlog
+    wrapper.key = key
     return wrapper
 
 
-def xsubscribe(func=None, strategy='DESIGNATION'):
+def xsubscribe(func=None, strategy='DESIGNATION', ack_after_handler=False):
     """
     Used to listen for publications from a specific endpoint of a service. If multiple instances
     subscribe to an endpoint, only one of them receives the event. And the publish event is retried till
@@ -45,13 +56,16 @@ def xsubscribe(func=None, strategy='DESIGNATION'):
     :param strategy: The strategy of delivery. Can be 'RANDOM' or 'LEADER'. If 'RANDOM', then the event will be randomly
     passed to any one of the interested parties. If 'LEADER' then it is passed to the first instance alive
     which registered for that endpoint.
+    :param ack_after_handler: acknowledge the event once the function has returned rather than when it is received,
+    an event whose function raised is not acknowledged and is handled again when the publisher retries it
     """
     if func is None:
-        return partial(xsubscribe, strategy=strategy)
+        return partial(xsubscribe, strategy=strategy, ack_after_handler=ack_after_handler)
     else:
         wrapper = _get_subscribe_decorator(func)
         wrapper.is_xsubscribe = True
         wrapper.strategy = strategy
+        wrapper.ack_after_handler = ack_after_handler
         return wrapper
 
 
@@ -0,0 +1,124 @@
+import asyncio
+from collections import deque, OrderedDict
+from functools import partial
+import logging
+import time
+
+MAX_CONCURRENCY = 32
+MAX_BACKLOG = 10000
+DEDUP_WINDOW = 1800  # seconds, longer than the outbox keeps retrying an event with its default backoff
+DEDUP_MAX_SIZE = 100000
+
+_logger = logging.getLogger(__name__)
+
+
+class HandlerQueue:
+    """
+    Runs the handler of a subscription for the publications it receives, at most concurrency of them at a time.
+    Publications waiting for a free slot are buffered up to max_backlog, past that they are dropped and counted.
+    With a key, publications whose payloads share the value of that field are handled one after the other in the
+    order they arrived, while publications of different keys still run side by side.
+    """
+
+    def __init__(self, handler, concurrency=MAX_CONCURRENCY, max_backlog=MAX_BACKLOG, key=None):
+        """
+        :param handler: coroutine function called with the payload of a publication as keyword arguments
+        :param key: payload field partitioning publications into ordered streams, no ordering if None
+        """
+        self._handler = handler
+        self._concurrency = concurrency
+        self._max_backlog = max_backlog
+        self._key = key
+        self._ready = deque()
+        self._keys = {}  # key of a running publication -> publications of that key waiting behind it
+        self._backlog = 0
+        self.running = 0
+        self.dropped = 0
+
+    def __len__(self):
+        """
+        :return: publications buffered and not handled yet
+        """
+        return self._backlog
+
+    def submit(self, payload: dict):
+        """
+        :return: False if the buffer is full and the publication was dropped
+        """
+        if self._backlog >= self._max_backlog:
+            self.dropped += 1
+            return False
+        self._backlog += 1
+        key = payload.get(self._key) if self._key is not None else None
+        if key is None:
+            self._ready.append((None, payload))
+        elif key in self._keys:
+            self._keys[key].append(payload)
+        else:
+            self._keys[key] = deque()
+            self._ready.append((key, payload))
+        self._run()
+        return True
+
+    def _run(self):
+        while self._ready and self.running < self._concurrency:
+            key, payload = self._ready.popleft()
+            self._backlog -= 1
+            self.running += 1
+            future = asyncio.async(self._handler(**payload))
+            future.add_done_callback(partial(self._done, key))
+
+    def _done(self, key, future):
+        self.running -= 1
+        if not future.cancelled() and future.exception() is not None:
+            _logger.error('Subscription handler %s failed', getattr(self._handler, '__name__', self._handler),
+                          exc_info=future.exception())
+        if key is not None:
+            waiting = self._keys[key]
+            if waiting:
+                self._ready.append((key, waiting.popleft()))
+            else:
+                del self._keys[key]
+        self._run()
+
+
+class DedupWindow:
+    """
+    The publish_ids received in the last window seconds, at most max_size of them.
+    Ids are kept in the order they arrived with their expiry, so expiring and evicting only ever pops the oldest.
+    """
+
+    def __init__(self, window=DEDUP_WINDOW, max_size=DEDUP_MAX_SIZE, clock=time.monotonic):
+        self._window = window
+        self._max_size = max_size
+        self._clock = clock
+        self._seen = OrderedDict()
+
+    def __contains__(self, publish_id):
+        return publish_id in self._seen
+
+    def __len__(self):
+        return len(self._seen)
+
+    def add(self, publish_id):
+        """
+        :return: False if publish_id was already received within the window
+        """
+        now = self._clock()
+        while self._seen:
+            oldest, expiry = next(iter(self._seen.items()))
+            if expiry > now:
+                break
+            del self._seen[oldest]
+        if publish_id in self._seen:
+            return False
+        self._seen[publish_id] = now + self._window
+        if len(self._seen) > self._max_size:
+            self._seen.popitem(last=False)
+        return True
+
+    def discard(self, publish_id):
+        """
+        Forgets publish_id so that its next delivery is handled again
+        """
+        self._seen.pop(publish_id, None)
@@ -0,0 +1,113 @@
+import asyncio
+import logging
+import random
+
+import aiohttp
+
+from .pinger import PING_INTERVAL, PING_TIMEOUT
+
+HEALTH_PATH = '/ping'
+FAILURE_THRESHOLD = 3
+MAX_CONCURRENT_CHECKS = 100
+JITTER = 0.1
+
+_logger = logging.getLogger(__name__)
+
+
+class HTTPHealthChecker:
+    """
+    Checks the health path of http nodes through a single pooled, keep-alive client session.
+    Checks are spread over the interval with jitter so they don't synchronise, at most max_concurrent run at once
+    and a node is reported unhealthy after failure_threshold consecutive failed checks.
+    """
+
+    def __init__(self, path=HEALTH_PATH, interval=PING_INTERVAL, timeout=PING_TIMEOUT,
+                 failure_threshold=FAILURE_THRESHOLD, max_concurrent=MAX_CONCURRENT_CHECKS, session=None, loop=None):
+        """
+        :param session: client session to check through, one sharing a connection pool is created if not given
+        """
+        self._path = path
+        self._interval = interval
+        self._timeout = timeout
+        self._failure_threshold = failure_threshold
+        self._max_concurrent = max_concurrent
+        self._session = session
+        self._owns_session = session is None
+        self._loop = loop or asyncio.get_event_loop()
+        self._semaphore = None
+        self._nodes = {}
+
+    def add(self, node_id, host, port, on_unhealthy):
+        """
+        Starts checking a node, on_unhealthy(node_id) is called once the node is evicted
+        """
+        if self._session is None:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(loop=self._loop), loop=self._loop)
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._max_concurrent)
+        self.remove(node_id)
+        url = 'http://{}:{}{}'.format(host, port, self._path)
+        self._nodes[node_id] = _Node(url, on_unhealthy)
+        self._schedule(node_id, random.uniform(0, self._interval))
+
+    def remove(self, node_id):
+        node = self._nodes.pop(node_id, None)
+        if node is not None and node.timer is not None:
+            node.timer.cancel()
+
+    def close(self):
+        for node_id in list(self._nodes):
+            self.remove(node_id)
+        if self._owns_session and self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def _schedule(self, node_id, delay):
+        self._nodes[node_id].timer = self._loop.call_later(delay, self._start_check, node_id)
+
+    def _start_check(self, node_id):
+        if node_id in self._nodes:
+            self._nodes[node_id].timer = None
+            asyncio.async(self._check(node_id), loop=self._loop)
+
+    @asyncio.coroutine
+    def _check(self, node_id):
+        node = self._nodes[node_id]
+        yield from self._semaphore.acquire()
+        try:
+            healthy = yield from self._is_healthy(node.url)
+        finally:
+            self._semaphore.release()
+        if self._nodes.get(node_id) is not node:  # removed while the check was in flight
+            return
+        if healthy:
+            node.failures = 0
+        else:
+            node.failures += 1
+            _logger.info('Health check %s of %s failed', node.failures, node_id)
+            if node.failures >= self._failure_threshold:
+                self.remove(node_id)
+                node.on_unhealthy(node_id)
+                return
+        self._schedule(node_id, self._interval * random.uniform(1 - JITTER, 1 + JITTER))
+
+    @asyncio.coroutine
+    def _is_healthy(self, url):
+        try:
+            response = yield from asyncio.wait_for(self._session.get(url), self._timeout)
+        except (aiohttp.ClientError, asyncio.TimeoutError, OSError):
+            return False
+        try:
+            return response.status == 200
+        finally:
+            yield from response.release()  # hands the connection back to the pool whatever the status
+
+
+class _Node:
+    __slots__ = ('url', 'on_unhealthy', 'failures', 'timer')
+
+    def __init__(self, url, on_unhealthy):
+        self.url = url
+        self.on_unhealthy = on_unhealthy
+        self.failures = 0
+        self.timer = None
@@ -10,6 +10,7 @@ from .bus import TCPBus, PubSubBus
 from vyked.registry_client import RegistryClient
 from vyked.services import HTTPService, TCPService
 from .protocol_factory import get_vyked_protocol
+from .shm import create_shm_server
 from .utils.log import setup_logging
 
 _logger = logging.getLogger(__name__)
@@ -18,10 +19,17 @@ _logger = logging.getLogger(__name__)
 class Host:
     registry_host = None
     registry_port = None
+    registry_replicas = []
     pubsub_host = None
     pubsub_port = None
+    pubsub_broker = False
+    xsubscribe_streams = False
     name = None
     ronin = False
+    unix_socket_dir = None
+    shm_transport = False
+    topology_cache_dir = None
+    outbox_dir = None
     _host_id = None
     _tcp_service = None
     _http_service = None
@@ -73,6 +81,37 @@ class Host:
             print(result)
             return result
 
+    @classmethod
+    def _create_unix_server(cls):
+        """
+        Also serves the tcp service on a unix socket in unix_socket_dir, consumers on the same host prefer it over tcp
+        """
+        if cls._tcp_service and cls.unix_socket_dir:
+            _, host_port = cls._tcp_service.socket_address
+            path = os.path.join(cls.unix_socket_dir, 'vyked_{}_{}.sock'.format(cls._tcp_service.name, host_port))
+            if os.path.exists(path):
+                os.remove(path)
+            task = asyncio.get_event_loop().create_unix_server(partial(get_vyked_protocol, cls._tcp_service.tcp_bus),
+                                                               path)
+            result = asyncio.get_event_loop().run_until_complete(task)
+            cls._tcp_service.unix_socket = path
+            return result
+
+    @classmethod
+    def _create_shm_server(cls):
+        """
+        Serves the tcp service over shared memory rings when shm_transport is set, requires unix_socket_dir
+        """
+        if cls._tcp_service and cls.unix_socket_dir and cls.shm_transport:
+            _, host_port = cls._tcp_service.socket_address
+            path = os.path.join(cls.unix_socket_dir, 'vyked_{}_{}.shm.sock'.format(cls._tcp_service.name, host_port))
+            if os.path.exists(path):
+                os.remove(path)
+            task = create_shm_server(partial(get_vyked_protocol, cls._tcp_service.tcp_bus), path)
+            result = asyncio.get_event_loop().run_until_complete(task)
+            cls._tcp_service.shm_socket = path
+            return result
+
     @classmethod
     def _create_http_server(cls):
         if cls._http_service:
@@ -101,12 +140,18 @@ class Host:
     @classmethod
     def _start_server(cls):
         tcp_server = cls._create_tcp_server()
+        unix_server = cls._create_unix_server()
+        shm_server = cls._create_shm_server()
         http_server = cls._create_http_server()
         cls._create_pubsub_handler()
         cls._subscribe()
         cls._register_services()
         if tcp_server:
             _logger.info('Serving TCP on {}'.format(tcp_server.sockets[0].getsockname()))
+        if unix_server:
+            _logger.info('Serving TCP on unix socket {}'.format(cls._tcp_service.unix_socket))
+        if shm_server:
+            _logger.info('Serving TCP over shared memory via {}'.format(cls._tcp_service.shm_socket))
         if http_server:
             _logger.info('Serving HTTP on {}'.format(http_server.sockets[0].getsockname()))
         _logger.info("Event loop running forever, press CTRL+c to interrupt.")
@@ -120,6 +165,16 @@ class Host:
                 tcp_server.close()
                 asyncio.get_event_loop().run_until_complete(tcp_server.wait_closed())
 
+            if unix_server:
+                unix_server.close()
+                asyncio.get_event_loop().run_until_complete(unix_server.wait_closed())
+                os.remove(cls._tcp_service.unix_socket)
+
+            if shm_server:
+                shm_server.close()
+                asyncio.get_event_loop().run_until_complete(shm_server.wait_closed())
+                os.remove(cls._tcp_service.shm_socket)
+
             if http_server:
                 http_server.close()
                 asyncio.get_event_loop().run_until_complete(http_server.wait_closed())
@@ -130,11 +185,23 @@ class Host:
     def _create_pubsub_handler(cls):
         if not cls.ronin:
             if cls._tcp_service:
-                asyncio.get_event_loop().run_until_complete(
-                    cls._tcp_service.pubsub_bus.create_pubsub_handler(cls.pubsub_host, cls.pubsub_port))
+                asyncio.get_event_loop().run_until_complete(cls._tcp_service.pubsub_bus.create_pubsub_handler(
+                    cls.pubsub_host, cls.pubsub_port, cls.pubsub_broker))
+                cls._create_streams_handler(cls._tcp_service)
             if cls._http_service:
                 asyncio.get_event_loop().run_until_complete(
-                    cls._http_service.pubsub_bus.create_pubsub_handler(cls.pubsub_host, cls.pubsub_port))
+                    cls._http_service.pubsub_bus.create_pubsub_handler(cls.pubsub_host, cls.pubsub_port,
+                                                                       cls.pubsub_broker))
+                cls._create_streams_handler(cls._http_service)
+
+    @classmethod
+    def _create_streams_handler(cls, service):
+        """
+        Moves the xpublishes and xsubscriptions of service to redis streams when xsubscribe_streams is set
+        """
+        if cls.xsubscribe_streams:
+            asyncio.get_event_loop().run_until_complete(service.pubsub_bus.create_streams_handler(
+                cls.pubsub_host, cls.pubsub_port, '{}/{}'.format(service.name, service.version)))
 
     @classmethod
     def _subscribe(cls):
@@ -146,12 +213,26 @@ class Host:
 
     @classmethod
     def _set_bus(cls, service):
-        registry_client = RegistryClient(asyncio.get_event_loop(), cls.registry_host, cls.registry_port)
+        topology_file = None
+        if cls.topology_cache_dir:
+            _, host_port = service.socket_address
+            topology_file = os.path.join(cls.topology_cache_dir,
+                                         'vyked_{}_{}.topology.json'.format(service.name, host_port))
+        registry_client = RegistryClient(asyncio.get_event_loop(), cls.registry_host, cls.registry_port,
+                                         replicas=cls.registry_replicas, topology_file=topology_file)
         if not cls.ronin:
-            asyncio.get_event_loop().run_until_complete(registry_client.connect())
+            if registry_client.load_topology():
+                asyncio.async(registry_client.connect())
+            else:
+                asyncio.get_event_loop().run_until_complete(registry_client.connect())
         tcp_bus = TCPBus(registry_client)
-        pubsub_bus = PubSubBus(registry_client)
+        outbox_file = None
+        if cls.outbox_dir:
+            outbox_file = os.path.join(cls.outbox_dir,
+                                       'vyked_{}_{}.outbox'.format(service.name, service.socket_address[1]))
+        pubsub_bus = PubSubBus(registry_client, outbox_file=outbox_file)
         registry_client.bus = tcp_bus
+        tcp_bus.pubsub_bus = pubsub_bus
         if isinstance(service, TCPService):
             tcp_bus.tcp_host = service
         if isinstance(service, HTTPService):
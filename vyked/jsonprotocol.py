@@ -21,7 +21,7 @@ class JSONProtocol(asyncio.Protocol):
         self._pending_data = []
 
     @staticmethod
-    def _make_frame(packet):
+    def make_frame(packet):
         string = json.dumps(packet, cls=VykedEncoder) + ','
         return string.encode()
 
@@ -30,7 +30,7 @@ class JSONProtocol(asyncio.Protocol):
 
     def _write_pending_data(self):
         for packet in self._pending_data:
-            frame = self._make_frame(packet)
+            frame = self.make_frame(packet)
             self._transport.write(frame.encode())
         self._pending_data.clear()
 
@@ -51,7 +51,7 @@ class JSONProtocol(asyncio.Protocol):
         self.logger.info('Peer closed %s', self._transport.get_extra_info('peername'))
 
     def send(self, packet: dict):
-        frame = self._make_frame(packet)
+        frame = self.make_frame(packet)
         self._send_q.send(frame)
         if 'ping' in frame.decode() or 'pong' in frame.decode():
             if is_ping_logging_enabled():
@@ -59,6 +59,12 @@ class JSONProtocol(asyncio.Protocol):
         else:
             self.logger.debug('Data sent: %s', frame.decode())
 
+    def send_frame(self, frame: bytes):
+        """
+        Sends a packet already encoded with make_frame, a packet going to many peers is encoded only once
+        """
+        self._send_q.send(frame)
+
     def close(self):
         self._transport.write(']'.encode())  # end the json array
         self._transport.close()
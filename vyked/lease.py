@@ -0,0 +1,88 @@
+import heapq
+import time
+
+DEFAULT_LEASE = 10
+KEEPALIVES_PER_LEASE = 3
+LEASE_CHECK_INTERVAL = 1
+LEADER_LEASE = 0.75  # seconds a LEADER strategy subscriber keeps its leadership without a leader keepalive
+LEADER_CHECK_INTERVAL = 0.1
+LOAD_CHANGE_RATIO = 0.2
+LAG_PER_REQUEST = 10  # milliseconds of event loop lag that count as much as one queued request
+
+
+def load_score(load):
+    """
+    Work a node has queued up according to the load report of its last keepalive
+    """
+    return load.get('in_flight', 0) + load.get('queue', 0) + load.get('lag', 0) / LAG_PER_REQUEST
+
+
+def load_changed(published, load):
+    """
+    Tells if a load report differs enough from the one consumers were last sent to be worth pushing to them
+    """
+    score, published_score = load_score(load), load_score(published)
+    return abs(score - published_score) >= max(1, published_score * LOAD_CHANGE_RATIO)
+
+
+class LeaseTable:
+    """
+    Tracks when the lease of every node expires with a single heap.
+    A renewal only moves the node's expiry in a dict, the heap keeps one entry per node and an entry that surfaces
+    before the node's current expiry is pushed back with it instead of expiring the node.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._durations = {}
+        self._expiries = {}
+        self._heap = []
+
+    def __contains__(self, node_id):
+        return node_id in self._durations
+
+    def __len__(self):
+        return len(self._durations)
+
+    def grant(self, node_id, duration):
+        """
+        Starts a lease of duration seconds for node_id, replacing any lease it had
+        """
+        self._durations[node_id] = duration
+        expiry = self._clock() + duration
+        if node_id not in self._expiries:
+            heapq.heappush(self._heap, (expiry, node_id))
+        self._expiries[node_id] = expiry
+
+    def renew(self, node_id):
+        """
+        :return: False if node_id holds no lease
+        """
+        duration = self._durations.get(node_id)
+        if duration is None:
+            return False
+        self._expiries[node_id] = self._clock() + duration
+        return True
+
+    def revoke(self, node_id):
+        self._durations.pop(node_id, None)
+        self._expiries.pop(node_id, None)
+
+    def expired(self):
+        """
+        Removes the leases that ran out
+        :return: ids of the nodes whose lease expired
+        """
+        now = self._clock()
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            expiry, node_id = heapq.heappop(self._heap)
+            current = self._expiries.get(node_id)
+            if current is None:
+                continue
+            if current > now:
+                heapq.heappush(self._heap, (current, node_id))
+            else:
+                self.revoke(node_id)
+                expired.append(node_id)
+        return expired
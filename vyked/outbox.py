@@ -0,0 +1,205 @@
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+import os
+import random
+import time
+
+from .utils.jsonencoder import VykedEncoder
+
+MAX_ATTEMPTS = 10
+BASE_DELAY = 5
+MAX_DELAY = 300
+ATTEMPT_TIMEOUT = 30
+JITTER = 0.2
+COMPACT_AFTER = 1000
+
+_logger = logging.getLogger(__name__)
+
+
+class Outbox:
+    """
+    Append-only log of the events published but not acked yet, retried by a single dispatcher timer.
+    An event is attempted again with exponential backoff and jitter until it is acked, an attempt finds nobody to
+    deliver it to or it runs out of attempts and goes to the dead letter file. Events left in the log by a previous
+    run are loaded and delivered again.
+    """
+
+    def __init__(self, deliver, path=None, max_attempts=MAX_ATTEMPTS, base_delay=BASE_DELAY, max_delay=MAX_DELAY,
+                 attempt_timeout=ATTEMPT_TIMEOUT, loop=None):
+        """
+        :param deliver: coroutine function making one attempt at delivering an event, returning False if there is
+                        nobody to deliver it to
+        :param path: log file, events are only kept in memory if not given. Dead letters go to path + '.dead'
+        :param attempt_timeout: seconds after which an attempt that hasn't returned counts as failed
+        """
+        self._deliver = deliver
+        self._path = path
+        self._max_attempts = max_attempts
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+        self._attempt_timeout = attempt_timeout
+        self._loop = loop or asyncio.get_event_loop()
+        self._events = {}
+        self._attempts = {}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._timer = None
+        self._timer_due = None
+        self._file = None
+        self._done = 0
+
+    def __contains__(self, event_id):
+        return event_id in self._events
+
+    def __len__(self):
+        return len(self._events)
+
+    def load(self):
+        """
+        Reads back the events a previous run left in the log and compacts it
+        :return: number of events to deliver again
+        """
+        if self._path is None or not os.path.exists(self._path):
+            return 0
+        try:
+            with open(self._path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:  # torn last line of a crash
+                        continue
+                    if record['op'] == 'add':
+                        self._events[record['event']['id']] = record['event']
+                    else:
+                        self._events.pop(record['id'], None)
+        except OSError as e:
+            _logger.warning('Could not read outbox %s: %s', self._path, e)
+            return 0
+        self._compact()
+        for event_id in self._events:
+            self._schedule(event_id, 0)
+        return len(self._events)
+
+    def add(self, event):
+        """
+        Logs an event and schedules its first attempt, event['id'] is what it is acked with
+        """
+        self._events[event['id']] = event
+        self._append({'op': 'add', 'event': event})
+        self._schedule(event['id'], 0)
+
+    def ack(self, event_id):
+        if event_id in self._events:
+            self._remove(event_id)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _schedule(self, event_id, delay):
+        due = self._loop.time() + delay
+        heapq.heappush(self._heap, (due, next(self._sequence), event_id))
+        if self._timer is None or due < self._timer_due:
+            self._arm(due)
+
+    def _arm(self, due):
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer_due = due
+        self._timer = self._loop.call_at(due, self._dispatch)
+
+    def _dispatch(self):
+        self._timer = None
+        now = self._loop.time()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, event_id = heapq.heappop(self._heap)
+            if event_id not in self._events:
+                continue
+            if self._attempts.get(event_id, 0) >= self._max_attempts:
+                self._dead_letter(event_id)
+            else:
+                asyncio.async(self._attempt(event_id), loop=self._loop)
+        if self._heap:
+            self._arm(self._heap[0][0])
+
+    @asyncio.coroutine
+    def _attempt(self, event_id):
+        event = self._events[event_id]
+        attempts = self._attempts.get(event_id, 0) + 1
+        self._attempts[event_id] = attempts
+        try:
+            delivered = yield from asyncio.wait_for(self._deliver(event), self._attempt_timeout)
+        except asyncio.TimeoutError:
+            _logger.info('Attempt %s at delivering %s timed out', attempts, event_id)
+            delivered = None
+        except Exception:
+            _logger.exception('Attempt %s at delivering %s failed', attempts, event_id)
+            delivered = None
+        if event_id not in self._events:  # acked while the attempt was in flight
+            return
+        if delivered is False:
+            self._remove(event_id)
+        else:
+            self._schedule(event_id, self._backoff(attempts))
+
+    def _backoff(self, attempts):
+        delay = min(self._max_delay, self._base_delay * 2 ** (attempts - 1))
+        return delay * random.uniform(1 - JITTER, 1 + JITTER)
+
+    def _dead_letter(self, event_id):
+        event = self._events[event_id]
+        _logger.warning('Giving up on %s after %s attempts', event_id, self._attempts[event_id])
+        if self._path is not None:
+            try:
+                with open(self._path + '.dead', 'a') as f:
+                    f.write(json.dumps(dict(event, attempts=self._attempts[event_id], dead_at=time.time()),
+                                       cls=VykedEncoder) + '\n')
+            except OSError as e:
+                _logger.warning('Could not write dead letter %s: %s', event_id, e)
+        self._remove(event_id)
+
+    def _remove(self, event_id):
+        del self._events[event_id]
+        self._attempts.pop(event_id, None)
+        self._append({'op': 'done', 'id': event_id})
+        self._done += 1
+        if self._done >= COMPACT_AFTER and self._done > len(self._events):
+            self._compact()
+
+    def _append(self, record):
+        if self._path is None:
+            return
+        try:
+            if self._file is None:
+                self._file = open(self._path, 'a')
+            self._file.write(json.dumps(record, cls=VykedEncoder) + '\n')
+            self._file.flush()
+        except OSError as e:
+            _logger.warning('Could not write to outbox %s: %s', self._path, e)
+
+    def _compact(self):
+        """
+        Rewrites the log with only the events still pending
+        """
+        if self._path is None:  # nothing logged, there is only the counter to reset
+            self._done = 0
+            return
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        temp_path = self._path + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                for event in self._events.values():
+                    f.write(json.dumps({'op': 'add', 'event': event}, cls=VykedEncoder) + '\n')
+            os.replace(temp_path, self._path)
+            self._done = 0
+        except OSError as e:
+            _logger.warning('Could not compact outbox %s: %s', self._path, e)
@@ -30,7 +30,8 @@ class _Packet:
 
 class ControlPacket(_Packet):
     @classmethod
-    def registration(cls, ip: str, port: int, node_id, service: str, version: str, vendors, service_type: str):
+    def registration(cls, ip: str, port: int, node_id, service: str, version: str, vendors, service_type: str,
+                     unix_socket: str=None, host_id: str=None, shm_socket: str=None, lease=None):
         v = [{'service': vendor.name, 'version': vendor.version} for vendor in vendors]
 
         params = {'service': service,
@@ -39,7 +40,11 @@ class ControlPacket(_Packet):
                   'port': port,
                   'node_id': node_id,
                   'vendors': v,
-                  'type': service_type}
+                  'type': service_type,
+                  'unix_socket': unix_socket,
+                  'shm_socket': shm_socket,
+                  'host_id': host_id,
+                  'lease': lease}
 
         packet = {'pid': cls._next_pid(), 'type': 'register', 'params': params}
         return packet
@@ -57,8 +62,11 @@ class ControlPacket(_Packet):
         return packet
 
     @classmethod
-    def get_subscribers(cls, service, version, endpoint):
-        params = {'service': service, 'version': version, 'endpoint': endpoint}
+    def get_subscribers(cls, service, version, endpoint, watch=False):
+        """
+        :param watch: have the registry push 'subscribers_changed' packets for the endpoint from now on
+        """
+        params = {'service': service, 'version': version, 'endpoint': endpoint, 'watch': watch}
         packet = {'pid': cls._next_pid(),
                   'type': 'get_subscribers',
                   'params': params,
@@ -80,28 +88,77 @@ class ControlPacket(_Packet):
         return packet
 
     @classmethod
-    def activated(cls, instances):
+    def activated(cls, instances, node_info=None, topology_version=0, node_id=None):
+        """
+        :param node_id: the activated node, lets a connection carrying several nodes tell them apart
+        """
+        params = {
+            'vendors': cls._vendors(instances, node_info or {}),
+            'topology_version': topology_version,
+            'node_id': node_id
+        }
+        packet = {'pid': cls._next_pid(),
+                  'type': 'registered',
+                  'params': params}
+        return packet
+
+    @classmethod
+    def topology_snapshot(cls, instances, node_info, topology_version):
+        params = {'vendors': cls._vendors(instances, node_info), 'topology_version': topology_version}
+        return {'pid': cls._next_pid(), 'type': 'topology_snapshot', 'params': params}
+
+    @classmethod
+    def topology(cls, topology_version, changes):
+        """
+        :param changes: list of {'op': 'added' | 'removed' | 'weight' | 'load', 'service', 'version', 'node'} dicts
+        """
+        params = {'topology_version': topology_version, 'changes': changes}
+        return {'pid': cls._next_pid(), 'type': 'topology', 'params': params}
+
+    @classmethod
+    def keepalive(cls, node_ids, loads=None):
+        """
+        :param loads: optional {node_id: {'in_flight', 'queue', 'lag'}} load reports of the nodes
+        """
+        packet = {'pid': cls._next_pid(), 'type': 'keepalive', 'node_ids': node_ids}
+        if loads:
+            packet['loads'] = loads
+        return packet
+
+    @classmethod
+    def leader_keepalive(cls, node_ids):
+        return {'pid': cls._next_pid(), 'type': 'leader_keepalive', 'node_ids': node_ids}
+
+    @classmethod
+    def resync(cls, node_id):
+        return {'pid': cls._next_pid(), 'type': 'resync', 'node_id': node_id}
+
+    @classmethod
+    def set_weight(cls, node_id, weight):
+        return {'pid': cls._next_pid(), 'type': 'set_weight', 'params': {'node_id': node_id, 'weight': weight}}
+
+    @staticmethod
+    def node(host, port, node_id, service_type, node_info=None):
+        node = {
+            'host': host,
+            'port': port,
+            'node_id': node_id,
+            'type': service_type
+        }
+        node.update(node_info or {})
+        return node
+
+    @classmethod
+    def _vendors(cls, instances, node_info):
         vendors_packet = []
         for k, v in instances.items():
             vendor_packet = defaultdict(list)
             vendor_packet['name'] = k[0]
             vendor_packet['version'] = k[1]
             for host, port, node, service_type in v:
-                vendor_node_packet = {
-                    'host': host,
-                    'port': port,
-                    'node_id': node,
-                    'type': service_type
-                }
-                vendor_packet['addresses'].append(vendor_node_packet)
+                vendor_packet['addresses'].append(cls.node(host, port, node, service_type, node_info.get(node)))
             vendors_packet.append(vendor_packet)
-        params = {
-            'vendors': vendors_packet
-        }
-        packet = {'pid': cls._next_pid(),
-                  'type': 'registered',
-                  'params': params}
-        return packet
+        return vendors_packet
 
     @classmethod
     def xsubscribe(cls, service, version, host, port, node_id, endpoints):
@@ -115,17 +172,89 @@ class ControlPacket(_Packet):
         return packet
 
     @classmethod
-    def subscribers(cls, service, version, endpoint, request_id, subscribers):
-        params = {'service': service, 'version': version, 'endpoint': endpoint}
-        subscribers = [{'service': service, 'version': version, 'host': host, 'port': port, 'node_id': node_id,
-                        'strategy': strategy} for service, version, host, port, node_id, strategy in subscribers]
-        params['subscribers'] = subscribers
+    def subscribers(cls, service, version, endpoint, request_id, subscribers, leaders=()):
         packet = {'pid': cls._next_pid(),
                   'request_id': request_id,
                   'type': 'subscribers',
-                  'params': params}
+                  'params': cls._subscriber_params(service, version, endpoint, subscribers, leaders)}
         return packet
 
+    @classmethod
+    def subscribers_changed(cls, service, version, endpoint, subscribers, leaders=()):
+        return {'pid': cls._next_pid(), 'type': 'subscribers_changed',
+                'params': cls._subscriber_params(service, version, endpoint, subscribers, leaders)}
+
+    @staticmethod
+    def _subscriber_params(service, version, endpoint, subscribers, leaders):
+        params = {'service': service, 'version': version, 'endpoint': endpoint}
+        subscribers = [{'service': service, 'version': version, 'host': host, 'port': port, 'node_id': node_id,
+                        'strategy': strategy, 'leader': node_id in leaders}
+                       for service, version, host, port, node_id, strategy in subscribers]
+        params['subscribers'] = subscribers
+        return params
+
+    @classmethod
+    def not_primary(cls, host, port):
+        return {'pid': cls._next_pid(), 'type': 'not_primary', 'host': host, 'port': port}
+
+    @classmethod
+    def replicate(cls, host, port):
+        params = {'host': host, 'port': port}
+        return {'pid': cls._next_pid(), 'type': 'replicate', 'params': params}
+
+    @classmethod
+    def replica_snapshot(cls, entries):
+        return {'pid': cls._next_pid(), 'type': 'replica_snapshot', 'params': {'entries': entries}}
+
+    @classmethod
+    def replicated(cls, op, params):
+        return {'pid': cls._next_pid(), 'type': 'replicated', 'params': {'op': op, 'params': params}}
+
+    @classmethod
+    def lease(cls, duration, replicas):
+        params = {'duration': duration, 'replicas': replicas}
+        return {'pid': cls._next_pid(), 'type': 'lease', 'params': params}
+
+    @classmethod
+    def lease_ack(cls):
+        return {'pid': cls._next_pid(), 'type': 'lease_ack'}
+
+    @classmethod
+    def wrong_shard(cls, shards, packet):
+        """
+        :param packet: the misrouted request, for the client to send on to the shard owning it
+        """
+        return {'pid': cls._next_pid(), 'type': 'wrong_shard', 'shards': shards, 'packet': packet}
+
+    @classmethod
+    def watch_service(cls, service):
+        return {'pid': cls._next_pid(), 'type': 'watch_service', 'params': {'service': service}}
+
+    @classmethod
+    def service_nodes(cls, service, nodes):
+        """
+        :param nodes: (version, node) pairs, node shaped like the nodes of topology changes
+        """
+        params = {'service': service, 'nodes': [{'version': version, 'node': node} for version, node in nodes]}
+        return {'pid': cls._next_pid(), 'type': 'service_nodes', 'params': params}
+
+    @classmethod
+    def shard_update(cls, service, version, change):
+        params = {'service': service, 'version': version, 'change': change}
+        return {'pid': cls._next_pid(), 'type': 'shard_update', 'params': params}
+
+    @classmethod
+    def channel_subscribe(cls, channels, patterns=()):
+        return {'pid': cls._next_pid(), 'type': 'channel_subscribe', 'channels': channels, 'patterns': list(patterns)}
+
+    @classmethod
+    def channel_publish(cls, channel, payload):
+        return {'pid': cls._next_pid(), 'type': 'channel_publish', 'channel': channel, 'payload': payload}
+
+    @classmethod
+    def channel_message(cls, channel, payload):
+        return {'pid': cls._next_pid(), 'type': 'channel_message', 'channel': channel, 'payload': payload}
+
 
 class MessagePacket(_Packet):
     @classmethod
@@ -25,6 +25,7 @@ class Pinger:
         self._timeout = timeout
         self._loop = loop
         self._timer = None
+        self._stopped = False
 
     @asyncio.coroutine
     def send_ping(self):
@@ -32,8 +33,9 @@ class Pinger:
         Sends the ping after the interval specified when initializing
         """
         yield from asyncio.sleep(self._interval)
-        self._handler.send_ping()
-        self._start_timer()
+        if not self._stopped:
+            self._handler.send_ping()
+            self._start_timer()
 
     def pong_received(self):
         """
@@ -42,6 +44,14 @@ class Pinger:
         self._timer.cancel()
         asyncio.async(self.send_ping())
 
+    def stop(self):
+        """
+        Stops pinging, no timeout is reported after this
+        """
+        self._stopped = True
+        if self._timer is not None:
+            self._timer.cancel()
+
     def _start_timer(self):
         self._timer = self._loop.call_later(self._timeout, self._on_timeout)
 
@@ -68,6 +78,9 @@ class TCPPinger:
     def pong_received(self):
         self._pinger.pong_received()
 
+    def stop(self):
+        self._pinger.stop()
+
 
 class HTTPPinger:
     def __init__(self, node_id, host, port, handler):
@@ -84,8 +97,10 @@ class HTTPPinger:
 
     def ping_coroutine(self):
         res = yield from request('get', self._url)
-        if res.status == 200:
-            self.pong_received()
+        try:
+            if res.status == 200:
+                self.pong_received()
+        finally:
             res.close()
 
     def on_timeout(self):
@@ -1,34 +1,62 @@
 import logging
 import asyncio
+import zlib
 
 import asyncio_redis as redis
 
+MAX_PENDING_PUBLISHES = 10000
+PUBLISH_CONNECTIONS = 4
+SUBSCRIBE_SHARDS = 4
+SHARD_QUEUE_SIZE = 1000
+
+
+def channel_shard(channel, shards):
+    return zlib.crc32(channel.encode()) % shards
+
 
 class PubSub:
     """
     Pub sub handler which uses redis.
-    Can be used to publish an event or subscribe to a list of endpoints
+    Can be used to publish an event or subscribe to a list of endpoints.
+    Channels are spread by hash over several publish connections. Publishes to the channels of a connection made in
+    the same event loop tick are sent to redis as one pipelined batch, one batch at a time, so a channel keeps the
+    order of its publishes while the other connections carry other channels. Subscriptions are spread over
+    connections the same way, each with its own queue of received messages and its own worker.
     """
     _logger = logging.getLogger(__name__)
 
-    def __init__(self, redis_host, redis_port):
+    def __init__(self, redis_host, redis_port, max_pending=MAX_PENDING_PUBLISHES, connections=PUBLISH_CONNECTIONS,
+                 shards=SUBSCRIBE_SHARDS, shard_queue_size=SHARD_QUEUE_SIZE):
         """
         Create in instance of Pub Sub handler
         :param str redis_host: Redis Host address
         :param redis_port: Redis port number
+        :param max_pending: publishes buffered or in flight before publish waits for a batch to go out
+        :param connections: connections publishes are sent on
+        :param shards: connections subscriptions are spread over
+        :param shard_queue_size: messages a subscription connection buffers before it stops reading from redis
         """
         self._redis_host = redis_host
         self._redis_port = redis_port
-        self._conn = None
+        self._conns = [None] * connections
+        self._max_pending = max_pending
+        self._pending = [[] for _ in range(connections)]
+        self._sending = [False] * connections
+        self._queued = 0
+        self._room = asyncio.Event()
+        self._room.set()
+        self._shards = shards
+        self._shard_queue_size = shard_queue_size
 
     @asyncio.coroutine
     def connect(self):
         """
-        Connect to the redis server and return the connection
+        Connect the publish connections to the redis server and return the first one
         :return:
         """
-        self._conn = yield from self._get_conn()
-        return self._conn
+        for index in range(len(self._conns)):
+            self._conns[index] = yield from self._get_conn()
+        return self._conns[0]
 
     @asyncio.coroutine
     def publish(self, endpoint: str, payload: str):
@@ -39,16 +67,64 @@ class PubSub:
         :param str payload: Payload to publish with the event
         :return: A boolean indicating if the publish was successful
         """
-        if self._conn is not None:
-            try:
-                yield from self._conn.publish(endpoint, payload)
-                return True
-            except redis.Error as e:
-                self._logger.error('Publish failed with error %s', repr(e))
-        return False
+        while self._queued >= self._max_pending:
+            self._room.clear()
+            yield from self._room.wait()
+        index = channel_shard(endpoint, len(self._conns))
+        result = asyncio.Future()
+        self._pending[index].append((endpoint, payload, result))
+        self._queued += 1
+        if not self._sending[index]:
+            self._sending[index] = True
+            asyncio.async(self._send_batches(index))
+        return (yield from result)
 
     @asyncio.coroutine
-    def subscribe(self, endpoints: list, handler):
+    def _send_batches(self, index):
+        batch = []
+        try:
+            while self._pending[index]:
+                batch, self._pending[index] = self._pending[index], []
+                try:
+                    published = yield from self._send_batch(self._conns[index], batch)
+                except Exception:
+                    self._logger.exception('Publish of %s events failed', len(batch))
+                    published = False
+                self._settle(batch, published)
+                batch = []
+        finally:
+            self._settle(batch, False)
+            self._sending[index] = False
+
+    def _settle(self, batch, published):
+        for _, _, result in batch:
+            if not result.done():
+                result.set_result(published)
+        self._queued -= len(batch)
+        self._room.set()
+
+    @asyncio.coroutine
+    def _send_batch(self, conn, batch):
+        """
+        Sends a batch of publishes pipelined in one MULTI/EXEC transaction
+        """
+        if conn is None:
+            return False
+        try:
+            transaction = yield from conn.multi()
+            # every publish is written before waiting for any QUEUED reply, one round trip for the whole batch
+            queued = [asyncio.async(transaction.publish(endpoint, payload)) for endpoint, payload, _ in batch]
+            for reply in (yield from asyncio.gather(*queued, return_exceptions=True)):
+                if isinstance(reply, Exception):
+                    raise reply
+            yield from transaction.exec()
+            return True
+        except redis.Error as e:
+            self._logger.error('Publish of %s events failed with error %s', len(batch), repr(e))
+            return False
+
+    @asyncio.coroutine
+    def subscribe(self, endpoints: list, handler, patterns=()):
         """
         Subscribe to a list of endpoints
         :param endpoints: List of endpoints the subscribers is interested to subscribe to
@@ -56,15 +132,43 @@ class PubSub:
         :param handler: The callback to call when a particular event is published.
                         Must take two arguments, a channel to which the event was published
                         and the payload.
+        :param patterns: glob style channel patterns like 'service/*/endpoint' subscribed to with PSUBSCRIBE
         :return:
         """
+        shards = [([], []) for _ in range(self._shards)]
+        for endpoint in endpoints:
+            shards[channel_shard(endpoint, self._shards)][0].append(endpoint)
+        for pattern in patterns:
+            shards[channel_shard(pattern, self._shards)][1].append(pattern)
+        yield from asyncio.gather(*(self._subscribe_shard(channels, shard_patterns, handler)
+                                    for channels, shard_patterns in shards if channels or shard_patterns))
+        return False
+
+    @asyncio.coroutine
+    def _subscribe_shard(self, endpoints, patterns, handler):
         connection = yield from self._get_conn()
         subscriber = yield from connection.start_subscribe()
-        yield from subscriber.subscribe(endpoints)
+        if endpoints:
+            yield from subscriber.subscribe(endpoints)
+        if patterns:
+            yield from subscriber.psubscribe(patterns)
+        queue = asyncio.Queue(maxsize=self._shard_queue_size)
+        worker = asyncio.async(self._handle_shard(queue, handler))
+        try:
+            while True:
+                payload = yield from subscriber.next_published()
+                yield from queue.put((payload.channel, payload.value))
+        finally:
+            worker.cancel()
+
+    @asyncio.coroutine
+    def _handle_shard(self, queue, handler):
         while True:
-            payload = yield from subscriber.next_published()
-            handler(payload.channel, payload.value)
-        return False
+            channel, value = yield from queue.get()
+            try:
+                handler(channel, value)
+            except Exception:
+                self._logger.exception('Handling a publication on %s failed', channel)
 
     def _get_conn(self):
         return (yield from redis.Connection.create(self._redis_host, self._redis_port, auto_reconnect=True))
@@ -1,39 +1,126 @@
 import logging
 import signal
 import asyncio
+import zlib
 from functools import partial
 from collections import defaultdict, namedtuple
-from again.utils import natural_sort
 
 from .utils.log import config_logs
 from .packet import ControlPacket
 from .protocol_factory import get_vyked_protocol
-from .pinger import TCPPinger, HTTPPinger
+from .pinger import TCPPinger, PING_INTERVAL, PING_TIMEOUT
+from .health import HTTPHealthChecker
+from .broker import Broker
+from .lease import LeaseTable, LEASE_CHECK_INTERVAL, LEADER_LEASE, LEADER_CHECK_INTERVAL, load_changed
+from .registry_store import RepositoryStore
+from .sharding import shard_of
+from .versions import VersionIndex
 from .utils.log import setup_logging
 
-Service = namedtuple('Service', ['name', 'version', 'dependencies', 'host', 'port', 'node_id', 'type'])
+Service = namedtuple('Service', ['name', 'version', 'dependencies', 'host', 'port', 'node_id', 'type', 'unix_socket',
+                                 'host_id', 'shm_socket', 'lease'])
+Service.__new__.__defaults__ = (None, None, None, None)
+
+REPLICATION_LEASE = 3
+SHARD_RETRY_INTERVAL = 5
+PRIMARY_REQUESTS = ('register', 'xsubscribe', 'replicate', 'resync', 'set_weight', 'keepalive', 'leader_keepalive',
+                    'watch_service')
+
+
+def service_from_params(params: dict):
+    return Service(params['service'], params['version'], params['vendors'], params['host'], params['port'],
+                   params['node_id'], params['type'], params.get('unix_socket'), params.get('host_id'),
+                   params.get('shm_socket'), params.get('lease'))
+
 
 logger = logging.getLogger(__name__)
 
 
+def leader_rank(service, version, endpoint, epoch, node_id):
+    """
+    Rendezvous hash of a node for the leadership of an endpoint, the subscriber node ranking highest leads
+    """
+    return zlib.crc32('{}/{}/{}/{}/{}'.format(service, version, endpoint, epoch, node_id).encode())
+
+
 class Repository:
+    """
+    Holds the registered services, their dependencies and xsubscriptions.
+    Nodes are indexed by node id and vendors by their consumers, both indexes are updated on every mutation.
+    Every pending service keeps the set of its vendors that have no tcp instance yet, so a vendor change only
+    re-evaluates its direct dependants.
+    The versions of a service with instances are kept in a VersionIndex that caches how dependencies resolve.
+    """
+
     def __init__(self):
         self._registered_services = defaultdict(lambda: defaultdict(list))
         self._pending_services = defaultdict(list)
         self._service_dependencies = {}
         self._subscribe_list = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+        self._local_addresses = {}
+        self._nodes = {}
+        self._consumers = defaultdict(set)
+        self._dependants = defaultdict(set)
+        self._unsatisfied = {}
+        self._node_subscriptions = defaultdict(list)
+        self._weights = {}
+        self._leases = {}
+        self._version_indexes = defaultdict(VersionIndex)
+        self._leaders = defaultdict(dict)  # (service, version, endpoint) -> {(service, version): leader node id}
 
     def register_service(self, service: Service):
         service_name = self._get_full_service_name(service.name, service.version)
         service_entry = (service.host, service.port, service.node_id, service.type)
         self._registered_services[service.name][service.version].append(service_entry)
-        self._pending_services[service_name].append(service.node_id)
+        self._version_indexes[service.name].add(service.version)
+        self._nodes[service.node_id] = (service.name, service.version, service_entry)
+        if service.unix_socket is not None or service.shm_socket is not None:
+            self._local_addresses[service.node_id] = {'host_id': service.host_id, 'unix_socket': service.unix_socket,
+                                                      'shm_socket': service.shm_socket}
+        if service.lease:
+            self._leases[service.node_id] = service.lease
         if len(service.dependencies):
             if self._service_dependencies.get(service_name) is None:
                 self._service_dependencies[service_name] = service.dependencies
+                for vendor in service.dependencies:
+                    self._consumers[(vendor['service'], vendor['version'])].add((service.name, service.version))
+                    self._dependants[vendor['service']].add((service.name, service.version))
+        self.add_pending_service(service.name, service.version, service.node_id)
 
     def add_pending_service(self, service, version, node_id):
-        self._pending_services[self._get_full_service_name(service, version)].append(node_id)
+        service_name = self._get_full_service_name(service, version)
+        self._pending_services[service_name].append(node_id)
+        if service_name not in self._unsatisfied:
+            self._unsatisfied[service_name] = {(vendor['service'], vendor['version']) for vendor in
+                                               self.get_vendors(service, version) if not self._is_available(vendor)}
+
+    def get_unsatisfied_vendors(self, service, version):
+        return self._unsatisfied.get(self._get_full_service_name(service, version), set())
+
+    def update_dependants(self, vendor_name):
+        """
+        Re-evaluates the pending services that depend on vendor_name, to be called when its instances change
+        :return: the pending services that have no unsatisfied vendors left
+        """
+        ready = []
+        for service, version in self._dependants.get(vendor_name, ()):
+            service_name = self._get_full_service_name(service, version)
+            if service_name in self._unsatisfied:
+                unsatisfied = {vendor for vendor in self._unsatisfied[service_name] if vendor[0] != vendor_name}
+                unsatisfied.update((vendor['service'], vendor['version'])
+                                   for vendor in self.get_vendors(service, version)
+                                   if vendor['service'] == vendor_name and not self._is_available(vendor))
+                self._unsatisfied[service_name] = unsatisfied
+                if not unsatisfied:
+                    ready.append((service, version))
+        return ready
+
+    def get_dependants(self, vendor_name):
+        return set(self._dependants.get(vendor_name, ()))
+
+    def _is_available(self, vendor):
+        instances = self.get_versioned_instances(vendor['service'], vendor['version'])
+        return any(instance[3] == 'tcp' for instance in instances)
 
     def get_pending_services(self):
         return [self._split_key(k) for k in self._pending_services.keys()]
@@ -45,63 +132,180 @@ class Repository:
         self.get_pending_instances(service, version).remove(node_id)
         if not len(self.get_pending_instances(service, version)):
             self._pending_services.pop(self._get_full_service_name(service, version))
+            self._unsatisfied.pop(self._get_full_service_name(service, version), None)
 
     def get_instances(self, service, version):
         return self._registered_services[service][version]
 
+    def get_versions(self, service):
+        """
+        :return: {version: instances} of every registered version of service
+        """
+        return {version: list(instances) for version, instances in self._registered_services.get(service, {}).items()}
+
     def get_versioned_instances(self, service, version):
-        version = self._get_non_breaking_version(version, list(self._registered_services[service].keys()))
-        return self._registered_services[service][version]
+        return self._registered_services[service][self.resolve_version(service, version)]
+
+    def resolve_version(self, service, version):
+        """
+        :param version: a version or a requirement like '~1.2' or '>=1.2,<2', see versions.parse_range
+        :return: the registered version of service that serves consumers depending on version
+        """
+        index = self._version_indexes.get(service)
+        resolved = index.resolve(version) if index is not None else None
+        return version if resolved is None else resolved
 
     def get_consumers(self, service_name, service_version):
-        consumers = set()
-        for service, vendors in self._service_dependencies.items():
-            for each in vendors:
-                if each['service'] == service_name and each['version'] == service_version:
-                    consumers.add(self._split_key(service))
-        return consumers
+        return set(self._consumers.get((service_name, service_version), ()))
 
     def get_vendors(self, service, version):
         return self._service_dependencies.get(self._get_full_service_name(service, version), [])
 
     def get_node(self, node_id):
-        for name, versions in self._registered_services.items():
-            for version, instances in versions.items():
-                for host, port, node, service_type in instances:
-                    if node_id == node:
-                        return Service(name, version, [], host, port, node, service_type)
-        return None
+        if node_id not in self._nodes:
+            return None
+        name, version, (host, port, node, service_type) = self._nodes[node_id]
+        local = self._local_addresses.get(node, {})
+        return Service(name, version, [], host, port, node, service_type, local.get('unix_socket'),
+                       local.get('host_id'), local.get('shm_socket'), self._leases.get(node))
+
+    def get_nodes(self):
+        return [self.get_node(node_id) for node_id in self._nodes]
+
+    def get_weight(self, node_id):
+        return self._weights.get(node_id, 1)
+
+    def set_weight(self, node_id, weight):
+        if node_id in self._nodes:
+            self._weights[node_id] = weight
+
+    def get_local_address(self, node_id):
+        """
+        :return: the host id and socket paths of a node reachable without tcp from its own host, None otherwise
+        """
+        return self._local_addresses.get(node_id)
 
     def remove_node(self, node_id):
-        for name, versions in self._registered_services.items():
-            for version, instances in versions.items():
-                for instance in instances:
-                    host, port, node, service_type = instance
-                    if node_id == node:
-                        instances.remove(instance)
+        if node_id in self._nodes:
+            name, version, entry = self._nodes.pop(node_id)
+            self._registered_services[name][version].remove(entry)
+            if not self._registered_services[name][version]:
+                self._version_indexes[name].remove(version)
+            if node_id in self.get_pending_instances(name, version):
+                self.remove_pending_instance(name, version, node_id)
+        self._local_addresses.pop(node_id, None)
+        self._weights.pop(node_id, None)
+        self._leases.pop(node_id, None)
+        for service, version, endpoint in self._node_subscriptions.pop(node_id, ()):
+            subscribers = self._subscribe_list[service][version][endpoint]
+            subscribers[:] = [subscriber for subscriber in subscribers if subscriber[4] != node_id]
+            leaders = self._leaders.get((service, version, endpoint), {})
+            for subscriber, leader in list(leaders.items()):
+                if leader == node_id:
+                    del leaders[subscriber]
         return None
 
     def xsubscribe(self, service, version, host, port, node_id, endpoints):
         entry = (service, version, host, port, node_id)
         for endpoint in endpoints:
+            if (endpoint['service'], endpoint['version'], endpoint['endpoint']) in self._node_subscriptions[node_id]:
+                continue
             self._subscribe_list[endpoint['service']][endpoint['version']][endpoint['endpoint']].append(
                 entry + (endpoint['strategy'],))
+            self._node_subscriptions[node_id].append((endpoint['service'], endpoint['version'], endpoint['endpoint']))
 
     def get_subscribers(self, service, version, endpoint):
         return self._subscribe_list[service][version][endpoint]
 
-    def _get_non_breaking_version(self, version, versions):
-        if version in versions:
-            return version
-        versions.sort(key=natural_sort, reverse=True)
-        for v in versions:
-            if self._is_non_breaking(v, version):
-                return v
-        return version
+    def get_subscriber_services(self):
+        """
+        :return: names of the services with a node subscribed to some endpoint
+        """
+        return {subscriber[0] for versions in self._subscribe_list.values() for endpoints in versions.values()
+                for subscribers in endpoints.values() for subscriber in subscribers}
 
-    @staticmethod
-    def _is_non_breaking(v, version):
-        return version.split('.')[0] == v.split('.')[0]
+    def get_node_subscriptions(self, node_id):
+        """
+        :return: the (service, version, endpoint) keys node_id is subscribed to
+        """
+        return list(self._node_subscriptions.get(node_id, ()))
+
+    def get_leader_endpoints(self):
+        """
+        :return: the (service, version, endpoint) keys with a node subscribed with the LEADER strategy
+        """
+        return [(service, version, endpoint) for service, versions in self._subscribe_list.items()
+                for version, endpoints in versions.items() for endpoint, subscribers in endpoints.items()
+                if any(subscriber[5] == 'LEADER' for subscriber in subscribers)]
+
+    def get_leaders(self, service, version, endpoint):
+        """
+        :return: {(subscriber service, subscriber version): node id of its leader} for endpoint
+        """
+        return dict(self._leaders.get((service, version, endpoint), {}))
+
+    def set_leader(self, service, version, endpoint, subscriber_service, subscriber_version, node_id):
+        """
+        :param node_id: the new leader, None for none
+        """
+        leaders = self._leaders[(service, version, endpoint)]
+        if node_id is None:
+            leaders.pop((subscriber_service, subscriber_version), None)
+        else:
+            leaders[(subscriber_service, subscriber_version)] = node_id
+
+    def apply(self, op, params):
+        """
+        Applies a journaled operation, params are shaped like the params of the corresponding packet
+        """
+        if op == 'register':
+            self.register_service(service_from_params(params))
+        elif op == 'remove':
+            self.remove_node(params['node_id'])
+        elif op == 'xsubscribe':
+            self.xsubscribe(params['service'], params['version'], params['host'], params['port'], params['node_id'],
+                            params['events'])
+        elif op == 'weight':
+            self.set_weight(params['node_id'], params['weight'])
+        elif op == 'leader':
+            self.set_leader(params['service'], params['version'], params['endpoint'], params['subscriber_service'],
+                            params['subscriber_version'], params['node_id'])
+
+    def dump(self, exclude=()):
+        """
+        :param exclude: ids of nodes to leave out, the nodes a shard mirrors from the shards owning them
+        :return: (operation, params) pairs that rebuild the registered nodes and subscriptions when applied
+        """
+        entries = []
+        for service in self.get_nodes():
+            if service.node_id in exclude:
+                continue
+            params = {'service': service.name, 'version': service.version, 'host': service.host,
+                      'port': service.port, 'node_id': service.node_id, 'type': service.type,
+                      'vendors': self.get_vendors(service.name, service.version),
+                      'unix_socket': service.unix_socket, 'host_id': service.host_id,
+                      'shm_socket': service.shm_socket, 'lease': service.lease}
+            entries.append(('register', params))
+            if self.get_weight(service.node_id) != 1:
+                entries.append(('weight', {'node_id': service.node_id, 'weight': self.get_weight(service.node_id)}))
+        subscriptions = {}
+        for publisher, versions in self._subscribe_list.items():
+            for publisher_version, endpoints in versions.items():
+                for endpoint, subscribers in endpoints.items():
+                    for service, version, host, port, node_id, strategy in subscribers:
+                        params = subscriptions.setdefault(node_id, {'service': service, 'version': version,
+                                                                    'host': host, 'port': port, 'node_id': node_id,
+                                                                    'events': []})
+                        params['events'].append({'service': publisher, 'version': publisher_version,
+                                                 'endpoint': endpoint, 'strategy': strategy})
+        entries.extend(('xsubscribe', params) for params in subscriptions.values())
+        for (service, version, endpoint), leaders in self._leaders.items():
+            for (subscriber_service, subscriber_version), node_id in leaders.items():
+                if node_id not in exclude:
+                    entries.append(('leader', {'service': service, 'version': version, 'endpoint': endpoint,
+                                               'subscriber_service': subscriber_service,
+                                               'subscriber_version': subscriber_version, 'node_id': node_id}))
+        return entries
 
     @staticmethod
     def _get_full_service_name(service: str, version):
@@ -113,21 +317,97 @@ class Repository:
 
 
 class Registry:
-    def __init__(self, ip, port, repository):
+    """
+    A registry is either the primary, which accepts registrations and heartbeats its nodes, or a replica.
+    Nodes that register with a lease send keepalives and expire when they stop, the others are pinged.
+    The primary streams every journaled change to its replicas and renews their lease, replicas answer reads and
+    the first replica in the primary's list promotes itself once the lease expires, the others follow it. The primary
+    holds a lease of its own that the first replica renews by acking leases, once half of it went by without an ack
+    that replica may take over, so the primary steps down and follows its replicas rather than keep taking writes.
+    A sharded registry owns the services whose name hashes to its shard and bounces requests for the others. It
+    mirrors the nodes of services owned elsewhere that its own services depend on or subscribe to, the owning shard
+    forwards every topology change of a watched service.
+    Every service subscribed to an endpoint with the LEADER strategy has a leader among its subscribed nodes. LEADER
+    subscribers hold a leader lease of LEADER_LEASE seconds they renew with leader keepalives, and the primary keeps
+    a leader while its lease lives. Once it lapses the candidate with a live lease that ranks highest by rendezvous
+    hashing takes over, so leaderships of a service spread over its nodes and failover takes under a second. The
+    primary journals every election to its replicas, and a promoted primary keeps the replicated leaders until their
+    nodes had the time to renew their leases with it. With leader_term set, leaderships are re-ranked every
+    leader_term seconds. Leadership changes are pushed to the publishers watching the endpoint's subscribers.
+    """
+
+    def __init__(self, ip, port, repository, store=None, primary=None, lease=REPLICATION_LEASE, health_checker=None,
+                 shards=None, shard_index=0, broker_port=None, leader_term=None):
+        """
+        :param store: optional RepositoryStore, the repository is restored from it on start and journaled to it
+        :param primary: (host, port) of the primary registry to replicate, None to start as the primary
+        :param lease: seconds a replica waits for the primary to renew its lease before failing over
+        :param health_checker: HTTPHealthChecker for http nodes that register without a lease, a default one if None
+        :param shards: (host, port) of the primary of every registry shard, None for a single registry
+        :param shard_index: position of this registry's shard in shards
+        :param broker_port: port to host a pub sub Broker on in the registry process, no broker if None
+        :param leader_term: seconds after which leaderships rotate, leaders don't rotate if None
+        """
         self._ip = ip
         self._port = port
         self._loop = asyncio.get_event_loop()
         self._client_protocols = {}
         self._service_protocols = {}
         self._repository = repository
+        self._store = store
+        self._broker_port = broker_port
+        self._leader_term = leader_term
         self._pingers = {}
+        self._leases = LeaseTable()
+        self._leader_leases = LeaseTable()
+        self._leader_epoch = 0
+        self._leader_grace = 0
+        self._loads = {}
+        self._subscriber_watchers = defaultdict(set)
+        self._changed_subscriptions = set()
+        self._health_checker = health_checker or HTTPHealthChecker()
+        self._pending_activations = defaultdict(list)
+        self._topology_changes = defaultdict(list)
+        self._topology_versions = {}
+        self._updates_scheduled = False
+        self._primary = primary
+        self._primary_protocol = None
+        self._address = (ip, port) if ip else None
+        self._lease = lease
+        self._lease_timer = None
+        self._replica_protocols = []
+        self._replicas = []
+        self._successor = None
+        self._successor_ack = 0
+        self._primary_timers = {}
+        self._shards = [tuple(shard) for shard in shards] if shards else None
+        self._shard_index = shard_index
+        self._shard_protocols = {}
+        self._connecting_shards = set()
+        self._shard_watchers = defaultdict(set)
+        self._watched = set()
+        self._mirrored = set()
 
     def start(self):
         setup_logging("registry")
         self._loop.add_signal_handler(getattr(signal, 'SIGINT'), partial(self._stop, 'SIGINT'))
         self._loop.add_signal_handler(getattr(signal, 'SIGTERM'), partial(self._stop, 'SIGTERM'))
+        if self._store is not None:
+            self._restore()
         registry_coroutine = self._loop.create_server(partial(get_vyked_protocol, self), self._ip, self._port)
         server = self._loop.run_until_complete(registry_coroutine)
+        broker_server = None
+        if self._broker_port is not None:
+            broker_server = self._loop.run_until_complete(Broker().serve(self._ip, self._broker_port, self._loop))
+        if self.is_primary:
+            self._send_leases()
+            self._expire_leases()
+            self._expire_leader_leases()
+            self._watch_foreign_services()
+        else:
+            asyncio.async(self._follow([self._primary]))
+        if self._leader_term:
+            self._schedule_leader_rotation()
         try:
             self._loop.run_forever()
         except Exception as e:
@@ -135,15 +415,376 @@ class Registry:
         finally:
             server.close()
             self._loop.run_until_complete(server.wait_closed())
+            if broker_server is not None:
+                broker_server.close()
+                self._loop.run_until_complete(broker_server.wait_closed())
+            if self._store is not None:
+                self._store.snapshot(self._repository.dump(exclude=self._mirrored))
+                self._store.close()
+            self._health_checker.close()
             self._loop.close()
 
     def _stop(self, signame: str):
         print('\ngot signal {} - exiting'.format(signame))
         self._loop.stop()
 
+    @property
+    def is_primary(self):
+        return self._primary is None
+
+    def _restore(self):
+        """
+        Rebuilds the topology from the store, restored nodes are then re-validated through heartbeats
+        """
+        self._load(self._store.load())
+        if self.is_primary:
+            self._validate_nodes()
+        self._loop.call_later(self._store.snapshot_interval, self._take_snapshot)
+
+    def _load(self, entries):
+        for op, params in entries:
+            self._repository.apply(op, params)
+        for service, version in self._repository.get_pending_services():
+            if not self._repository.get_unsatisfied_vendors(service, version):
+                for node in list(self._repository.get_pending_instances(service, version)):
+                    self._repository.remove_pending_instance(service, version, node)
+
+    def _validate_nodes(self):
+        nodes = self._repository.get_nodes()
+        for node in nodes:
+            if node.lease:  # a grace lease long enough for the node to notice the old registry is gone
+                self._leases.grant(node.node_id, node.lease + PING_INTERVAL + PING_TIMEOUT)
+            else:
+                self._connect_to_service(node.host, node.port, node.node_id, node.type)
+        logger.info('Validating %s nodes through heartbeats', len(nodes))
+        # leaders keep leading until they had the time to find this registry and renew their leader lease with it
+        grace = LEADER_LEASE + PING_INTERVAL + PING_TIMEOUT
+        self._leader_grace = self._loop.time() + grace
+        self._loop.call_later(grace, self._end_leader_grace)
+
+    def _take_snapshot(self):
+        self._store.snapshot(self._repository.dump(exclude=self._mirrored))
+        self._loop.call_later(self._store.snapshot_interval, self._take_snapshot)
+
+    def _journal(self, op, params):
+        if self._store is not None:
+            self._store.append(op, params)
+        if self._replica_protocols:
+            packet = ControlPacket.replicated(op, params)
+            for protocol, _ in self._replica_protocols:
+                protocol.send(packet)
+
+    def _schedule_as_primary(self, delay, callback):
+        """
+        Schedules the next run of a periodic task of the primary, they are all cancelled when it steps down
+        """
+        self._primary_timers[callback.__name__] = self._loop.call_later(delay, callback)
+
+    def _send_leases(self):
+        """
+        Renews the lease of every connected replica and tells them the order they take over in. The first replica
+        that connected stays first, even while disconnected, for as long as this registry is the primary.
+        """
+        now = self._loop.time()
+        if self._successor is not None and now - self._successor_ack > self._lease / 2:
+            self._step_down()
+            return
+        self._replica_protocols = [(protocol, address) for protocol, address in self._replica_protocols if
+                                   protocol.is_connected()]
+        if self._successor is None and self._replica_protocols:
+            self._successor, self._successor_ack = self._replica_protocols[0][1], now
+        replicas = [address for _, address in self._replica_protocols if address != self._successor]
+        if self._successor is not None:
+            replicas.insert(0, self._successor)
+        packet = ControlPacket.lease(self._lease, replicas)
+        for protocol, _ in self._replica_protocols:
+            protocol.send(packet)
+        self._schedule_as_primary(self._lease / 3, self._send_leases)
+
+    def _ack_lease(self, protocol):
+        if (protocol, self._successor) in self._replica_protocols:
+            self._successor_ack = self._loop.time()
+
+    def _step_down(self):
+        """
+        Stops acting as the primary once the replica taking over first may have promoted itself, and follows it
+        """
+        logger.warning('Replica %s:%s stopped acking leases, stepping down', *self._successor)
+        replicas = [address for _, address in self._replica_protocols if address != self._successor]
+        for timer in self._primary_timers.values():
+            timer.cancel()
+        self._primary_timers.clear()
+        for protocol, _ in self._replica_protocols:
+            protocol.close()
+        self._replica_protocols = []
+        self._primary, self._replicas = self._successor, [self._successor] + replicas
+        self._successor = None
+        asyncio.async(self._follow(self._replicas))
+
+    def _add_replica(self, packet, protocol):
+        address = (packet['params']['host'], packet['params']['port'])
+        self._replica_protocols = [(known, known_address) for known, known_address in self._replica_protocols
+                                   if known_address != address]  # a replica that reconnected
+        self._replica_protocols.append((protocol, address))
+        protocol.send(ControlPacket.replica_snapshot(self._repository.dump(exclude=self._mirrored)))
+        logger.info('Replica %s connected', address)
+
+    @asyncio.coroutine
+    def _follow(self, candidates):
+        """
+        Replicates the first reachable candidate, promotes this registry when it comes first in the list
+        """
+        for host, port in candidates:
+            if self._address == (host, port):
+                self._promote()
+                return
+            try:
+                transport, protocol = yield from self._loop.create_connection(
+                    partial(get_vyked_protocol, self), host, port)
+            except OSError:
+                logger.info('Registry %s:%s is unreachable', host, port)
+                continue
+            if self._address is None:
+                self._address = (transport.get_extra_info('sockname')[0], self._port)
+            self._primary, self._primary_protocol = (host, port), protocol
+            protocol.send(ControlPacket.replicate(*self._address))
+            self._renew_lease()
+            return
+        self._loop.call_later(self._lease, self._fail_over)
+
+    def _renew_lease(self, packet=None):
+        if packet is not None:
+            self._replicas = [tuple(address) for address in packet['params']['replicas']]
+        if self._lease_timer is not None:
+            self._lease_timer.cancel()
+        self._lease_timer = self._loop.call_later(self._lease, self._fail_over)
+
+    def _fail_over(self):
+        logger.info('Lease of primary %s expired', self._primary)
+        self._lease_timer = None
+        if self._primary_protocol is not None:
+            self._primary_protocol.close()
+            self._primary_protocol = None
+        asyncio.async(self._follow(self._replicas or [self._primary]))
+
+    def _promote(self):
+        logger.info('Promoted to primary')
+        self._primary = None
+        self._replicas = []
+        self._validate_nodes()
+        self._send_leases()
+        self._expire_leases()
+        self._expire_leader_leases()
+        self._watch_foreign_services()
+
+    def _expire_leases(self):
+        """
+        Deregisters the nodes whose lease ran out, one timer checks every lease
+        """
+        for node_id in self._leases.expired():
+            logger.info('Lease of %s expired', node_id)
+            self.deregister_service(node_id)
+        self._schedule_as_primary(LEASE_CHECK_INTERVAL, self._expire_leases)
+
+    def _expire_leader_leases(self):
+        """
+        Hands the leaderships of the nodes whose leader lease ran out to other candidates
+        """
+        keys = set()
+        for node_id in self._leader_leases.expired():
+            logger.info('Leader lease of %s expired', node_id)
+            keys.update(self._repository.get_node_subscriptions(node_id))
+        if keys:
+            self._elect_leaders(keys)
+        self._schedule_as_primary(LEADER_CHECK_INTERVAL, self._expire_leader_leases)
+
+    def _end_leader_grace(self):
+        self._elect_leaders(self._repository.get_leader_endpoints())
+
+    def _leader_keepalive(self, packet):
+        for node_id in packet['node_ids']:
+            if not self._leader_leases.renew(node_id):
+                self._leader_leases.grant(node_id, LEADER_LEASE)
+                self._elect_leaders(self._repository.get_node_subscriptions(node_id))
+
+    def _keepalive(self, packet):
+        loads = packet.get('loads', {})
+        for node_id in packet['node_ids']:
+            if self._leases.renew(node_id) and node_id in loads:
+                self._report_load(node_id, loads[node_id])
+
+    def _report_load(self, node_id, load):
+        """
+        Keeps the load a node reported and pushes it to the node's consumers when it moved noticeably
+        """
+        published = self._loads.get(node_id)
+        if published is None or load_changed(published, load):
+            self._loads[node_id] = load
+            service = self._repository.get_node(node_id)
+            if service is not None:
+                self._publish_topology_change(service, {'op': 'load', 'node': {'node_id': node_id, 'load': load}})
+
+    def _load_replica_snapshot(self, packet, protocol):
+        if protocol is self._primary_protocol:
+            self._repository = type(self._repository)()
+            self._load(packet['params']['entries'])
+            self._subscriptions_changed(list(self._subscriber_watchers))
+            if self._store is not None:
+                self._store.snapshot(self._repository.dump(exclude=self._mirrored))
+
+    def _apply_replicated(self, packet, protocol):
+        if protocol is self._primary_protocol:
+            op, params = packet['params']['op'], packet['params']['params']
+            if op == 'remove':
+                self._subscriptions_changed(self._repository.get_node_subscriptions(params['node_id']))
+            elif op == 'xsubscribe':
+                self._subscriptions_changed(
+                    (event['service'], event['version'], event['endpoint']) for event in params['events'])
+            elif op == 'leader':
+                self._subscriptions_changed([(params['service'], params['version'], params['endpoint'])])
+            self._repository.apply(op, params)
+            self._journal(op, params)
+
+    def owns(self, service):
+        return self._shards is None or shard_of(service, len(self._shards)) == self._shard_index
+
+    def _is_misrouted(self, packet, protocol):
+        """
+        Bounces a request for a service another shard owns back to the client, with the shard map
+        """
+        if self._shards is None or packet['type'] not in ('register', 'get_instances', 'get_subscribers',
+                                                          'xsubscribe'):
+            return False
+        if packet['type'] == 'xsubscribe':
+            foreign = [event for event in packet['params']['events'] if not self.owns(event['service'])]
+            if foreign:
+                packet['params']['events'] = [event for event in packet['params']['events'] if event not in foreign]
+                bounced = dict(packet, params=dict(packet['params'], events=foreign))
+                protocol.send(ControlPacket.wrong_shard(self._shards, bounced))
+            return False
+        if self.owns(packet['params']['service']):
+            return False
+        protocol.send(ControlPacket.wrong_shard(self._shards, packet))
+        return True
+
+    def _watch_foreign_services(self):
+        """
+        Watches the services owned by other shards that the services of this shard depend on or subscribe to
+        """
+        if self._shards is None:
+            return
+        for node in self._repository.get_nodes():
+            if node.node_id not in self._mirrored:
+                for vendor in self._repository.get_vendors(node.name, node.version):
+                    self._watch(vendor['service'])
+        for service in self._repository.get_subscriber_services():
+            self._watch(service)
+        self._schedule_as_primary(SHARD_RETRY_INTERVAL, self._check_shards)
+
+    def _watch(self, service):
+        if self.owns(service) or service in self._watched:
+            return
+        self._watched.add(service)
+        index = shard_of(service, len(self._shards))
+        protocol = self._shard_protocols.get(index)
+        if protocol is not None and protocol.is_connected():
+            protocol.send(ControlPacket.watch_service(service))
+        elif index not in self._connecting_shards:
+            asyncio.async(self._connect_shard(index))
+
+    def _check_shards(self):
+        """
+        Reconnects to the shards whose connection dropped, they send a fresh copy of every watched service
+        """
+        for index in {shard_of(service, len(self._shards)) for service in self._watched}:
+            protocol = self._shard_protocols.get(index)
+            if (protocol is None or not protocol.is_connected()) and index not in self._connecting_shards:
+                asyncio.async(self._connect_shard(index))
+        self._schedule_as_primary(SHARD_RETRY_INTERVAL, self._check_shards)
+
+    @asyncio.coroutine
+    def _connect_shard(self, index):
+        self._connecting_shards.add(index)
+        host, port = self._shards[index]
+        try:
+            _, protocol = yield from self._loop.create_connection(partial(get_vyked_protocol, self), host, port)
+        except OSError:
+            logger.info('Registry shard %s:%s is unreachable', host, port)
+            return
+        finally:
+            self._connecting_shards.discard(index)
+        self._shard_protocols[index] = protocol
+        for service in self._watched:
+            if shard_of(service, len(self._shards)) == index:
+                protocol.send(ControlPacket.watch_service(service))
+
+    def _add_shard_watcher(self, packet, protocol):
+        service = packet['params']['service']
+        self._shard_watchers[service].add(protocol)
+        nodes = []
+        for version, instances in self._repository.get_versions(service).items():
+            for host, port, node_id, service_type in instances:
+                nodes.append((version, self._node_packet(self._repository.get_node(node_id))))
+        protocol.send(ControlPacket.service_nodes(service, nodes))
+
+    def _forward_to_shards(self, service: Service, change):
+        watchers = {protocol for protocol in self._shard_watchers.get(service.name, ()) if protocol.is_connected()}
+        self._shard_watchers[service.name] = watchers
+        if watchers:
+            packet = ControlPacket.shard_update(service.name, service.version, change)
+            for protocol in watchers:
+                protocol.send(packet)
+
+    def _load_service_nodes(self, packet):
+        """
+        Replaces the mirrored nodes of a watched service with the owning shard's copy
+        """
+        params = packet['params']
+        current = {each['node']['node_id'] for each in params['nodes']}
+        for version, instances in self._repository.get_versions(params['service']).items():
+            for _, _, node_id, _ in list(instances):
+                if node_id in self._mirrored and node_id not in current:
+                    self.deregister_service(node_id)
+        for each in params['nodes']:
+            self._mirror(params['service'], each['version'], each['node'])
+
+    def _apply_shard_update(self, packet):
+        params = packet['params']
+        change, node = params['change'], params['change']['node']
+        if change['op'] == 'added':
+            self._mirror(params['service'], params['version'], node)
+        elif node['node_id'] in self._mirrored:
+            if change['op'] == 'removed':
+                self.deregister_service(node['node_id'])
+            else:
+                if change['op'] == 'weight':
+                    self._repository.set_weight(node['node_id'], node['weight'])
+                elif change['op'] == 'load':
+                    self._loads[node['node_id']] = node['load']
+                self._publish_topology_change(self._repository.get_node(node['node_id']), change)
+
+    def _mirror(self, service_name, version, node):
+        """
+        Registers a node of a service another shard owns, it activates dependants like a local node would
+        """
+        if self._repository.get_node(node['node_id']) is not None:
+            return
+        service = service_from_params(dict(node, service=service_name, version=version, vendors=[]))
+        self._repository.register_service(service)
+        self._mirrored.add(service.node_id)
+        self._repository.set_weight(service.node_id, node.get('weight', 1))
+        if 'load' in node:
+            self._loads[service.node_id] = node['load']
+        self._publish_topology_change(service, {'op': 'added', 'node': self._node_packet(service)})
+        self._handle_pending_registrations(service)
+
     def receive(self, packet: dict, protocol, transport):
         request_type = packet['type']
-        if request_type == 'register':
+        if request_type in PRIMARY_REQUESTS and not self.is_primary:
+            protocol.send(ControlPacket.not_primary(*self._primary))
+        elif self._is_misrouted(packet, protocol):
+            pass
+        elif request_type == 'register':
             self.register_service(packet, protocol, *transport.get_extra_info('peername'))
         elif request_type == 'get_instances':
             self.get_service_instances(packet, protocol)
@@ -155,59 +796,281 @@ class Registry:
             self._ping(packet)
         elif request_type == 'ping':
             self._pong(packet, protocol)
+        elif request_type == 'keepalive':
+            self._keepalive(packet)
+        elif request_type == 'leader_keepalive':
+            self._leader_keepalive(packet)
+        elif request_type == 'watch_service':
+            self._add_shard_watcher(packet, protocol)
+        elif request_type == 'service_nodes':
+            self._load_service_nodes(packet)
+        elif request_type == 'shard_update':
+            self._apply_shard_update(packet)
+        elif request_type == 'resync':
+            self._resync(packet, protocol)
+        elif request_type == 'set_weight':
+            self._set_weight(packet)
+        elif request_type == 'replicate':
+            self._add_replica(packet, protocol)
+        elif request_type == 'replica_snapshot':
+            self._load_replica_snapshot(packet, protocol)
+        elif request_type == 'replicated':
+            self._apply_replicated(packet, protocol)
+        elif request_type == 'lease':
+            if protocol is self._primary_protocol:
+                self._renew_lease(packet)
+                protocol.send(ControlPacket.lease_ack())
+        elif request_type == 'lease_ack':
+            self._ack_lease(protocol)
+        elif request_type == 'not_primary':
+            if protocol is self._primary_protocol:  # the replica we followed has not promoted itself yet
+                self._primary_protocol = None
+                protocol.close()
+                self._renew_lease()
 
     def deregister_service(self, node_id):
         service = self._repository.get_node(node_id)
+        if service is not None:  # consumers are found through the version the node serves, before it goes away
+            self._publish_topology_change(service, {'op': 'removed', 'node': {'node_id': node_id}})
+        subscriptions = self._repository.get_node_subscriptions(node_id)
+        self._subscriptions_changed(subscriptions)
         self._repository.remove_node(node_id)
+        self._leader_leases.revoke(node_id)
+        self._elect_leaders(subscriptions)
         if service is not None:
+            self._journal('remove', {'node_id': node_id})
             self._service_protocols.pop(node_id, None)
+            self._leases.revoke(node_id)
+            self._mirrored.discard(node_id)
+            self._loads.pop(node_id, None)
+            self._health_checker.remove(node_id)
+            pinger = self._pingers.pop(node_id, None)
+            if pinger is not None:
+                pinger.stop()
             self._client_protocols.pop(node_id, None)
-            self._notify_consumers(service.name, service.version, node_id)
+            self._topology_versions.pop(node_id, None)
             if not len(self._repository.get_instances(service.name, service.version)):
                 consumers = self._repository.get_consumers(service.name, service.version)
                 for consumer_name, consumer_version in consumers:
                     for _, _, node_id, _ in self._repository.get_instances(consumer_name, consumer_version):
                         self._repository.add_pending_service(consumer_name, consumer_version, node_id)
+            for consumer_name, consumer_version in self._repository.update_dependants(service.name):
+                self._activate(consumer_name, consumer_version)
 
     def register_service(self, packet: dict, registry_protocol, host, port):
         params = packet['params']
-        service = Service(params['service'], params['version'], params['vendors'], params['host'], params['port'],
-                          params['node_id'], params['type'])
+        known = self._repository.get_node(params['node_id'])
+        if known is not None:  # a known node that reconnected, maybe to a restarted or promoted registry
+            self._client_protocols[params['node_id']] = registry_protocol
+            self._leases.renew(params['node_id'])
+            if known.node_id not in self._repository.get_pending_instances(known.name, known.version):
+                self._send_topology_snapshot(known, registry_protocol)  # realigns the node's topology version
+            return
+        service = service_from_params(params)
         self._repository.register_service(service)
+        self._journal('register', params)
         self._client_protocols[params['node_id']] = registry_protocol
-        self._connect_to_service(params['host'], params['port'], params['node_id'], params['type'])
-        self._handle_pending_registrations()
+        if self._shards is not None:
+            for vendor in service.dependencies:
+                self._watch(vendor['service'])
+        if service.lease:
+            self._leases.grant(service.node_id, service.lease)
+        else:
+            self._connect_to_service(params['host'], params['port'], params['node_id'], params['type'])
+        self._publish_topology_change(service, {'op': 'added', 'node': self._node_packet(service)})
+        self._handle_pending_registrations(service)
 
-    def _send_activated_packet(self, service, version, node):
-        protocol = self._client_protocols[node]
-        packet = self._make_activated_packet(service, version)
-        protocol.send(packet)
+    def _handle_pending_registrations(self, service: Service):
+        unsatisfied = self._repository.get_unsatisfied_vendors(service.name, service.version)
+        if unsatisfied:
+            logger.info('%s can\'t register because it depends on %s', (service.name, service.version), unsatisfied)
+        else:
+            self._activate(service.name, service.version)
+        if service.type == 'tcp':
+            for consumer_name, consumer_version in self._repository.update_dependants(service.name):
+                self._activate(consumer_name, consumer_version)
 
-    def _handle_pending_registrations(self):
-        for service, version in self._repository.get_pending_services():
-            vendors = self._repository.get_vendors(service, version)
-            should_activate = True
-            for vendor in vendors:
-                instances = self._repository.get_versioned_instances(vendor['service'], vendor['version'])
-                tcp_instances = [instance for instance in instances if instance[3] == 'tcp']
-                if not len(tcp_instances):
-                    should_activate = False
-                    break
-            for node in self._repository.get_pending_instances(service, version):
-                if should_activate:
-                    self._send_activated_packet(service, version, node)
-                    self._repository.remove_pending_instance(service, version, node)
-                    logger.info('%s activated', (service, version))
-                else:
-                    logger.info('%s can\'t register because it depends on %s', (service, version), vendor)
+    def _activate(self, service, version):
+        for node in list(self._repository.get_pending_instances(service, version)):
+            self._repository.remove_pending_instance(service, version, node)
+            self._pending_activations[(service, version)].append(node)
+            logger.info('%s activated', (service, version))
+        if self._pending_activations:
+            self._schedule_updates()
 
-    def _make_activated_packet(self, service, version):
+    def _schedule_updates(self):
+        if not self._updates_scheduled:
+            self._updates_scheduled = True
+            self._loop.call_soon(self._send_updates)
+
+    def _send_updates(self):
+        self._updates_scheduled = False
+        self._send_activated_packets()
+        self._send_topology_changes()
+        self._send_subscriber_changes()
+
+    def _subscriptions_changed(self, keys):
+        """
+        Queues the watched (service, version, endpoint) keys among keys for a push to their watchers
+        """
+        watched = [key for key in keys if key in self._subscriber_watchers]
+        if watched:
+            self._changed_subscriptions.update(watched)
+            self._schedule_updates()
+
+    def _send_subscriber_changes(self):
+        """
+        Pushes the current subscribers of every endpoint that changed this tick to the clients caching them
+        """
+        changed, self._changed_subscriptions = self._changed_subscriptions, set()
+        for key in changed:
+            watchers = {protocol for protocol in self._subscriber_watchers[key] if protocol.is_connected()}
+            if not watchers:
+                del self._subscriber_watchers[key]
+                continue
+            self._subscriber_watchers[key] = watchers
+            packet = ControlPacket.subscribers_changed(*key, subscribers=self._repository.get_subscribers(*key),
+                                                       leaders=self._leaders(*key))
+            for protocol in watchers:
+                protocol.send(packet)
+
+    def _leaders(self, service, version, endpoint):
+        """
+        :return: node ids of the leaders of the services subscribed to endpoint with the LEADER strategy
+        """
+        return set(self._repository.get_leaders(service, version, endpoint).values())
+
+    def _elect_leaders(self, keys, rotate=False):
+        """
+        Elects a leader for every LEADER strategy service subscribed to the (service, version, endpoint) keys whose
+        leader lost its lease or its subscription, among the candidates with a live leader lease
+        :param rotate: re-elect every leader, for a new leader term
+        """
+        if not self.is_primary:
+            return
+        grace = self._loop.time() < self._leader_grace
+        for key in set(keys):
+            candidates = defaultdict(list)
+            for subscriber_service, subscriber_version, _, _, node_id, strategy in self._repository.get_subscribers(
+                    *key):
+                if strategy == 'LEADER' and (grace or node_id in self._leader_leases):
+                    candidates[(subscriber_service, subscriber_version)].append(node_id)
+            leaders = self._repository.get_leaders(*key)
+            for subscriber in set(candidates) | set(leaders):
+                nodes, leader = candidates.get(subscriber, []), leaders.get(subscriber)
+                if leader in nodes and not rotate:
+                    continue
+                elected = None
+                if nodes:
+                    elected = max(nodes, key=partial(leader_rank, key[0], key[1], key[2], self._leader_epoch))
+                if elected != leader:
+                    params = {'service': key[0], 'version': key[1], 'endpoint': key[2],
+                              'subscriber_service': subscriber[0], 'subscriber_version': subscriber[1],
+                              'node_id': elected}
+                    self._repository.apply('leader', params)
+                    self._journal('leader', params)
+                    self._subscriptions_changed([key])
+
+    def _schedule_leader_rotation(self):
+        self._loop.call_later(self._leader_term, self._rotate_leaders)
+
+    def _rotate_leaders(self):
+        """
+        Re-ranks the candidates of every endpoint with LEADER subscribers for the new term
+        """
+        self._leader_epoch += 1
+        self._elect_leaders(self._repository.get_leader_endpoints(), rotate=True)
+        self._schedule_leader_rotation()
+
+    def _send_activated_packets(self):
+        """
+        Sends the activations of an event loop tick in one go, building each service's packet once
+        """
+        activations, self._pending_activations = self._pending_activations, defaultdict(list)
+        for (service, version), nodes in activations.items():
+            instances, node_info = self._get_vendor_instances(service, version)
+            for node in nodes:
+                protocol = self._client_protocols.get(node)
+                if protocol is not None:
+                    topology_version = self._topology_versions.setdefault(node, 0)
+                    protocol.send(ControlPacket.activated(instances, node_info, topology_version, node_id=node))
+
+    def _send_topology_changes(self):
+        """
+        Sends every active consumer node the vendor changes of an event loop tick as one versioned delta
+        """
+        changes, self._topology_changes = self._topology_changes, defaultdict(list)
+        for node, node_changes in changes.items():
+            protocol = self._client_protocols.get(node)
+            if protocol is not None:
+                self._topology_versions[node] = self._topology_versions.get(node, 0) + 1
+                protocol.send(ControlPacket.topology(self._topology_versions[node], node_changes))
+
+    def _publish_topology_change(self, service: Service, change):
+        """
+        Queues a change to service's instances for the active consumers whose dependency resolves to its version
+        """
+        if service.name in self._shard_watchers and service.node_id not in self._mirrored:
+            self._forward_to_shards(service, change)
+        for consumer_name, consumer_version in self._repository.get_dependants(service.name):
+            pending = self._repository.get_pending_instances(consumer_name, consumer_version)
+            for vendor in self._repository.get_vendors(consumer_name, consumer_version):
+                if vendor['service'] != service.name or \
+                        self._repository.resolve_version(service.name, vendor['version']) != service.version:
+                    continue
+                vendor_change = dict(change, service=vendor['service'], version=vendor['version'])
+                for _, _, node, _ in self._repository.get_instances(consumer_name, consumer_version):
+                    if node not in pending:
+                        self._topology_changes[node].append(vendor_change)
+        if self._topology_changes:
+            self._schedule_updates()
+
+    def _get_vendor_instances(self, service, version):
         vendors = self._repository.get_vendors(service, version)
         instances = {
-            (vendor['service'], vendor['version']): self._repository.get_versioned_instances(vendor['service'], vendor['version'])
+            (vendor['service'], vendor['version']): self._repository.get_versioned_instances(vendor['service'],
+                                                                                             vendor['version'])
             for
             vendor in vendors}
-        return ControlPacket.activated(instances)
+        node_info = {}
+        for addresses in instances.values():
+            for _, _, node, _ in addresses:
+                node_info[node] = self._get_node_info(node)
+        return instances, node_info
+
+    def _get_node_info(self, node_id):
+        node_info = dict(self._repository.get_local_address(node_id) or {})
+        node_info['weight'] = self._repository.get_weight(node_id)
+        if node_id in self._loads:
+            node_info['load'] = self._loads[node_id]
+        return node_info
+
+    def _node_packet(self, service: Service):
+        return ControlPacket.node(service.host, service.port, service.node_id, service.type,
+                                  self._get_node_info(service.node_id))
+
+    def _make_activated_packet(self, service, version):
+        instances, node_info = self._get_vendor_instances(service, version)
+        return ControlPacket.activated(instances, node_info)
+
+    def _resync(self, packet, protocol):
+        service = self._repository.get_node(packet['node_id'])
+        if service is not None:
+            self._send_topology_snapshot(service, protocol)
+
+    def _send_topology_snapshot(self, service: Service, protocol):
+        instances, node_info = self._get_vendor_instances(service.name, service.version)
+        topology_version = self._topology_versions.setdefault(service.node_id, 0)
+        protocol.send(ControlPacket.topology_snapshot(instances, node_info, topology_version))
+
+    def _set_weight(self, packet):
+        params = packet['params']
+        service = self._repository.get_node(params['node_id'])
+        if service is not None:
+            self._repository.set_weight(service.node_id, params['weight'])
+            self._journal('weight', params)
+            self._publish_topology_change(service, {'op': 'weight', 'node': {'node_id': service.node_id,
+                                                                             'weight': params['weight']}})
 
     def _connect_to_service(self, host, port, node_id, service_type):
         if service_type == 'tcp':
@@ -215,24 +1078,20 @@ class Registry:
             future = asyncio.async(coroutine)
             future.add_done_callback(partial(self._handle_service_connection, node_id))
         elif service_type == 'http':
-            pinger = HTTPPinger(node_id, host, port, self)
-            self._pingers[node_id] = pinger
-            pinger.ping()
+            self._health_checker.add(node_id, host, port, self.on_timeout)
 
     def _handle_service_connection(self, node_id, future):
-        transport, protocol = future.result()
+        try:
+            transport, protocol = future.result()
+        except OSError as e:
+            logger.info('Could not connect to %s: %s', node_id, e)
+            self.deregister_service(node_id)
+            return
         self._service_protocols[node_id] = protocol
         pinger = TCPPinger(node_id, protocol, self)
         self._pingers[node_id] = pinger
         pinger.ping()
 
-    def _notify_consumers(self, service, version, node_id):
-        packet = ControlPacket.deregister(service, version, node_id)
-        for consumer_name, consumer_version in self._repository.get_consumers(service, version):
-            for host, port, node, service_type in self._repository.get_instances(consumer_name, consumer_version):
-                protocol = self._client_protocols[node]
-                protocol.send(packet)
-
     def get_service_instances(self, packet, registry_protocol):
         params = packet['params']
         service, version = params['service'], params['version']
@@ -245,33 +1104,83 @@ class Registry:
         request_id = packet['request_id']
         service, version, endpoint = params['service'], params['version'], params['endpoint']
         subscribers = self._repository.get_subscribers(service, version, endpoint)
-        packet = ControlPacket.subscribers(service, version, endpoint, request_id, subscribers)
+        if params.get('watch'):
+            self._subscriber_watchers[(service, version, endpoint)].add(protocol)
+        packet = ControlPacket.subscribers(service, version, endpoint, request_id, subscribers,
+                                           leaders=self._leaders(service, version, endpoint))
         protocol.send(packet)
 
     def on_timeout(self, node_id):
         self.deregister_service(node_id)
 
     def _ping(self, packet):
-        pinger = self._pingers[packet['node_id']]
-        pinger.pong_received()
+        pinger = self._pingers.get(packet['node_id'])
+        if pinger is not None:
+            pinger.pong_received()
 
     def _pong(self, packet, protocol):
         protocol.send(ControlPacket.pong(packet['node_id']))
 
     def _xsubscribe(self, packet):
         params = packet['params']
-        service, version, host, port, node_id = params['service'], params['version'], params['host'], params['port'], \
-                                                params['node_id']
+        service, version, host, port, node_id = (params['service'], params['version'], params['host'], params['port'],
+                                                 params['node_id'])
         endpoints = params['events']
         self._repository.xsubscribe(service, version, host, port, node_id, endpoints)
+        self._journal('xsubscribe', params)
+        if self._shards is not None:  # mirroring the subscriber drops its subscriptions once its node is gone
+            self._watch(service)
+        keys = [(event['service'], event['version'], event['endpoint']) for event in endpoints]
+        if any(event['strategy'] == 'LEADER' for event in endpoints) and node_id not in self._leader_leases:
+            self._leader_leases.grant(node_id, LEADER_LEASE)  # until the node's first leader keepalive
+        self._subscriptions_changed(keys)
+        self._elect_leaders(keys)
 
 
 if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Starts the vyked registry')
+    parser.add_argument('--host', default=None)
+    parser.add_argument('--port', type=int, default=4500)
+    parser.add_argument('--data-dir', default=None,
+                        help='persist the registry state here and restore it on start')
+    parser.add_argument('--snapshot-interval', type=int, default=60, help='seconds between snapshots')
+    parser.add_argument('--replica-of', default=None, metavar='HOST:PORT',
+                        help='start as a read replica of the primary registry at this address')
+    parser.add_argument('--lease', type=float, default=REPLICATION_LEASE,
+                        help='seconds without a lease renewal before a replica takes over')
+    parser.add_argument('--shards', default=None, metavar='HOST:PORT,...',
+                        help='primaries of every registry shard, in the same order for all of them')
+    parser.add_argument('--shard-index', type=int, default=0, help='position of this registry in --shards')
+    parser.add_argument('--health-path', default='/ping', help='path health checks of http nodes request')
+    parser.add_argument('--health-failures', type=int, default=3,
+                        help='consecutive failed health checks before an http node is evicted')
+    parser.add_argument('--health-concurrency', type=int, default=100,
+                        help='health checks of http nodes that may run at once')
+    parser.add_argument('--broker-port', type=int, default=None,
+                        help='also host a pub sub broker services can use instead of redis on this port')
+    parser.add_argument('--leader-term', type=float, default=None,
+                        help='seconds after which the leaders of LEADER strategy subscribers rotate')
+    args = parser.parse_args()
+
     config_logs(enable_ping_logs=False, log_level=logging.DEBUG)
     from setproctitle import setproctitle
 
     setproctitle("registry")
-    REGISTRY_HOST = None
-    REGISTRY_PORT = 4500
-    registry = Registry(REGISTRY_HOST, REGISTRY_PORT, Repository())
+    store = None
+    if args.data_dir is not None:
+        store = RepositoryStore(args.data_dir, snapshot_interval=args.snapshot_interval)
+    primary = None
+    if args.replica_of is not None:
+        primary_host, primary_port = args.replica_of.rsplit(':', 1)
+        primary = (primary_host, int(primary_port))
+    health_checker = HTTPHealthChecker(path=args.health_path, failure_threshold=args.health_failures,
+                                       max_concurrent=args.health_concurrency)
+    shards = None
+    if args.shards is not None:
+        shards = [(shard.rsplit(':', 1)[0], int(shard.rsplit(':', 1)[1])) for shard in args.shards.split(',')]
+    registry = Registry(args.host, args.port, Repository(), store=store, primary=primary, lease=args.lease,
+                        health_checker=health_checker, shards=shards, shard_index=args.shard_index,
+                        broker_port=args.broker_port, leader_term=args.leader_term)
     registry.start()
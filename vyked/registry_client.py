@@ -1,6 +1,10 @@
 import asyncio
+import itertools
+import json
 import logging
+import os
 import random
+import socket
 from collections import defaultdict
 
 from again.utils import unique_hex
@@ -9,6 +13,10 @@ from retrial.retrial import retry
 from .packet import ControlPacket
 from .protocol_factory import get_vyked_protocol
 from .pinger import TCPPinger
+from .lease import KEEPALIVES_PER_LEASE, LEADER_LEASE, load_score
+from .sharding import shard_of
+
+FAILOVER_RETRY_DELAY = 1
 
 
 def _retry_for_result(result):
@@ -21,13 +29,48 @@ def _retry_for_exception(_):
     return True
 
 
+def get_host_id():
+    """
+    Identifies the machine a node runs on, nodes with the same host id can reach each other's unix sockets
+    """
+    return socket.gethostname()
+
+
 class RegistryClient:
     logger = logging.getLogger(__name__)
 
-    def __init__(self, loop, host, port):
+    def __init__(self, loop, host, port, replicas=None, topology_file=None):
+        """
+        :param replicas: (host, port) addresses of read replicas of the registry, reads are spread across them
+        :param topology_file: file the last known vendor topology is kept in, lets a node start while the registry is
+        unreachable
+        """
         self._loop = loop
         self._port = port
         self._host = host
+        self._replicas = replicas or []
+        self._registry_address = (host, port)
+        self._failed_address = None
+        self._read_protocols = {}
+        self._read_count = 0
+        self._registration = None
+        self._xsubscribed = None
+        self._shards = None
+        self._shard_protocols = {}
+        self._shard_queues = defaultdict(list)
+        self._connecting_shards = set()
+        self._topology_version = 0
+        self._resyncing = False
+        self._weights = {}
+        self._loads = {}
+        self._subscribers = {}
+        self._topology_file = topology_file
+        self._topology_loaded = False
+        self._save_scheduled = False
+        self._queued_packets = []
+        self._lease = None
+        self._keepalive_due = None
+        self._leading = False
         self.bus = None
         self._service_host = None
         self._service_port = None
@@ -40,59 +83,339 @@ class RegistryClient:
         self._pending_requests = {}
         self._available_services = defaultdict(list)
         self._assigned_services = defaultdict(lambda: defaultdict(list))
+        self._host_id = get_host_id()
+        self._local_addresses = {}
 
-    def register(self, ip, port, service, version, vendors, service_type):
+    def register(self, ip, port, service, version, vendors, service_type, unix_socket=None, shm_socket=None,
+                 lease=None):
+        """
+        :param lease: seconds the registry keeps this node without a keepalive, None to be pinged by the registry
+        """
         self._service_host = ip
         self._service_port = port
         self._service = service
         self._version = version
         self._node_id = '{}_{}_{}'.format(service, version, unique_hex())
-        packet = ControlPacket.registration(ip, port, self._node_id, service, version, vendors, service_type)
-        self._protocol.send(packet)
+        packet = ControlPacket.registration(ip, port, self._node_id, service, version, vendors, service_type,
+                                            unix_socket=unix_socket, host_id=self._host_id, shm_socket=shm_socket,
+                                            lease=lease)
+        self._registration = packet
+        if self._is_connected():
+            self._protocol.send(packet)
+        if lease and self._lease is None:
+            self._lease = lease
+            self._schedule_keepalive()
+        if self._topology_loaded:  # serve from the persisted topology until the registry answers
+            self.bus.registration_complete()
 
     def get_instances(self, service, version):
         packet = ControlPacket.get_instances(service, version)
         future = asyncio.Future()
-        self._protocol.send(packet)
+        self._send_for_service(service, packet)
         self._pending_requests[packet['request_id']] = future
         return future
 
     def get_subscribers(self, service, version, endpoint):
-        packet = ControlPacket.get_subscribers(service, version, endpoint)
-        # TODO : remove duplication in get_instances and get_subscribers
+        """
+        Answers from the local subscriber index while the registry connection that keeps it up to date is alive
+        """
         future = asyncio.Future()
-        self._protocol.send(packet)
+        cached = self._subscribers.get((service, version, endpoint))
+        if cached is not None and cached[0].is_connected():
+            future.set_result(cached[1])
+            return future
+        packet = ControlPacket.get_subscribers(service, version, endpoint, watch=True)
+        # TODO : remove duplication in get_instances and get_subscribers
+        self._send_for_service(service, packet)
         self._pending_requests[packet['request_id']] = future
         return future
 
     def x_subscribe(self, endpoints):
-        packet = ControlPacket.xsubscribe(self._service, self._version, self._service_host, self._service_port,
-                                          self._node_id,
-                                          endpoints)
-        self._protocol.send(packet)
+        self._xsubscribed = list(endpoints)
+        for address, packet in self._xsubscription_packets().items():
+            if address is None:
+                if self._is_connected():
+                    self._protocol.send(packet)
+            else:
+                self._send_to_shard(address, packet)
+        if not self._leading and any(endpoint[3] == 'LEADER' for endpoint in self._xsubscribed):
+            self._leading = True
+            self._schedule_leader_keepalive()
+
+    def _xsubscription_packets(self):
+        """
+        :return: {shard address: xsubscribe packet} with every endpoint sent to the shard owning its publisher,
+        None standing for the registry this node is registered with
+        """
+        grouped = defaultdict(list)
+        for endpoint in self._xsubscribed or []:
+            grouped[self._shard_address(endpoint[0])].append(endpoint)
+        return {address: ControlPacket.xsubscribe(self._service, self._version, self._service_host,
+                                                  self._service_port, self._node_id, endpoints)
+                for address, endpoints in grouped.items()}
+
+    def _shard_address(self, service):
+        """
+        :return: address of the registry shard owning service, None if it is the one this node is registered with
+        """
+        if self._shards is None:
+            return None
+        address = self._shards[shard_of(service, len(self._shards))]
+        return None if address == (self._host, self._port) else address
+
+    def _send_for_service(self, service, packet):
+        address = self._shard_address(service)
+        if address is None:
+            self._send(packet, self._read_protocol())
+        else:
+            self._send_to_shard(address, packet)
+
+    def _send_to_shard(self, address, packet):
+        if address is None:
+            self._send(packet, self._protocol)
+            return
+        protocol = self._shard_protocols.get(address)
+        if protocol is not None and protocol.is_connected():
+            protocol.send(packet)
+        else:
+            self._shard_queues[address].append(packet)
+            if address not in self._connecting_shards:
+                asyncio.async(self._connect_shard(address))
+
+    @asyncio.coroutine
+    def _connect_shard(self, address):
+        self._connecting_shards.add(address)
+        try:
+            _, protocol = yield from self._loop.create_connection(partial(get_vyked_protocol, self), *address)
+        except OSError as e:
+            self.logger.info('Registry shard %s:%s is unreachable: %s', address[0], address[1], e)
+            return
+        finally:
+            self._connecting_shards.discard(address)
+        self._shard_protocols[address] = protocol
+        xsubscription = self._xsubscription_packets().get(address)
+        if xsubscription is not None:
+            protocol.send(xsubscription)
+        for packet in self._shard_queues.pop(address, []):
+            protocol.send(packet)
+
+    def _handle_wrong_shard(self, packet):
+        """
+        Learns the shard map from a bounced request and sends the request on to the shard owning it
+        """
+        self._shards = [tuple(shard) for shard in packet['shards']]
+        bounced = packet['packet']
+        if bounced['type'] == 'register':
+            self._switch_primary(*self._shards[shard_of(self._service, len(self._shards))])
+        elif bounced['type'] == 'xsubscribe':
+            for address, xsubscription in self._xsubscription_packets().items():
+                if address is not None:
+                    self._send_to_shard(address, xsubscription)
+        else:
+            self._send_to_shard(self._shard_address(bounced['params']['service']), bounced)
+
+    def set_weight(self, weight):
+        """
+        Changes the share of its consumers' requests this node receives, relative to the default weight of 1
+        """
+        self._send(ControlPacket.set_weight(self._node_id, weight), self._protocol)
+
+    def load_topology(self):
+        """
+        Fills the vendor cache from the topology persisted by an earlier run
+        :return: True if a persisted topology was found
+        """
+        if self._topology_file is None or not os.path.exists(self._topology_file):
+            return False
+        try:
+            with open(self._topology_file) as f:
+                vendors = json.load(f)['vendors']
+        except (OSError, ValueError, KeyError) as e:
+            self.logger.warning('Ignoring unreadable topology file %s: %s', self._topology_file, e)
+            return False
+        self.cache_vendors(vendors)
+        self._topology_loaded = True
+        return True
+
+    def _schedule_save(self):
+        if self._topology_file is not None and not self._save_scheduled:
+            self._save_scheduled = True
+            self._loop.call_soon(self._save_topology)
+
+    def _save_topology(self):
+        self._save_scheduled = False
+        vendors = []
+        for vendor_name, addresses in self._available_services.items():
+            name, version = vendor_name.rsplit('/', 1)
+            vendors.append({'name': name, 'version': version, 'addresses': [
+                ControlPacket.node(host, port, node_id, service_type,
+                                   dict(self._local_addresses.get(node_id, {}), weight=self._weights.get(node_id, 1)))
+                for host, port, node_id, service_type in addresses]})
+        temp_path = self._topology_file + '.tmp'
+        try:
+            with open(temp_path, 'w') as f:
+                json.dump({'vendors': vendors}, f)
+            os.replace(temp_path, self._topology_file)
+        except OSError as e:
+            self.logger.warning('Could not persist topology to %s: %s', self._topology_file, e)
+
+    def _schedule_keepalive(self):
+        delay = self._lease / KEEPALIVES_PER_LEASE
+        self._keepalive_due = self._loop.time() + delay
+        self._loop.call_later(delay, self._send_keepalive)
+
+    def _send_keepalive(self):
+        """
+        Renews the lease with a load report, the event loop lag is how late this keepalive fired
+        """
+        if self._is_connected():
+            load = self.bus.load_report() if self.bus is not None else {}
+            load['lag'] = round(max(0, self._loop.time() - self._keepalive_due) * 1000)
+            self._protocol.send(ControlPacket.keepalive([self._node_id], {self._node_id: load}))
+        self._schedule_keepalive()
+
+    def _schedule_leader_keepalive(self):
+        self._loop.call_later(LEADER_LEASE / KEEPALIVES_PER_LEASE, self._send_leader_keepalive)
+
+    def _send_leader_keepalive(self):
+        """
+        Renews the leader lease of this node with every registry shard holding one of its LEADER subscriptions
+        """
+        packet = ControlPacket.leader_keepalive([self._node_id])
+        for address in {self._shard_address(endpoint[0]) for endpoint in self._xsubscribed if endpoint[3] == 'LEADER'}:
+            protocol = self._protocol if address is None else self._shard_protocols.get(address)
+            if protocol is not None and protocol.is_connected():
+                protocol.send(packet)
+        self._schedule_leader_keepalive()
+
+    def _is_connected(self):
+        return self._protocol is not None and self._protocol.is_connected()
+
+    def _send(self, packet, protocol):
+        """
+        Sends packet on protocol, holding it until the registry connection is up if it is not
+        """
+        if protocol is not None and protocol.is_connected():
+            protocol.send(packet)
+        else:
+            self._queued_packets.append(packet)
+
+    def _read_protocol(self):
+        protocols = [protocol for protocol in self._read_protocols.values() if protocol.is_connected()]
+        if not protocols:
+            return self._protocol
+        self._read_count += 1
+        return protocols[self._read_count % len(protocols)]
 
     @retry(should_retry_for_result=_retry_for_result, should_retry_for_exception=_retry_for_exception,
            strategy=[0, 2, 4, 8, 16, 32])
     def connect(self):
+        return (yield from self._open())
+
+    @asyncio.coroutine
+    def _open(self):
         self._transport, self._protocol = yield from self._loop.create_connection(partial(get_vyked_protocol, self),
                                                                                   self._host, self._port)
         self._pinger = TCPPinger('registry', self._protocol, self)
         self._pinger.ping()
+        for packet in (self._registration, self._xsubscription_packets().get(None)):  # a known node is reattached
+            if packet is not None:
+                self._protocol.send(packet)
+        queued, self._queued_packets = self._queued_packets, []
+        for packet in queued:
+            self._protocol.send(packet)
+        for host, port in self._replicas:
+            protocol = self._read_protocols.get((host, port))
+            if protocol is None or not protocol.is_connected():
+                asyncio.async(self._connect_replica(host, port))
         return self._transport, self._protocol
 
+    @asyncio.coroutine
+    def _connect_replica(self, host, port):
+        try:
+            _, protocol = yield from self._loop.create_connection(partial(get_vyked_protocol, self), host, port)
+        except OSError as e:
+            self.logger.info('Registry replica %s:%s is unreachable: %s', host, port, e)
+        else:
+            self._read_protocols[(host, port)] = protocol
+
     def on_timeout(self, node_id):
+        self._failed_address = (self._host, self._port)
+        asyncio.async(self._failover())
+
+    @asyncio.coroutine
+    def _failover(self, primary=None, delay=0):
+        """
+        Connects to the first reachable registry, trying primary first if given and then the replicas in order after
+        the current one. A replica that is not primary answers the registration with not_primary, which moves on to
+        the primary it follows.
+        :param delay: seconds to wait before the first attempt
+        """
+        self._pinger.stop()
+        if self._transport is not None:
+            self._transport.close()
+        addresses = [self._registry_address] + [tuple(address) for address in self._replicas if
+                                                tuple(address) != self._registry_address]
+        start = addresses.index((self._host, self._port)) + 1 if (self._host, self._port) in addresses else 0
+        addresses = addresses[start:] + addresses[:start]
+        if primary is not None:
+            addresses.insert(0, primary)
+        yield from asyncio.sleep(delay)
+        for attempt in itertools.count():
+            self._host, self._port = addresses[attempt % len(addresses)]
+            try:
+                yield from self._open()
+                return
+            except OSError as e:
+                self.logger.info('Registry %s:%s is unreachable: %s', self._host, self._port, e)
+            if (attempt + 1) % len(addresses) == 0:
+                yield from asyncio.sleep(FAILOVER_RETRY_DELAY)
+
+    def _switch_primary(self, host, port):
+        self.logger.info('Switching to primary registry %s:%s', host, port)
+        self._pinger.stop()
+        self._transport.close()
+        self._host, self._port = host, port
         asyncio.async(self.connect())
 
+    def _follow_redirect(self, host, port):
+        """
+        Moves on to the primary a replica follows, or to the next replica if the replica still follows the registry
+        that just failed, it promotes itself or learns the new primary after its lease expires
+        """
+        if (host, port) == self._failed_address:
+            self.logger.info('Registry %s:%s still follows the failed primary', self._host, self._port)
+            asyncio.async(self._failover(delay=FAILOVER_RETRY_DELAY))
+        else:
+            self.logger.info('Switching to primary registry %s:%s', host, port)
+            asyncio.async(self._failover(primary=(host, port)))
+
     def receive(self, packet: dict, protocol, transport):
         if packet['type'] == 'registered':
-            self.cache_vendors(packet['params']['vendors'])
+            self._failed_address = None
+            self._topology_version = packet['params'].get('topology_version', 0)
+            self._reconcile(packet['params']['vendors'])
+            self._schedule_save()
             self.bus.registration_complete()
+        elif packet['type'] == 'topology':
+            self._handle_topology(packet)
+            self._schedule_save()
+        elif packet['type'] == 'topology_snapshot':
+            self._handle_topology_snapshot(packet)
+            self._schedule_save()
         elif packet['type'] == 'deregister':
             self._handle_deregistration(packet)
+            self._schedule_save()
         elif packet['type'] == 'subscribers':
-            self._handle_subscriber_packet(packet)
+            self._handle_subscriber_packet(packet, protocol)
+        elif packet['type'] == 'subscribers_changed':
+            self._cache_subscribers(packet['params'], protocol)
         elif packet['type'] == 'pong':
             self._pinger.pong_received()
+        elif packet['type'] == 'wrong_shard':
+            self._handle_wrong_shard(packet)
+        elif packet['type'] == 'not_primary':
+            self._follow_redirect(packet['host'], packet['port'])
 
     def get_all_addresses(self, full_service_name):
         return self._available_services.get(
@@ -105,14 +428,38 @@ class RegistryClient:
                     return host, port, node, service_type
         return None
 
+    def get_unix_socket(self, node_id):
+        """
+        :return: path of the unix socket of a vendor node running on this host, None if it has to be reached over tcp
+        """
+        return self._local_addresses.get(node_id, {}).get('unix_socket')
+
+    def get_shm_socket(self, node_id):
+        """
+        :return: path of the shared memory transport socket of a vendor node running on this host, None otherwise
+        """
+        return self._local_addresses.get(node_id, {}).get('shm_socket')
+
     def get_random_service(self, service_name, service_type):
         services = self._available_services[service_name]
         services = [service for service in services if service[3] == service_type]
         if len(services):
-            return random.choice(services)
+            weights = [self._get_routing_weight(service[2]) for service in services]
+            pick = random.uniform(0, sum(weights))
+            for service, weight in zip(services, weights):
+                pick -= weight
+                if pick <= 0:
+                    return service
+            return services[-1]
         else:
             return None
 
+    def _get_routing_weight(self, node_id):
+        """
+        The node's weight scaled down by the load it last reported, idle nodes get their full weight
+        """
+        return self._weights.get(node_id, 1) / (1 + load_score(self._loads.get(node_id, {})))
+
     def resolve(self, service: str, version: str, entity: str, service_type: str):
         service_name = self._get_full_service_name(service, version)
         if entity is not None:
@@ -137,27 +484,99 @@ class RegistryClient:
     def cache_vendors(self, vendors):
         for vendor in vendors:
             vendor_name = self._get_full_service_name(vendor['name'], vendor['version'])
+            self._available_services[vendor_name] = []
             for address in vendor['addresses']:
                 self._available_services[vendor_name].append(
                     (address['host'], address['port'], address['node_id'], address['type']))
+                self._cache_node_info(address)
 
-    def _handle_deregistration(self, packet):
+    def _cache_node_info(self, address):
+        if address.get('host_id') == self._host_id:
+            self._local_addresses[address['node_id']] = address
+        self._weights[address['node_id']] = address.get('weight', 1)
+        if 'load' in address:
+            self._loads[address['node_id']] = address['load']
+
+    def _handle_topology(self, packet):
+        """
+        Applies a versioned delta to the vendor cache, a gap in versions means a delta was lost and asks for a resync
+        """
+        params = packet['params']
+        topology_version = params['topology_version']
+        if self._resyncing or topology_version <= self._topology_version:
+            return
+        if topology_version != self._topology_version + 1:
+            self.logger.info('Topology jumped from version %s to %s, resyncing', self._topology_version,
+                             topology_version)
+            self._resyncing = True
+            self._protocol.send(ControlPacket.resync(self._node_id))
+            return
+        self._topology_version = topology_version
+        for change in params['changes']:
+            vendor = self._get_full_service_name(change['service'], change['version'])
+            node = change['node']
+            if change['op'] == 'added':
+                self._add_node(change['service'], change['version'], node)
+            elif change['op'] == 'removed':
+                self._remove_node(vendor, node['node_id'])
+            elif change['op'] == 'weight':
+                self._weights[node['node_id']] = node['weight']
+            elif change['op'] == 'load':
+                self._loads[node['node_id']] = node['load']
+
+    def _handle_topology_snapshot(self, packet):
         params = packet['params']
-        vendor = self._get_full_service_name(params['service'], params['version'])
-        node = params['node_id']
-        for each in self._available_services[vendor]:
-            if each[2] == node:
-                self._available_services[vendor].remove(each)
+        self._reconcile(params['vendors'])
+        self._topology_version = params['topology_version']
+        self._resyncing = False
+
+    def _reconcile(self, vendors):
+        """
+        Brings the vendor cache in line with a full vendor list, telling the bus about the nodes that changed
+        """
+        for vendor in vendors:
+            vendor_name = self._get_full_service_name(vendor['name'], vendor['version'])
+            addresses = vendor.get('addresses', [])
+            current = {address['node_id'] for address in addresses}
+            for _, _, node_id, _ in list(self._available_services[vendor_name]):
+                if node_id not in current:
+                    self._remove_node(vendor_name, node_id)
+            for address in addresses:
+                self._add_node(vendor['name'], vendor['version'], address)
+
+    def _add_node(self, service, version, address):
+        vendor = self._get_full_service_name(service, version)
+        self._cache_node_info(address)
+        if any(node_id == address['node_id'] for _, _, node_id, _ in self._available_services[vendor]):
+            return
+        entry = (address['host'], address['port'], address['node_id'], address['type'])
+        self._available_services[vendor].append(entry)
+        if self.bus is not None:
+            self.bus.vendor_node_added(service, version, *entry)
+
+    def _remove_node(self, vendor, node):
+        self._available_services[vendor] = [each for each in self._available_services[vendor] if each[2] != node]
+        self._local_addresses.pop(node, None)
+        self._weights.pop(node, None)
+        self._loads.pop(node, None)
         entity_map = self._assigned_services.get(vendor)
         if entity_map is not None:
-            stale_entities = []
-            for entity, node_id in entity_map.items():
-                if node == node_id:
-                    stale_entities.append(entity)
+            stale_entities = [entity for entity, address in entity_map.items() if address[2] == node]
             for entity in stale_entities:
                 entity_map.pop(entity)
+        if self.bus is not None:
+            self.bus.vendor_node_removed(node)
+
+    def _handle_deregistration(self, packet):
+        params = packet['params']
+        self._remove_node(self._get_full_service_name(params['service'], params['version']), params['node_id'])
 
-    def _handle_subscriber_packet(self, packet):
+    def _handle_subscriber_packet(self, packet, protocol):
         request_id = packet['request_id']
-        future = self._pending_requests[request_id]
+        self._cache_subscribers(packet['params'], protocol)
+        future = self._pending_requests.pop(request_id)
         future.set_result(packet['params']['subscribers'])
+
+    def _cache_subscribers(self, params, protocol):
+        key = (params['service'], params['version'], params['endpoint'])
+        self._subscribers[key] = (protocol, params['subscribers'])
@@ -0,0 +1,87 @@
+import json
+import logging
+import os
+
+_logger = logging.getLogger(__name__)
+
+SNAPSHOT_FILE = 'registry.snapshot'
+JOURNAL_FILE = 'registry.journal'
+
+
+class RepositoryStore:
+    """
+    Persists the registry's repository as a snapshot plus an append-only journal on local disk.
+    Entries are (operation, params) pairs that Repository.apply() understands. Every entry carries a sequence
+    number and the snapshot records the last one it includes, so a crash between writing a snapshot and
+    truncating the journal never applies an operation twice.
+    """
+
+    def __init__(self, directory, snapshot_interval=60, sync=False):
+        """
+        :param str directory: directory holding the snapshot and journal files, created if missing
+        :param snapshot_interval: seconds between snapshots taken by the registry
+        :param bool sync: fsync every journal entry instead of only flushing it
+        """
+        self._directory = directory
+        self._snapshot_path = os.path.join(directory, SNAPSHOT_FILE)
+        self._journal_path = os.path.join(directory, JOURNAL_FILE)
+        self.snapshot_interval = snapshot_interval
+        self._sync = sync
+        self._seq = 0
+        self._journal = None
+
+    def load(self):
+        """
+        Reads the snapshot and the journal entries written after it
+        :return: the (operation, params) pairs to replay, in order
+        """
+        entries = []
+        snapshot_seq = 0
+        if os.path.exists(self._snapshot_path):
+            with open(self._snapshot_path) as f:
+                snapshot = json.load(f)
+            snapshot_seq = snapshot['seq']
+            entries.extend(snapshot['entries'])
+        self._seq = snapshot_seq
+        if os.path.exists(self._journal_path):
+            with open(self._journal_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        _logger.warning('Ignoring truncated journal entry %s', line)
+                        break
+                    if entry['seq'] > snapshot_seq:
+                        entries.append((entry['op'], entry['params']))
+                        self._seq = entry['seq']
+        return entries
+
+    def append(self, op, params):
+        if self._journal is None:
+            os.makedirs(self._directory, exist_ok=True)
+            self._journal = open(self._journal_path, 'a')
+        self._seq += 1
+        self._journal.write(json.dumps({'seq': self._seq, 'op': op, 'params': params}) + '\n')
+        self._journal.flush()
+        if self._sync:
+            os.fsync(self._journal.fileno())
+
+    def snapshot(self, entries):
+        """
+        Replaces the snapshot with entries describing the whole repository and truncates the journal
+        """
+        os.makedirs(self._directory, exist_ok=True)
+        temp_path = self._snapshot_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'seq': self._seq, 'entries': list(entries)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self._snapshot_path)
+        if self._journal is not None:
+            self._journal.close()
+        self._journal = open(self._journal_path, 'w')
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
@@ -6,6 +6,7 @@ from again.utils import unique_hex
 from aiohttp.web import Response
 
 from .packet import MessagePacket
+from .lease import DEFAULT_LEASE
 from .exceptions import RequestException
 from .utils.ordered_class_member import OrderedClassMembers
 
@@ -103,6 +104,9 @@ class _ServiceHost(_Service):
         super(_ServiceHost, self).__init__(service_name, service_version)
         self._ip = host_ip
         self._port = host_port
+        self._unix_socket = None
+        self._shm_socket = None
+        self._lease = DEFAULT_LEASE
         self._clients = []
 
     def is_for_me(self, service, version):
@@ -153,16 +157,40 @@ class _ServiceHost(_Service):
     def socket_address(self):
         return self._ip, self._port
 
+    @property
+    def unix_socket(self):
+        return self._unix_socket
+
+    @unix_socket.setter
+    def unix_socket(self, path):
+        self._unix_socket = path
+
+    @property
+    def shm_socket(self):
+        return self._shm_socket
+
+    @shm_socket.setter
+    def shm_socket(self, path):
+        self._shm_socket = path
+
+    @property
+    def lease(self):
+        """
+        Seconds the registry keeps this service registered without a keepalive, None to have the registry ping it
+        """
+        return self._lease
+
+    @lease.setter
+    def lease(self, seconds):
+        self._lease = seconds
+
 
 class TCPService(_ServiceHost):
     def __init__(self, service_name, service_version, host_ip=None, host_port=None):
         super(TCPService, self).__init__(service_name, service_version, host_ip, host_port)
 
     def _publish(self, endpoint, payload):
-        self._pubsub_bus.publish(self.name, self.version, endpoint, payload)
-
-    def _xpublish(self, endpoint, payload, strategy):
-        self._pubsub_bus.xpublish(self.name, self.version, endpoint, payload, strategy)
+        return self._pubsub_bus.publish(self.name, self.version, endpoint, payload)
 
     @staticmethod
     def _make_response_packet(request_id: str, from_id: str, entity: str, result: object, error: object):
@@ -179,7 +207,8 @@ class TCPService(_ServiceHost):
         return packet
 
     def register(self):
-        self._tcp_bus.register(self._ip, self._port, self.name, self.version, self._clients, 'tcp')
+        self._tcp_bus.register(self._ip, self._port, self.name, self.version, self._clients, 'tcp',
+                               unix_socket=self._unix_socket, shm_socket=self._shm_socket, lease=self._lease)
 
 
 def default_preflight_response(request):
@@ -214,7 +243,8 @@ class HTTPService(_ServiceHost, metaclass=OrderedClassMembers):
         return Response()
 
     def register(self):
-        self._tcp_bus.register(self._ip, self._port, self.name, self.version, self._clients, 'http')
+        self._tcp_bus.register(self._ip, self._port, self.name, self.version, self._clients, 'http',
+                               lease=self._lease)
 
 
 class HTTPServiceClient(_Service):
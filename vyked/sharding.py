@@ -0,0 +1,8 @@
+import zlib
+
+
+def shard_of(service, shard_count):
+    """
+    :return: index of the registry shard owning service, registries and clients all agree on it
+    """
+    return zlib.crc32(service.encode()) % shard_count
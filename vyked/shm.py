@@ -0,0 +1,274 @@
+import asyncio
+import logging
+import mmap
+import os
+import re
+import stat
+import struct
+import tempfile
+from functools import partial
+from uuid import uuid4
+
+RING_CAPACITY = 4 * 1024 * 1024
+RETRY_FULL_DELAY = 0.001
+
+_HEADER = struct.Struct('=QQ')
+_WAKEUP = b'\x00'
+_HANDSHAKE_END = b'\n'
+_MAX_HANDSHAKE = 4096
+_SHM_FILE = re.compile(r'^vyked_[0-9a-f]{32}\.shm$')
+
+_logger = logging.getLogger(__name__)
+
+
+class RingBuffer:
+    """
+    Single producer, single consumer byte ring over a memory mapped region.
+    The header holds monotonically increasing write and read counters, the data follows it.
+    """
+
+    def __init__(self, mm, offset, capacity):
+        self._mm = mm
+        self._offset = offset
+        self._data = offset + _HEADER.size
+        self._capacity = capacity
+
+    @staticmethod
+    def size(capacity):
+        return _HEADER.size + capacity
+
+    def _counters(self):
+        return _HEADER.unpack_from(self._mm, self._offset)
+
+    def write(self, data):
+        """
+        Copies as much of data as fits into the ring
+        :return: the number of bytes written
+        """
+        written, read = self._counters()
+        length = min(len(data), self._capacity - (written - read))
+        if length <= 0:
+            return 0
+        start = written % self._capacity
+        first = min(length, self._capacity - start)
+        self._mm[self._data + start:self._data + start + first] = data[:first]
+        if first < length:
+            self._mm[self._data:self._data + length - first] = data[first:length]
+        struct.pack_into('=Q', self._mm, self._offset, written + length)
+        return length
+
+    def read(self):
+        """
+        Consumes everything available in the ring
+        """
+        written, read = self._counters()
+        length = written - read
+        if not length:
+            return b''
+        start = read % self._capacity
+        first = min(length, self._capacity - start)
+        data = self._mm[self._data + start:self._data + start + first]
+        if first < length:
+            data += self._mm[self._data:self._data + length - first]
+        struct.pack_into('=Q', self._mm, self._offset + 8, written)
+        return data
+
+
+class ShmTransport(asyncio.Transport):
+    """
+    Moves bytes through a pair of shared memory rings, the unix socket it is created on only carries wakeups.
+    The first write in an event loop tick wakes the peer up straight away, later writes in the same tick share
+    a single trailing wakeup.
+    """
+
+    def __init__(self, loop, protocol, mm, tx_ring, rx_ring, channel, path):
+        super().__init__()
+        self._loop = loop
+        self._protocol = protocol
+        self._mm = mm
+        self._tx_ring = tx_ring
+        self._rx_ring = rx_ring
+        self._channel = channel
+        self._path = path
+        self._buffer = bytearray()
+        self._in_tick = False
+        self._wakeup_pending = False
+        self._retry_scheduled = False
+        self._closing = False
+
+    def get_extra_info(self, name, default=None):
+        if name == 'peername':
+            return 'shm:{}'.format(self._path)
+        return self._channel.get_extra_info(name, default)
+
+    def is_closing(self):
+        return self._closing
+
+    def write(self, data):
+        if self._closing:
+            return
+        self._buffer.extend(data)
+        if not self._retry_scheduled:
+            self._flush()
+
+    def can_write_eof(self):
+        return False
+
+    def get_write_buffer_size(self):
+        return len(self._buffer)
+
+    def close(self):
+        if not self._closing:
+            self._closing = True
+            self._channel.close()
+
+    def abort(self):
+        self.close()
+
+    def _flush(self):
+        written = self._tx_ring.write(self._buffer)
+        if written:
+            del self._buffer[:written]
+            if self._in_tick:
+                self._wakeup_pending = True
+            else:
+                self._in_tick = True
+                self._channel.write(_WAKEUP)
+                self._loop.call_soon(self._end_tick)
+        if self._buffer and not self._retry_scheduled:
+            self._retry_scheduled = True
+            self._loop.call_later(RETRY_FULL_DELAY, self._retry)
+
+    def _end_tick(self):
+        self._in_tick = False
+        if self._wakeup_pending and not self._closing:
+            self._wakeup_pending = False
+            self._channel.write(_WAKEUP)
+
+    def _retry(self):
+        self._retry_scheduled = False
+        if not self._closing and self._buffer:
+            self._flush()
+
+    def _read_ready(self):
+        data = self._rx_ring.read()
+        if data:
+            self._protocol.data_received(data)
+
+    def _connection_lost(self, exc):
+        self._closing = True
+        self._mm.close()
+        self._protocol.connection_lost(exc)
+
+
+class _ShmChannel(asyncio.Protocol):
+    """
+    Unix socket side of a shared memory connection, sets up the rings and turns wakeups into reads
+    """
+
+    def __init__(self, loop, protocol_factory, path=None, capacity=RING_CAPACITY):
+        self._loop = loop
+        self._protocol_factory = protocol_factory
+        self._path = path
+        self._capacity = capacity
+        self._handshake = bytearray()
+        self._shm_transport = None
+        self._socket_transport = None
+        self.protocol = None
+
+    def connection_made(self, transport):
+        self._socket_transport = transport
+        if self._path is not None:  # connecting side owns the shared memory file
+            mm = _create_mapping(self._path, self._capacity)
+            transport.write(self._path.encode() + _HANDSHAKE_END)
+            self._start(mm, tx_offset=0, rx_offset=RingBuffer.size(self._capacity))
+
+    def data_received(self, data):
+        if self._shm_transport is None:
+            self._handshake.extend(data)
+            if _HANDSHAKE_END not in self._handshake:
+                if len(self._handshake) > _MAX_HANDSHAKE:
+                    self._reject('an overlong handshake')
+                return
+            path, _ = bytes(self._handshake).split(_HANDSHAKE_END, 1)
+            path = path.decode(errors='replace')
+            if not _is_shm_file(path):
+                self._reject(path)
+                return
+            self._path = path
+            mm, self._capacity = _open_mapping(self._path)
+            self._start(mm, tx_offset=RingBuffer.size(self._capacity), rx_offset=0)
+        self._shm_transport._read_ready()
+
+    def connection_lost(self, exc):
+        if self._shm_transport is not None:
+            self._shm_transport._connection_lost(exc)
+        if self._path is not None and os.path.exists(self._path):
+            os.remove(self._path)
+
+    def _reject(self, path):
+        _logger.warning('Refusing shared memory connection to %s', path)
+        self._socket_transport.close()
+
+    def _start(self, mm, tx_offset, rx_offset):
+        self.protocol = self._protocol_factory()
+        self._shm_transport = ShmTransport(self._loop, self.protocol, mm,
+                                           RingBuffer(mm, tx_offset, self._capacity),
+                                           RingBuffer(mm, rx_offset, self._capacity),
+                                           self._socket_transport, self._path)
+        self.protocol.connection_made(self._shm_transport)
+
+
+def _create_mapping(path, capacity):
+    # never follows a file or link planted at path, and only this user can map the rings
+    fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+    with open(fd, 'r+b') as f:
+        f.truncate(2 * RingBuffer.size(capacity))
+        return mmap.mmap(f.fileno(), 0)
+
+
+def _open_mapping(path):
+    with open(path, 'r+b') as f:
+        mm = mmap.mmap(f.fileno(), 0)
+    os.remove(path)  # both ends have it mapped now, nothing is left behind if either dies
+    return mm, len(mm) // 2 - _HEADER.size
+
+
+def _is_shm_file(path):
+    """
+    Tells if path names a shared memory file a client created with create_shm_connection, the server maps and
+    removes it so a peer must not be able to point it anywhere else
+    """
+    if os.path.dirname(path) != _shm_dir() or not _SHM_FILE.match(os.path.basename(path)):
+        return False
+    try:
+        return stat.S_ISREG(os.lstat(path).st_mode)
+    except OSError:
+        return False
+
+
+def _shm_dir():
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+@asyncio.coroutine
+def create_shm_server(protocol_factory, path, loop=None):
+    """
+    Serve protocol_factory over shared memory, clients find the server through the unix socket at path
+    :return: the asyncio server listening on the unix socket
+    """
+    loop = loop or asyncio.get_event_loop()
+    return (yield from loop.create_unix_server(partial(_ShmChannel, loop, protocol_factory), path))
+
+
+@asyncio.coroutine
+def create_shm_connection(protocol_factory, path, loop=None, capacity=RING_CAPACITY):
+    """
+    Connect to a server started with create_shm_server
+    :return: a (transport, protocol) tuple like loop.create_connection
+    """
+    loop = loop or asyncio.get_event_loop()
+    shm_path = os.path.join(_shm_dir(), 'vyked_{}.shm'.format(uuid4().hex))
+    _, channel = yield from loop.create_unix_connection(
+        partial(_ShmChannel, loop, protocol_factory, shm_path, capacity), path)
+    return channel._shm_transport, channel.protocol
@@ -0,0 +1,250 @@
+import asyncio
+from collections import deque
+import json
+import logging
+
+from again.utils import unique_hex
+
+STREAM_MAX_LENGTH = 100000
+READ_COUNT = 100
+READ_BLOCK = 1000  # milliseconds
+CLAIM_IDLE = 30000  # milliseconds an entry stays unacked before another consumer of the group takes it over
+LEADER_LEASE = 3000  # milliseconds
+RECONNECT_DELAY = 1
+
+# renews the lease if this consumer holds it, takes it if nobody does
+_LEAD_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+if redis.call('set', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+_logger = logging.getLogger(__name__)
+
+
+class RedisError(Exception):
+    """
+    Error reply of redis to a command
+    """
+
+
+def encode_command(*args):
+    parts = ['*{}\r\n'.format(len(args)).encode()]
+    for arg in args:
+        if not isinstance(arg, bytes):
+            arg = str(arg).encode()
+        parts.append('${}\r\n'.format(len(arg)).encode())
+        parts.append(arg)
+        parts.append(b'\r\n')
+    return b''.join(parts)
+
+
+@asyncio.coroutine
+def read_reply(reader):
+    """
+    Reads one reply, an error reply nested in an array is returned as a RedisError rather than raised
+    """
+    line = yield from reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise ConnectionError('Redis closed the connection')
+    kind, value = line[:1], line[1:-2]
+    if kind == b'+':
+        return value.decode()
+    if kind == b'-':
+        return RedisError(value.decode())
+    if kind == b':':
+        return int(value)
+    if kind == b'$':
+        if int(value) < 0:
+            return None
+        data = yield from reader.readexactly(int(value) + 2)
+        return data[:-2]
+    if kind == b'*':
+        if int(value) < 0:
+            return None
+        items = []
+        for _ in range(int(value)):
+            items.append((yield from read_reply(reader)))
+        return items
+    raise ConnectionError('Unexpected reply from redis: {}'.format(line))
+
+
+class RespConnection:
+    """
+    Minimal redis connection, commands sent while others are waiting for their replies are pipelined
+    """
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._waiting = deque()
+        self._reading = asyncio.async(self._read_replies())
+
+    @classmethod
+    @asyncio.coroutine
+    def create(cls, host, port):
+        reader, writer = yield from asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    def execute(self, *args):
+        """
+        :return: future of the reply, failing with RedisError for an error reply
+        """
+        future = asyncio.Future()
+        if self._reading.done():
+            future.set_exception(ConnectionError('Redis connection is closed'))
+        else:
+            self._waiting.append(future)
+            self._writer.write(encode_command(*args))
+        return future
+
+    def close(self):
+        self._writer.close()
+
+    @asyncio.coroutine
+    def _read_replies(self):
+        try:
+            while True:
+                reply = yield from read_reply(self._reader)
+                future = self._waiting.popleft()
+                if future.done():
+                    continue
+                if isinstance(reply, RedisError):
+                    future.set_exception(reply)
+                else:
+                    future.set_result(reply)
+        except (ConnectionError, asyncio.IncompleteReadError) as e:
+            while self._waiting:
+                future = self._waiting.popleft()
+                if not future.done():
+                    future.set_exception(ConnectionError(str(e)))
+
+
+class Streams:
+    """
+    xpublish and xsubscribe over redis streams consumer groups.
+    Every endpoint is a stream and every subscribing service a consumer group on it, so an event is delivered to one
+    node of each subscribing service and stays in redis until that node acks it. Entries left unacked by a node that
+    died are claimed by the others of its group after claim_idle milliseconds. With the LEADER strategy only the node
+    holding the group's lease in redis reads, the lease moves to another node when it is not renewed.
+    """
+
+    def __init__(self, host, port, group, max_length=STREAM_MAX_LENGTH, count=READ_COUNT, block=READ_BLOCK,
+                 claim_idle=CLAIM_IDLE, leader_lease=LEADER_LEASE):
+        """
+        :param group: consumer group of this service, its nodes share the events of the streams it reads
+        :param max_length: entries a stream keeps, approximately, acked or not
+        :param count: entries read and acked in one round trip
+        """
+        self._host = host
+        self._port = port
+        self._group = group
+        self._consumer = '{}_{}'.format(group, unique_hex())
+        self._max_length = max_length
+        self._count = count
+        self._block = block
+        self._claim_idle = claim_idle
+        self._leader_lease = leader_lease
+        self._conn = None
+
+    @staticmethod
+    def stream_key(endpoint):
+        return 'vyked:stream:' + endpoint
+
+    @asyncio.coroutine
+    def connect(self):
+        self._conn = yield from RespConnection.create(self._host, self._port)
+        return self._conn
+
+    @asyncio.coroutine
+    def add(self, endpoint, payload: str):
+        """
+        Appends an event to the stream of endpoint
+        :return: the id of the entry, None if redis could not be reached
+        """
+        try:
+            if self._conn is None:
+                yield from self.connect()
+            entry_id = yield from self._conn.execute('XADD', self.stream_key(endpoint), 'MAXLEN', '~',
+                                                     self._max_length, '*', 'payload', payload)
+            return entry_id.decode()
+        except (ConnectionError, OSError, RedisError) as e:
+            _logger.error('Could not add to stream %s: %s', endpoint, repr(e))
+            if not isinstance(e, RedisError):  # connects again on the next add
+                self._conn = None
+            return None
+
+    @asyncio.coroutine
+    def consume(self, endpoint, handler, strategy='RANDOM'):
+        """
+        Hands the events of endpoint to handler on a connection of its own, reconnecting when it drops
+        :param handler: coroutine function called with the payload of each event, the event is acked if it returns
+        """
+        while True:
+            conn = None
+            try:
+                conn = yield from RespConnection.create(self._host, self._port)
+                yield from self._consume(conn, self.stream_key(endpoint), handler, strategy)
+            except (ConnectionError, OSError, RedisError) as e:
+                _logger.error('Reading stream %s failed: %s', endpoint, repr(e))
+            finally:
+                if conn is not None:
+                    conn.close()
+            yield from asyncio.sleep(RECONNECT_DELAY)
+
+    @asyncio.coroutine
+    def _consume(self, conn, stream, handler, strategy):
+        try:
+            yield from conn.execute('XGROUP', 'CREATE', stream, self._group, '$', 'MKSTREAM')
+        except RedisError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+        loop = asyncio.get_event_loop()
+        leader_key = 'vyked:leader:{}:{}'.format(stream, self._group)
+        claim_due = loop.time()
+        while True:
+            if strategy == 'LEADER' and not (yield from conn.execute(
+                    'EVAL', _LEAD_SCRIPT, 1, leader_key, self._consumer, self._leader_lease)):
+                yield from asyncio.sleep(self._leader_lease / 3000)
+                continue
+            entries = []
+            if loop.time() >= claim_due:
+                claimed = yield from conn.execute('XAUTOCLAIM', stream, self._group, self._consumer,
+                                                  self._claim_idle, '0-0', 'COUNT', self._count)
+                entries = [entry for entry in claimed[1] if entry]
+                if len(entries) < self._count:
+                    claim_due = loop.time() + self._claim_idle / 2000
+            if not entries:
+                block = min(self._block, self._leader_lease // 3) if strategy == 'LEADER' else self._block
+                reply = yield from conn.execute('XREADGROUP', 'GROUP', self._group, self._consumer,
+                                                'COUNT', self._count, 'BLOCK', block, 'STREAMS', stream, '>')
+                entries = reply[0][1] if reply else []
+            if entries:
+                yield from self._handle(conn, stream, entries, handler)
+
+    @asyncio.coroutine
+    def _handle(self, conn, stream, entries, handler):
+        """
+        Runs the handler for a batch of entries and acks the ones it handled in a single XACK
+        """
+        ids = [entry_id for entry_id, _ in entries]
+        results = yield from asyncio.gather(*(self._run(handler, fields) for _, fields in entries),
+                                            return_exceptions=True)
+        handled = []
+        for entry_id, result in zip(ids, results):
+            if isinstance(result, BaseException):
+                _logger.error('Handling %s of %s failed, it is retried after %sms', entry_id.decode(), stream,
+                              self._claim_idle, exc_info=result)
+            else:
+                handled.append(entry_id)
+        if handled:
+            yield from conn.execute('XACK', stream, self._group, *handled)
+
+    @asyncio.coroutine
+    def _run(self, handler, fields):
+        values = dict(zip(fields[::2], fields[1::2]))
+        return (yield from handler(json.loads(values[b'payload'].decode())))
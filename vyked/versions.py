@@ -0,0 +1,127 @@
+import bisect
+import re
+
+from again.utils import natural_sort
+
+_COMPARATOR = re.compile(r'^(>=|<=|==|>|<)\s*(.+)$')
+
+
+def version_key(version):
+    """
+    Natural sort key of a version that also orders versions starting with a letter, after the numeric ones
+    """
+    key = natural_sort(version)
+    return (isinstance(key[0], str) if key else False, key)
+
+
+def parse_range(spec):
+    """
+    Turns a version requirement into (lower, lower_inclusive, upper, upper_inclusive) bounds, None for no bound.
+    Supported requirements are '*', '~1.2' for the 1.2 minor series, '^1.2' for 1.2 up to the next major and
+    explicit ranges like '>=1.2,<2' or '==1.4.0'.
+    :return: None if spec is a plain version
+    """
+    spec = spec.strip()
+    if spec == '*':
+        return None, True, None, True
+    if spec[:1] in ('~', '^'):
+        parts = spec[1:].strip().split('.')
+        bumped = 1 if spec[0] == '~' and len(parts) > 1 else 0
+        upper = _next(parts[:bumped + 1])
+        return spec[1:].strip(), True, upper, False
+    comparators = [_COMPARATOR.match(part.strip()) for part in spec.split(',')]
+    if not all(comparators):
+        return None
+    lower, lower_inclusive, upper, upper_inclusive = None, True, None, True
+    for comparator in comparators:
+        operator, version = comparator.group(1), comparator.group(2).strip()
+        if operator in ('>', '>=', '==') and (lower is None or version_key(version) >= version_key(lower)):
+            lower, lower_inclusive = version, operator != '>'
+        if operator in ('<', '<=', '==') and (upper is None or version_key(version) <= version_key(upper)):
+            upper, upper_inclusive = version, operator != '<'
+    return lower, lower_inclusive, upper, upper_inclusive
+
+
+def _next(parts):
+    """
+    :return: the version right after the series of parts, '1.3' for ['1', '2'], None if the last part isn't numeric
+    """
+    if not parts[-1].isdigit():
+        return None
+    return '.'.join(parts[:-1] + [str(int(parts[-1]) + 1)])
+
+
+class VersionIndex:
+    """
+    Registered versions of a service kept sorted, resolving a requirement takes a bisection.
+    Resolutions are cached until a version is added or removed.
+    """
+
+    def __init__(self):
+        self._versions = []
+        self._keys = []
+        self._resolved = {}
+
+    def __contains__(self, version):
+        index = bisect.bisect_left(self._keys, version_key(version))
+        return index < len(self._versions) and self._versions[index] == version
+
+    def __len__(self):
+        return len(self._versions)
+
+    def __iter__(self):
+        return iter(self._versions)
+
+    def add(self, version):
+        if version not in self:
+            key = version_key(version)
+            index = bisect.bisect_left(self._keys, key)
+            self._keys.insert(index, key)
+            self._versions.insert(index, version)
+            self._resolved.clear()
+
+    def remove(self, version):
+        if version in self:
+            index = bisect.bisect_left(self._keys, version_key(version))
+            del self._keys[index]
+            del self._versions[index]
+            self._resolved.clear()
+
+    def resolve(self, requirement):
+        """
+        :return: the version serving consumers that depend on requirement, None if no registered version does.
+        A plain version resolves to itself if registered, to the highest version with the same major otherwise.
+        """
+        if requirement not in self._resolved:
+            self._resolved[requirement] = self._resolve(requirement)
+        return self._resolved[requirement]
+
+    def _resolve(self, requirement):
+        if requirement in self:
+            return requirement
+        bounds = parse_range(requirement)
+        if bounds is not None:
+            return self._highest(*bounds)
+        major = requirement.split('.')[0]
+        if major.isdigit():
+            return self._highest(major, True, str(int(major) + 1), False)
+        for version in reversed(self._versions):
+            if version.split('.')[0] == major:
+                return version
+        return None
+
+    def _highest(self, lower, lower_inclusive, upper, upper_inclusive):
+        if upper is None:
+            index = len(self._keys)
+        elif upper_inclusive:
+            index = bisect.bisect_right(self._keys, version_key(upper))
+        else:
+            index = bisect.bisect_left(self._keys, version_key(upper))
+        if not index:
+            return None
+        candidate = self._keys[index - 1]
+        if lower is not None:
+            lower_key = version_key(lower)
+            if candidate < lower_key or (candidate == lower_key and not lower_inclusive):
+                return None
+        return self._versions[index - 1]